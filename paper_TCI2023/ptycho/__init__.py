@@ -1 +1 @@
-__all__ = ["pie", "sharp", "wf"]
+__all__ = ["pie", "sharp", "wf", "fft_backend", "patch_ops", "metrics", "checkpoint", "runner", "meas_store", "prep_cache", "stopping", "multires", "tiling", "streaming", "precision", "projection", "benchmark", "telemetry", "observers", "batch", "parallel", "positions"]
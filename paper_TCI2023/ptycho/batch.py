@@ -0,0 +1,158 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.meas_store import open_measurement
+from paper_TCI2023.ptycho.patch_ops import PatchOperator
+from paper_TCI2023.ptycho.precision import get_precision
+
+
+'''
+This file defines the batch reconstruction of many data sets sharing the scan pattern, the detector geometry and
+(optionally) the probe, e.g. the projections of a tomography scan. The patch operator with its index maps and
+image weights and the FFT backend with its plans are created once per process and reused for every data set,
+and loading the next data sets overlaps with the running reconstructions.
+'''
+
+
+# structures shared by all data sets reconstructed in this process
+_shared = {}
+
+
+def _init_shared(patch_bounds, img_shape, patch_shape, probe=None, fft_backend=None):
+    """Create the patch operator (with the image weight of probe) and the FFT backend of this process."""
+    patch_op = PatchOperator(patch_bounds, img_shape, patch_shape)
+    if probe is not None:
+        patch_op.illumination_weight(probe)
+    _shared.update(patch_op=patch_op, fft=get_fft_backend(fft_backend))
+
+
+def load_dataset(source, meas_window=None):
+    """Load the measurements of one data set.
+
+    Args:
+        source: array of pre-processed measurements, path to a measurement store (see meas_store), or function
+            without arguments returning the measurements.
+        meas_window: optional window applied to the frames read from a measurement store.
+
+    Returns:
+        pre-processed measurements.
+    """
+    if isinstance(source, str):
+        store = open_measurement(source, window=meas_window)
+        try:
+            return store.read()
+        finally:
+            store.close()
+    if callable(source):
+        return source()
+
+    return source
+
+
+def _recon_dataset(recon_func, source, init_obj, kwargs, meas_window=None):
+    """Load and reconstruct one data set with the shared structures of this process."""
+    y_meas = load_dataset(source, meas_window=meas_window)
+
+    return recon_func(y_meas, _shared['patch_op'], init_obj, fft_backend=_shared['fft'], **kwargs)
+
+
+def iter_batch_recon(datasets, patch_bounds, init_obj, recon_func, frm_shape=None, init_probe=None, ref_probe=None,
+                     joint_recon=False, save_dir=None, num_workers=1, prefetch=2, fft_backend=None, meas_window=None,
+                     **kwargs):
+    """Batch reconstruction.
+
+    Function to reconstruct a sequence of data sets with the same scan coordinates, yielding the results in the
+    order of the data sets. At most num_workers + prefetch data sets are loaded or in progress at a time, so
+    that a generator of data sets is consumed lazily.
+
+    Args:
+        datasets: list or iterator of data sets (arrays, paths to measurement stores or functions returning the
+            measurements, see load_dataset). Paths and functions are loaded by the workers.
+        patch_bounds: scan coordinates of projections shared by all data sets.
+        init_obj: formulated initial guess of complex object.
+        recon_func: reconstruction engine, e.g. sharp.sharp_recon, pie.epie_recon or wf.wf_recon.
+        frm_shape: shape of the frames (read from the first data set if None).
+        init_probe: formulated initial guess of complex probe.
+        ref_probe: complex reference image for probe (the known probe if not joint_recon).
+        joint_recon: option to estimate complex probe for blind ptychography.
+        save_dir: directory to save the reconstruction results (one sub-directory per data set).
+        num_workers: number of worker processes. 1 reconstructs the data sets in the current process, while a
+            thread loads the next data sets.
+        prefetch: number of data sets loaded or queued ahead of the running reconstructions.
+        fft_backend: FFT backend name (see fft_backend.get_fft_backend).
+        meas_window: optional window applied to the frames read from a measurement store.
+        **kwargs: further keyword arguments of recon_func.
+
+    Yields:
+        (index, result dictionary) of every data set.
+    """
+    datasets = iter(datasets)
+    first = next(datasets, None)
+    if first is None:
+        return
+    if frm_shape is None:
+        if isinstance(first, str):
+            store = open_measurement(first)
+            frm_shape = store.shape[1:]
+            store.close()
+        else:
+            first = load_dataset(first)
+            frm_shape = first.shape[1:]
+    # the image weight of the known probe is computed in the precision of the engine, matching its later calls
+    shared_args = (patch_bounds, init_obj.shape, (len(patch_bounds),) + tuple(frm_shape),
+                   None if joint_recon else get_precision(kwargs.get('precision')).complex(ref_probe), fft_backend)
+
+    def job_args(index):
+        args = dict(init_probe=init_probe, ref_probe=ref_probe, joint_recon=joint_recon, **kwargs)
+        if save_dir is not None:
+            args.update(save_dir=os.path.join(save_dir, '{:04d}/'.format(index)))
+        return args
+
+    if num_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_shared, initargs=shared_args)
+    else:
+        # reconstruct in this process and load the next data sets in a thread
+        _init_shared(*shared_args)
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(index, source):
+        if num_workers > 1:
+            return executor.submit(_recon_dataset, recon_func, source, init_obj, job_args(index), meas_window)
+        return executor.submit(load_dataset, source, meas_window)
+
+    print('Batch recon starts ...')
+    pending = deque()
+    index, source = 0, first
+    try:
+        while source is not None or pending:
+            # keep the pipeline filled
+            while source is not None and len(pending) < num_workers + prefetch:
+                pending.append((index, submit(index, source)))
+                index, source = index + 1, next(datasets, None)
+            job_index, future = pending.popleft()
+            if num_workers > 1:
+                yield job_index, future.result()
+            else:
+                yield job_index, recon_func(future.result(), _shared['patch_op'], init_obj, fft_backend=_shared['fft'],
+                                            **job_args(job_index))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def batch_recon(datasets, patch_bounds, init_obj, recon_func, **kwargs):
+    """Batch reconstruction.
+
+    Function to reconstruct a list of data sets with the same scan coordinates (see iter_batch_recon).
+
+    Args:
+        datasets: list or iterator of data sets.
+        patch_bounds: scan coordinates of projections shared by all data sets.
+        init_obj: formulated initial guess of complex object.
+        recon_func: reconstruction engine, e.g. sharp.sharp_recon, pie.epie_recon or wf.wf_recon.
+        **kwargs: further keyword arguments of iter_batch_recon and recon_func.
+
+    Returns:
+        list of result dictionaries in the order of the data sets.
+    """
+    return [result for _, result in iter_batch_recon(datasets, patch_bounds, init_obj, recon_func=recon_func, **kwargs)]
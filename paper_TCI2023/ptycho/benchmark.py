@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager
+from scipy import ndimage
+from paper_TCI2023.ptycho import pie, wf, sharp
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.patch_ops import PatchOperator
+from paper_TCI2023.ptycho.precision import get_precision
+from paper_TCI2023.ptycho.telemetry import PhaseTimer, TimedFFT
+
+
+'''
+This file defines a self-contained benchmark of the reconstruction engines. Synthetic objects, probes, raster or
+spiral scans and Poisson-noised diffraction data are generated offline at configurable sizes, and every engine is
+timed per iteration and per phase (FFT, inverse FFT, gather, scatter, metrics). Results are written to JSON, so that runs of
+different versions can be compared.
+'''
+
+
+ENGINES = {'ePIE': pie.epie_recon, 'WF': wf.wf_recon, 'SHARP': sharp.sharp_recon, 'SHARP+': sharp.sharp_plus_recon}
+
+
+def synthetic_object(shape, smoothness=4, seed=0):
+    """Generate a smooth random complex object with amplitude in [0.5, 1] and phase in [-pi/2, pi/2].
+
+    Args:
+        shape: shape of the object.
+        smoothness: standard deviation of the Gaussian filter applied to the random fields (in pixels).
+        seed: random seed.
+
+    Returns:
+        complex object.
+    """
+    rng = np.random.default_rng(seed)
+    fields = []
+    for _ in range(2):
+        field = ndimage.gaussian_filter(rng.standard_normal(shape), smoothness)
+        fields.append((field - np.amin(field)) / (np.amax(field) - np.amin(field)))
+
+    return ((0.5 + 0.5 * fields[0]) * np.exp(1j * np.pi * (fields[1] - 0.5))).astype(np.complex64)
+
+
+def synthetic_probe(size, aperture=0.25, defocus=20.0):
+    """Generate a probe as the defocused image of a circular pupil.
+
+    Args:
+        size: side length of the probe (and of the diffraction patterns).
+        aperture: pupil radius as a fraction of the Fourier domain.
+        defocus: quadratic phase at the pupil edge (in radians).
+
+    Returns:
+        complex probe with unit peak amplitude.
+    """
+    freq = np.fft.fftshift(np.fft.fftfreq(size))
+    rho = np.hypot(*np.meshgrid(freq, freq, indexing='ij')) / (aperture / 2)
+    pupil = (rho <= 1) * np.exp(1j * defocus * rho ** 2)
+    probe = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(pupil)))
+
+    return (probe / np.amax(np.abs(probe))).astype(np.complex64)
+
+
+def raster_scan(img_size, probe_size, step, jitter=0, seed=0):
+    """Generate a raster scan covering the object.
+
+    Args:
+        img_size: side length of the object.
+        probe_size: side length of the probe.
+        step: distance between neighboring scan positions (in pixels).
+        jitter: maximum random offset added to every position (in pixels).
+        seed: random seed of the jitter.
+
+    Returns:
+        scan coordinates of projections.
+    """
+    rng = np.random.default_rng(seed)
+    starts = np.arange(0, img_size - probe_size + 1, step)
+    corners = np.array([[row, col] for row in starts for col in starts])
+    if jitter > 0:
+        corners = np.clip(corners + rng.integers(-jitter, jitter + 1, corners.shape), 0, img_size - probe_size)
+
+    return np.concatenate([corners[:, :1], corners[:, :1] + probe_size, corners[:, 1:], corners[:, 1:] + probe_size], axis=1)
+
+
+def spiral_scan(img_size, probe_size, step):
+    """Generate a Fermat spiral scan covering the object.
+
+    Args:
+        img_size: side length of the object.
+        probe_size: side length of the probe.
+        step: approximate distance between neighboring scan positions (in pixels).
+
+    Returns:
+        scan coordinates of projections.
+    """
+    radius = (img_size - probe_size) / 2
+    num_pts = int(np.pi * radius ** 2 / step ** 2) + 1
+    n = np.arange(num_pts)
+    r = step * np.sqrt(n / np.pi)
+    theta = n * np.pi * (3 - np.sqrt(5))
+    corners = np.round(radius + np.stack([r * np.sin(theta), r * np.cos(theta)], axis=1)).astype(int)
+
+    return np.concatenate([corners[:, :1], corners[:, :1] + probe_size, corners[:, 1:], corners[:, 1:] + probe_size], axis=1)
+
+
+def simulate_data(obj, probe, patch_bounds, photon_peak=1e4, seed=0):
+    """Simulate Poisson-noised ptychographic measurements.
+
+    The probe is scaled such that the brightest pixel of the noise-free intensities receives photon_peak photons.
+
+    Args:
+        obj: complex object.
+        probe: complex probe.
+        patch_bounds: scan coordinates of projections.
+        photon_peak: expected photon count of the brightest pixel.
+        seed: random seed of the noise.
+
+    Returns:
+        pre-processed measurements (square root of the photon counts) and the scaled probe.
+    """
+    rng = np.random.default_rng(seed)
+    fft = get_fft_backend()
+    patch_op = PatchOperator(patch_bounds, obj.shape, (len(patch_bounds),) + probe.shape)
+    intensity = np.abs(fft.ft(patch_op.img2patch(obj) * probe)) ** 2
+    scale = photon_peak / np.amax(intensity)
+    counts = rng.poisson(scale * intensity)
+
+    return np.sqrt(counts).astype(np.float32), (np.sqrt(scale) * probe).astype(np.complex64)
+
+
+def make_dataset(obj_size=256, probe_size=64, scan='raster', step=16, jitter=0, photon_peak=1e4, seed=0):
+    """Generate a synthetic data set.
+
+    Args:
+        obj_size: side length of the object.
+        probe_size: side length of the probe.
+        scan: scan pattern ('raster' or 'spiral').
+        step: distance between neighboring scan positions (in pixels).
+        jitter: maximum random offset of the raster positions (in pixels).
+        photon_peak: expected photon count of the brightest pixel.
+        seed: random seed.
+
+    Returns:
+        dictionary with the measurements ('y_meas'), scan coordinates ('patch_bounds'), ground truth object
+        ('ref_obj') and probe ('ref_probe') and the initial object ('init_obj').
+    """
+    if scan == 'raster':
+        patch_bounds = raster_scan(obj_size, probe_size, step, jitter=jitter, seed=seed)
+    elif scan == 'spiral':
+        patch_bounds = spiral_scan(obj_size, probe_size, step)
+    else:
+        raise ValueError('Unknown scan pattern: {}'.format(scan))
+    ref_obj = synthetic_object((obj_size, obj_size), seed=seed)
+    y_meas, ref_probe = simulate_data(ref_obj, synthetic_probe(probe_size), patch_bounds, photon_peak=photon_peak, seed=seed)
+    init_obj = np.ones_like(ref_obj)
+
+    return dict(y_meas=y_meas, patch_bounds=patch_bounds, ref_obj=ref_obj, ref_probe=ref_probe, init_obj=init_obj)
+
+
+@contextmanager
+def instrument(timer):
+    """Instrument the patch operations (gather, scatter) and convergence metrics of the engines."""
+    targets = [(PatchOperator, 'img2patch', 'gather'), (PatchOperator, 'patch2img', 'scatter')]
+    for module in [pie, wf, sharp]:
+        targets += [(module, name, 'metrics') for name in ['phase_norm', 'compute_nrmse', 'meas_nrmse', 'ft_nrmse']
+                    if hasattr(module, name)]
+    originals = [(owner, name, getattr(owner, name)) for owner, name, _ in targets]
+    try:
+        for (owner, name, phase), (_, _, func) in zip(targets, originals):
+            setattr(owner, name, timer.wrap(phase, func))
+        yield timer
+    finally:
+        for owner, name, func in originals:
+            setattr(owner, name, func)
+
+
+def time_engine(recon_func, data, num_iter=10, warmup=2, repeat=1, fft_backend=None, **kwargs):
+    """Time one reconstruction engine.
+
+    A warmup run of warmup iterations (e.g. creating FFT plans) precedes repeat timed runs of num_iter iterations.
+    The fastest timed run is reported. ePIE updates the patches by slicing, so its gather and scatter time is part
+    of 'other'.
+
+    Args:
+        recon_func: reconstruction engine.
+        data: data set (see make_dataset).
+        num_iter: number of iterations of a timed run.
+        warmup: number of iterations of the warmup run (0 skips it).
+        repeat: number of timed runs.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        **kwargs: further keyword arguments of recon_func.
+
+    Returns:
+        dictionary with the total time ('total_s'), the time per iteration ('per_iter_s'), the exclusive time per
+        phase ('phases_s', including 'other' for the remaining time), the number of calls per phase ('calls') and
+        the final errors.
+    """
+    fft = get_fft_backend(fft_backend)
+    args = dict(init_probe=data['ref_probe'], ref_obj=data['ref_obj'], ref_probe=data['ref_probe'], fft_backend=fft, **kwargs)
+    if warmup > 0:
+        recon_func(data['y_meas'], data['patch_bounds'], data['init_obj'], num_iter=warmup, **args)
+
+    best = None
+    for _ in range(repeat):
+        timer = PhaseTimer()
+        args.update(fft_backend=TimedFFT(fft, timer))
+        with instrument(timer):
+            start = time.perf_counter()
+            output = recon_func(data['y_meas'], data['patch_bounds'], data['init_obj'], num_iter=num_iter, **args)
+            total = time.perf_counter() - start
+        if best is None or total < best['total_s']:
+            phases = {phase: timer.totals[phase] for phase in ['fft', 'ifft', 'gather', 'scatter', 'metrics']}
+            phases['other'] = total - sum(phases.values())
+            best = dict(total_s=total, per_iter_s=total / output['num_iter'], phases_s=phases, calls=dict(timer.counts),
+                        num_iter=output['num_iter'], err_obj=float(output['err_obj'][-1]) if output['err_obj'] else None,
+                        err_meas=float(output['err_meas'][-1]) if output['err_meas'] else None)
+
+    return best
+
+
+def peak_memory(recon_func, data, num_iter=1, **kwargs):
+    """Measure the peak memory allocated by one reconstruction.
+
+    Allocations are traced with tracemalloc, which includes the data of NumPy arrays. The arrays of the data set
+    existing before the reconstruction are not counted.
+
+    Args:
+        recon_func: reconstruction engine.
+        data: data set (see make_dataset).
+        num_iter: number of iterations.
+        **kwargs: further keyword arguments of recon_func.
+
+    Returns:
+        peak memory in MB.
+    """
+    args = dict(init_probe=data['ref_probe'], ref_obj=data['ref_obj'], ref_probe=data['ref_probe'], **kwargs)
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        recon_func(data['y_meas'], data['patch_bounds'], data['init_obj'], num_iter=num_iter, **args)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    return peak / 2 ** 20
+
+
+def in_place_memory(data, engines=('SHARP', 'SHARP+'), num_iter=2, **kwargs):
+    """Measure the peak memory reduction of the in-place mode of SHARP and SHARP+.
+
+    Args:
+        data: data set (see make_dataset).
+        engines: names of the engines in ENGINES supporting in_place.
+        num_iter: number of iterations of the measured runs.
+        **kwargs: further keyword arguments of the engines.
+
+    Returns:
+        dictionary with the peak memory of the default and the in-place mode ('default_mb', 'in_place_mb'), the
+        reduction ('reduction_mb') and the size of one complex frame stack ('frame_stack_mb') per engine.
+    """
+    frame_stack_mb = data['y_meas'].size * get_precision(kwargs.get('precision')).cdtype.itemsize / 2 ** 20
+    # the patch operator is shared by both modes and built before the measurement
+    data = dict(data, patch_bounds=PatchOperator(data['patch_bounds'], data['init_obj'].shape, data['y_meas'].shape))
+    results = {}
+    for name in engines:
+        default_mb = peak_memory(ENGINES[name], data, num_iter=num_iter, in_place=False, **kwargs)
+        in_place_mb = peak_memory(ENGINES[name], data, num_iter=num_iter, in_place=True, **kwargs)
+        results[name] = dict(default_mb=default_mb, in_place_mb=in_place_mb, reduction_mb=default_mb - in_place_mb,
+                             frame_stack_mb=frame_stack_mb)
+        print('{} peak memory: {:.1f} MB default, {:.1f} MB in-place ({:.1f} frame stacks less).'.format(
+            name, default_mb, in_place_mb, (default_mb - in_place_mb) / frame_stack_mb))
+
+    return results
+
+
+def environment_info():
+    """Return the versions and hardware information stored with the benchmark results."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(commit=commit, python=sys.version.split()[0], numpy=np.__version__, platform=platform.platform(),
+                processor=platform.processor(), cpu_count=os.cpu_count())
+
+
+def run_benchmark(engines=None, dataset=None, num_iter=10, warmup=2, repeat=1, fft_backend=None, engine_args=None,
+                  output=None, memory=False, **kwargs):
+    """Benchmark the reconstruction engines on a synthetic data set.
+
+    Args:
+        engines: names of the engines in ENGINES (defaults to all engines).
+        dataset: keyword arguments of make_dataset.
+        num_iter: number of iterations of a timed run.
+        warmup: number of iterations of the warmup run.
+        repeat: number of timed runs per engine.
+        fft_backend: FFT backend name (see fft_backend.get_fft_backend).
+        engine_args: dictionary of keyword arguments per engine name.
+        output: path of the JSON file to write the results to.
+        memory: option to also measure the peak memory reduction of the in-place mode of SHARP and SHARP+.
+        **kwargs: keyword arguments passed to all engines (e.g. joint_recon, metrics or precision).
+
+    Returns:
+        benchmark results.
+    """
+    engines = list(ENGINES) if engines is None else engines
+    dataset = {} if dataset is None else dataset
+    engine_args = {} if engine_args is None else engine_args
+
+    data = make_dataset(**dataset)
+    results = dict(environment=environment_info(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   config=dict(dataset=dataset, num_frames=len(data['y_meas']), num_iter=num_iter, warmup=warmup,
+                               repeat=repeat, fft_backend=fft_backend, engine_args=engine_args,
+                               common_args={key: str(val) for key, val in kwargs.items()}),
+                   engines={})
+    for name in engines:
+        if name not in ENGINES:
+            raise ValueError('Unknown engine: {}'.format(name))
+        print('Benchmarking {} ...'.format(name))
+        results['engines'][name] = time_engine(ENGINES[name], data, num_iter=num_iter, warmup=warmup, repeat=repeat,
+                                               fft_backend=fft_backend, **kwargs, **engine_args.get(name, {}))
+        print('{}: {:.4g} s per iteration.'.format(name, results['engines'][name]['per_iter_s']))
+    if memory:
+        results['in_place_memory'] = in_place_memory(data, engines=[name for name in engines if name in ['SHARP', 'SHARP+']],
+                                                     fft_backend=fft_backend, **kwargs)
+
+    if output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import h5py
+
+
+'''
+This file defines the functions to save and restore the state of the reconstruction engines, so that long
+reconstructions can be interrupted and resumed.
+'''
+
+
+HISTORY_KEYS = ['err_obj', 'err_probe', 'err_meas', 'metric_iters']
+
+
+def save_checkpoint(fname, approach, iteration, **state):
+    """Save the solver state to an HDF5 checkpoint file.
+
+    The file is written to a temporary file first and then renamed, so an interrupted write never
+    corrupts an existing checkpoint.
+
+    Args:
+        fname: path to checkpoint file.
+        approach: name of the reconstruction approach.
+        iteration: number of completed iterations.
+        **state: arrays (or lists) describing the solver state. Entries with value None are skipped.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    tmp_fname = fname + '.tmp'
+    with h5py.File(tmp_fname, 'w') as f:
+        f.attrs['approach'] = approach
+        f.attrs['iteration'] = iteration
+        for key, val in state.items():
+            if val is not None:
+                f.create_dataset(key, data=np.asarray(val))
+    os.replace(tmp_fname, fname)
+
+
+def load_checkpoint(fname, approach=None):
+    """Load the solver state from an HDF5 checkpoint file.
+
+    Args:
+        fname: path to checkpoint file.
+        approach: expected name of the reconstruction approach (not checked if None).
+
+    Returns:
+        dictionary containing the number of completed iterations ('iteration') and the saved state.
+        History entries (see HISTORY_KEYS) are returned as lists.
+    """
+    with h5py.File(fname, 'r') as f:
+        if approach is not None and f.attrs['approach'] != approach:
+            raise ValueError('Checkpoint {} was written by {}, not {}.'.format(fname, f.attrs['approach'], approach))
+        state = {key: f[key][()] for key in f.keys()}
+        state['iteration'] = int(f.attrs['iteration'])
+    for key in HISTORY_KEYS:
+        state[key] = state[key].tolist() if key in state else []
+
+    return state
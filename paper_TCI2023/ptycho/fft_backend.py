@@ -0,0 +1,156 @@
+import os
+import pickle
+import threading
+import numpy as np
+from paper_TCI2023.ptycho_pmace.pmace.utils import compute_ft, compute_ift
+from paper_TCI2023.ptycho.parallel import fft_threads
+from paper_TCI2023.ptycho.precision import complex_dtype
+
+
+'''
+This file defines the FFT backends shared by the reconstruction engines. Every backend computes the same
+centered, orthonormal 2D DFT over the last two axes as compute_ft/compute_ift, and returns the complex dtype
+matching the precision of its input (complex64 or complex128).
+'''
+
+
+def _numpy_transform(input_array, inverse):
+    dtype = complex_dtype(input_array)
+    a = np.fft.fftshift(input_array.astype(dtype, copy=False), axes=(-2, -1))
+    b = np.fft.ifft2(a, axes=(-2, -1), norm='ortho') if inverse else np.fft.fft2(a, axes=(-2, -1), norm='ortho')
+    return np.fft.ifftshift(b, axes=(-2, -1)).astype(dtype, copy=False)
+
+
+class FFTBackend:
+    """Default FFT backend using compute_ft/compute_ift from the pmace utilities (single precision only, so double
+    precision inputs are transformed with numpy.fft)."""
+    name = 'default'
+
+    def ft(self, input_array):
+        """Compute the centered, orthonormal 2D DFT over the last two axes."""
+        if complex_dtype(input_array) == np.complex128:
+            return _numpy_transform(input_array, inverse=False)
+        return compute_ft(input_array)
+
+    def ift(self, input_array):
+        """Compute the centered, orthonormal 2D inverse DFT over the last two axes."""
+        if complex_dtype(input_array) == np.complex128:
+            return _numpy_transform(input_array, inverse=True)
+        return compute_ift(input_array)
+
+
+class NumpyFFT(FFTBackend):
+    """FFT backend using numpy.fft."""
+    name = 'numpy'
+
+    def _transform(self, input_array, inverse):
+        return _numpy_transform(input_array, inverse)
+
+    def ft(self, input_array):
+        return self._transform(input_array, inverse=False)
+
+    def ift(self, input_array):
+        return self._transform(input_array, inverse=True)
+
+
+class ScipyFFT(NumpyFFT):
+    """Multithreaded FFT backend using scipy.fft.
+
+    Args:
+        workers: number of worker threads (defaults to all cores, 1 inside the workers of a frame-parallel executor).
+    """
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        import scipy.fft
+        self._fft = scipy.fft
+        self.workers = os.cpu_count() if workers is None else workers
+
+    def _transform(self, input_array, inverse):
+        a = np.fft.fftshift(input_array.astype(complex_dtype(input_array), copy=False), axes=(-2, -1))
+        func = self._fft.ifft2 if inverse else self._fft.fft2
+        b = func(a, axes=(-2, -1), norm='ortho', workers=fft_threads(self.workers), overwrite_x=True)
+        return np.fft.ifftshift(b, axes=(-2, -1))
+
+
+class PyFFTW(NumpyFFT):
+    """FFT backend using cached pyFFTW plans.
+
+    Plans are created once per (shape, dtype, direction) and calling thread and reused by every later call with
+    the same arguments, so that the threads of a frame-parallel executor never share the buffers of a plan.
+    Accumulated FFTW wisdom is loaded from and written back to wisdom_file, so that later runs start with warm
+    plans.
+
+    Args:
+        threads: number of FFTW threads (defaults to all cores, 1 inside the workers of a frame-parallel executor).
+        planner_effort: FFTW planner flag.
+        wisdom_file: path to file storing FFTW wisdom.
+    """
+    name = 'pyfftw'
+
+    def __init__(self, threads=None, planner_effort='FFTW_MEASURE', wisdom_file=None):
+        import pyfftw
+        self._pyfftw = pyfftw
+        self.threads = os.cpu_count() if threads is None else threads
+        self.planner_effort = planner_effort
+        self.wisdom_file = wisdom_file
+        self._plans = {}
+        self._lock = threading.Lock()
+        if wisdom_file is not None and os.path.exists(wisdom_file):
+            with open(wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+
+    def _plan(self, shape, dtype, inverse):
+        threads = fft_threads(self.threads)
+        key = (shape, np.dtype(dtype).str, inverse, threading.get_ident(), threads)
+        if key not in self._plans:
+            # the FFTW planner is not thread-safe
+            with self._lock:
+                arr = self._pyfftw.empty_aligned(shape, dtype=dtype)
+                builder = self._pyfftw.builders.ifft2 if inverse else self._pyfftw.builders.fft2
+                self._plans[key] = builder(arr, axes=(-2, -1), norm='ortho', threads=threads,
+                                           planner_effort=self.planner_effort, avoid_copy=False)
+                self.save_wisdom()
+        return self._plans[key]
+
+    def _transform(self, input_array, inverse):
+        plan = self._plan(input_array.shape, complex_dtype(input_array), inverse)
+        plan.input_array[...] = np.fft.fftshift(input_array, axes=(-2, -1))
+        return np.fft.ifftshift(plan(), axes=(-2, -1))
+
+    def save_wisdom(self):
+        """Write accumulated FFTW wisdom to wisdom_file (atomically)."""
+        if self.wisdom_file is None:
+            return
+        tmp_file = self.wisdom_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self._pyfftw.export_wisdom(), f)
+        os.replace(tmp_file, self.wisdom_file)
+
+
+_backend_classes = {'default': FFTBackend, 'numpy': NumpyFFT, 'scipy': ScipyFFT, 'pyfftw': PyFFTW}
+_backends = {}
+
+
+def get_fft_backend(fft_backend=None, **kwargs):
+    """Resolve an FFT backend.
+
+    Backends requested by name are created once and shared, so that their plans are reused across calls.
+
+    Args:
+        fft_backend: None, backend name ('default', 'numpy', 'scipy' or 'pyfftw') or FFTBackend instance.
+        **kwargs: keyword arguments passed to the backend constructor.
+
+    Returns:
+        FFTBackend instance.
+    """
+    if isinstance(fft_backend, FFTBackend):
+        return fft_backend
+    name = 'default' if fft_backend is None else fft_backend
+    if name not in _backend_classes:
+        raise ValueError('Unknown FFT backend: {}'.format(name))
+    key = (name, tuple(sorted(kwargs.items())))
+    if key not in _backends:
+        _backends[key] = _backend_classes[name](**kwargs)
+
+    return _backends[key]
@@ -0,0 +1,148 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import h5py
+from paper_TCI2023.ptycho_pmace.pmace.utils import load_measurement
+
+
+'''
+This file defines a chunked measurement store replacing the directory of per-frame TIFF files. A store is
+either an HDF5 file ('.h5', chunked and optionally compressed) or a directory of '.npy' files that is opened
+as a memory map.
+'''
+
+
+def read_translations(fname):
+    """Read the scan translations (FCx, FCy) from a delimited text file.
+
+    The file is parsed as tab-separated with the C parser first, and only falls back to delimiter sniffing
+    with the slow python parser if the expected columns are not found.
+
+    Args:
+        fname: path to translations file.
+
+    Returns:
+        array of scan translations.
+    """
+    scan_loc_file = pd.read_csv(fname, sep='\t', header=0)
+    if not {'FCx', 'FCy'}.issubset(scan_loc_file.columns):
+        scan_loc_file = pd.read_csv(fname, sep=None, engine='python', header=0)
+
+    return scan_loc_file[['FCx', 'FCy']].to_numpy()
+
+
+def convert_measurement(data_dir, store_path, chunk_frames=64, compression=None, meta=None):
+    """Convert a directory of frame data and scan translations to a measurement store.
+
+    Args:
+        data_dir: directory containing 'frame_data/' and 'Translations.tsv.txt'.
+        store_path: path to the store ('.h5' for HDF5, otherwise a directory of '.npy' files).
+        chunk_frames: number of frames per HDF5 chunk.
+        compression: HDF5 compression filter (e.g. 'gzip' or 'lzf'), ignored for '.npy' stores.
+        meta: optional dictionary of preprocessing metadata saved with the store.
+    """
+    frames = load_measurement(data_dir + 'frame_data/')
+    translations = read_translations(data_dir + 'Translations.tsv.txt')
+    meta = dict(meta or {}, source=os.path.abspath(data_dir))
+
+    if store_path.endswith('.h5'):
+        tmp_path = store_path + '.tmp'
+        with h5py.File(tmp_path, 'w') as f:
+            f.create_dataset('frames', data=frames, chunks=(min(chunk_frames, len(frames)),) + frames.shape[1:],
+                             compression=compression)
+            f.create_dataset('translations', data=translations)
+            f.attrs['meta'] = json.dumps(meta)
+        os.replace(tmp_path, store_path)
+    else:
+        os.makedirs(store_path, exist_ok=True)
+        np.save(os.path.join(store_path, 'frames.npy'), frames)
+        np.save(os.path.join(store_path, 'translations.npy'), translations)
+        with open(os.path.join(store_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class MeasurementStore:
+    """Lazily preprocessed view of a measurement store.
+
+    Frames are read from disk (memory map or HDF5 dataset) only when accessed, and the optional window is
+    applied per access, so no full-size preprocessed copy is made until read() is called.
+
+    Args:
+        frames: memory-mapped array or HDF5 dataset of frames.
+        translations: scan translations.
+        meta: preprocessing metadata.
+        window: optional window multiplied with every frame.
+        h5_file: open HDF5 file (closed by close()).
+    """
+
+    def __init__(self, frames, translations, meta, window=None, h5_file=None):
+        self.frames = frames
+        self.translations = translations
+        self.meta = meta
+        self.window = window
+        self._h5_file = h5_file
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, idx):
+        output = np.asarray(self.frames[idx])
+        if self.window is not None:
+            output = output * self.window
+
+        return output
+
+    def iter_chunks(self, chunk_frames=64):
+        """Iterate over (start index, preprocessed frames) chunks."""
+        for start in range(0, len(self), chunk_frames):
+            yield start, self[start:start + chunk_frames]
+
+    def read(self, dtype=np.float32, chunk_frames=64):
+        """Read all preprocessed frames into a single array, chunk by chunk.
+
+        Args:
+            dtype: data type of the output array.
+            chunk_frames: number of frames processed at once.
+
+        Returns:
+            array of preprocessed frames.
+        """
+        output = np.empty(self.shape, dtype=dtype)
+        for start, chunk in self.iter_chunks(chunk_frames):
+            output[start:start + len(chunk)] = chunk
+
+        return output
+
+    def __array__(self, dtype=None):
+        return self.read() if dtype is None else self.read(dtype=dtype)
+
+    def close(self):
+        if self._h5_file is not None:
+            self._h5_file.close()
+
+
+def open_measurement(store_path, window=None):
+    """Open a measurement store created by convert_measurement.
+
+    Args:
+        store_path: path to the store.
+        window: optional window applied lazily to every frame (e.g. a Tukey window).
+
+    Returns:
+        MeasurementStore instance.
+    """
+    if store_path.endswith('.h5'):
+        f = h5py.File(store_path, 'r')
+        return MeasurementStore(f['frames'], f['translations'][()], json.loads(f.attrs['meta']), window, h5_file=f)
+
+    frames = np.load(os.path.join(store_path, 'frames.npy'), mmap_mode='r')
+    translations = np.load(os.path.join(store_path, 'translations.npy'))
+    with open(os.path.join(store_path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+
+    return MeasurementStore(frames, translations, meta, window)
@@ -0,0 +1,107 @@
+import numpy as np
+from paper_TCI2023.ptycho_pmace.pmace.nrmse import compute_nrmse
+from paper_TCI2023.ptycho.precision import complex_dtype
+
+
+class MetricsPolicy:
+    """Policy deciding when and on which frames convergence metrics are evaluated.
+
+    The last iteration is always evaluated, since it provides the phase-normalized reconstruction returned
+    by the engines.
+
+    Args:
+        every: evaluate metrics every k iterations (0 evaluates only the last iteration).
+        frame_frac: fraction of frames used for the NRMSE in measurement domain (None uses all frames).
+        lagged_meas: let WF reuse the FFT of its gradient step for the NRMSE in measurement domain. The error
+            then belongs to the point where the gradient was evaluated, i.e. it lags by one iteration.
+        seed: random seed for selecting the frame subset.
+    """
+
+    def __init__(self, every=1, frame_frac=None, lagged_meas=False, seed=0):
+        self.every = every
+        self.frame_frac = frame_frac
+        self.lagged_meas = lagged_meas
+        self.seed = seed
+        self._frames = {}
+
+    def due(self, i, num_iter):
+        """Check whether metrics are evaluated at (zero-based) iteration i."""
+        return (i == num_iter - 1) or (self.every > 0 and (i + 1) % self.every == 0)
+
+    def frames(self, num_frames):
+        """Return sorted indices of the frames used for the measurement NRMSE, or None for all frames."""
+        if self.frame_frac is None or self.frame_frac >= 1:
+            return None
+        if num_frames not in self._frames:
+            rng = np.random.default_rng(self.seed)
+            num_selected = max(1, int(round(self.frame_frac * num_frames)))
+            self._frames[num_frames] = np.sort(rng.choice(num_frames, num_selected, replace=False))
+
+        return self._frames[num_frames]
+
+
+def get_metrics_policy(metrics=None):
+    """Resolve a metrics policy.
+
+    Args:
+        metrics: None (every iteration), int k (every k iterations), 'final' (last iteration only)
+            or MetricsPolicy instance.
+
+    Returns:
+        MetricsPolicy instance.
+    """
+    if isinstance(metrics, MetricsPolicy):
+        return metrics
+    if metrics is None:
+        return MetricsPolicy()
+    if metrics == 'final':
+        return MetricsPolicy(every=0)
+
+    return MetricsPolicy(every=int(metrics))
+
+
+def meas_nrmse(est_obj, est_probe, y_meas, patch_op, fft, frames=None, chunk_frames=64):
+    """Calculate NRMSE in measurement domain.
+
+    The frames are simulated in chunks, so that no full stack of frame data is allocated.
+
+    Args:
+        est_obj: estimate of complex object.
+        est_probe: estimate of complex probe or stack of probes of all frames.
+        y_meas: pre-processed measurements.
+        patch_op: PatchOperator of the scan geometry.
+        fft: FFT backend.
+        frames: optional indices of the frames to compare.
+        chunk_frames: number of frames simulated at once.
+
+    Returns:
+        NRMSE between the simulated and the recorded measurements.
+    """
+    frames = np.arange(len(y_meas)) if frames is None else np.asarray(frames)
+    err, ref = 0.0, 0.0
+    for start in range(0, len(frames), chunk_frames):
+        chunk = frames[start:start + chunk_frames]
+        probe = est_probe[chunk] if np.ndim(est_probe) == 3 else est_probe
+        est_patch = patch_op.img2patch(est_obj, frames=chunk).astype(complex_dtype(est_obj), copy=False)
+        err += np.sum((np.abs(fft.ft(probe * est_patch)) - y_meas[chunk]) ** 2, dtype=np.float64)
+        ref += np.sum(y_meas[chunk] ** 2, dtype=np.float64)
+
+    # accumulated in double precision, returned in the precision of the measurements
+    return y_meas.dtype.type(np.sqrt(err / ref))
+
+
+def ft_nrmse(est_ft, y_meas, frames=None):
+    """Calculate NRMSE in measurement domain from an already computed Fourier transform.
+
+    Args:
+        est_ft: Fourier transform of the estimated frame data.
+        y_meas: pre-processed measurements with the same shape as est_ft.
+        frames: optional indices of the frames to compare.
+
+    Returns:
+        NRMSE between the simulated and the recorded measurements.
+    """
+    if frames is not None:
+        est_ft, y_meas = est_ft[frames], y_meas[frames]
+
+    return compute_nrmse(np.abs(est_ft), y_meas)
@@ -0,0 +1,164 @@
+import os
+import numpy as np
+from scipy import ndimage
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.precision import complex_dtype
+
+
+'''
+This file defines the coarse-to-fine (multi-resolution) reconstruction. At a level with scale factor s the
+diffraction patterns are cropped to their central 1/s part in Fourier domain, which corresponds to real-space
+frames with s times larger pixels. The object and probe estimated at a level initialize the next finer level.
+'''
+
+
+def crop_or_pad_center(arr, shape):
+    """Crop or zero-pad the last two axes of an array around the center (index n // 2).
+
+    Args:
+        arr: input array.
+        shape: output shape of the last two axes.
+
+    Returns:
+        cropped or padded array.
+    """
+    output = np.zeros(arr.shape[:-2] + tuple(shape), dtype=arr.dtype)
+    src, dst = [], []
+    for n_in, n_out in zip(arr.shape[-2:], shape):
+        n = min(n_in, n_out)
+        src.append(slice(n_in // 2 - n // 2, n_in // 2 - n // 2 + n))
+        dst.append(slice(n_out // 2 - n // 2, n_out // 2 - n // 2 + n))
+    output[(Ellipsis,) + tuple(dst)] = arr[(Ellipsis,) + tuple(src)]
+
+    return output
+
+
+def fourier_resample(img, shape):
+    """Resample a complex image (e.g. the probe) to a new grid covering the same field of view.
+
+    The spectrum is cropped or zero-padded, and the result is scaled such that the sample values are preserved.
+
+    Args:
+        img: complex image.
+        shape: output shape.
+
+    Returns:
+        resampled complex image.
+    """
+    scale = np.sqrt(np.prod(shape) / np.prod(img.shape[-2:]))
+
+    fft = get_fft_backend()
+
+    return (scale * fft.ift(crop_or_pad_center(fft.ft(img), shape))).astype(complex_dtype(img))
+
+
+def resize_object(obj, shape, ratio, order=1):
+    """Resample a complex object to a new grid by spline interpolation of its real and imaginary parts.
+
+    Pixel j of the output corresponds to pixel j * ratio of the input, matching the frame sampling of Fourier
+    cropping.
+
+    Args:
+        obj: complex object.
+        shape: output shape.
+        ratio: output pixel size divided by input pixel size.
+        order: order of the spline interpolation.
+
+    Returns:
+        resampled complex object.
+    """
+    coords = np.meshgrid(*[np.arange(n) * ratio for n in shape], indexing='ij')
+    output = ndimage.map_coordinates(np.real(obj), coords, order=order, mode='nearest') + \
+        1j * ndimage.map_coordinates(np.imag(obj), coords, order=order, mode='nearest')
+
+    return output.astype(complex_dtype(obj))
+
+
+def downsample_data(y_meas, patch_bounds, img_shape, scale):
+    """Downsample the measurements and the scan geometry by Fourier cropping.
+
+    Args:
+        y_meas: pre-processed measurements.
+        patch_bounds: scan coordinates of projections.
+        img_shape: shape of the full-resolution object.
+        scale: integer scale factor dividing the frame size.
+
+    Returns:
+        cropped measurements, scan coordinates and object shape at the coarse level.
+    """
+    frm_sz = y_meas.shape[-1]
+    if frm_sz % scale != 0:
+        raise ValueError('Frame size {} is not divisible by the scale factor {}.'.format(frm_sz, scale))
+    crop_sz = frm_sz // scale
+
+    # amplitudes are scaled to keep the orthonormal FT consistent with the downsampled frames
+    y_coarse = crop_or_pad_center(y_meas, (crop_sz, crop_sz)) / scale
+    starts = np.round(patch_bounds[:, [0, 2]] / scale).astype(int)
+    coords = np.stack([starts[:, 0], starts[:, 0] + crop_sz, starts[:, 1], starts[:, 1] + crop_sz], axis=1)
+    shape = tuple(max(int(np.ceil(n / scale)), int(np.amax(coords[:, k]))) for n, k in zip(img_shape, [1, 3]))
+
+    return y_coarse.astype(y_meas.dtype), coords, shape
+
+
+def multires_recon(y_meas, patch_bounds, init_obj, recon_func, scales=(4, 2, 1), level_iters=None,
+                   num_iter=100, init_probe=None, ref_obj=None, ref_probe=None, joint_recon=False, recon_win=None,
+                   save_dir=None, **kwargs):
+    """Coarse-to-fine reconstruction.
+
+    Function to run a reconstruction engine on a pyramid of Fourier-cropped measurements, where the estimates of
+    every level initialize the next finer level.
+
+    Args:
+        y_meas: pre-processed measurements.
+        patch_bounds: scan coordinates of projections.
+        init_obj: formulated initial guess of complex object.
+        recon_func: reconstruction engine, e.g. pie.epie_recon, wf.wf_recon or sharp.sharp_recon.
+        scales: scale factors of the levels from coarse to fine (the last level should be 1).
+        level_iters: number of iterations per level (defaults to num_iter split evenly across the levels).
+        num_iter: total number of iterations if level_iters is not given.
+        init_probe: formulated initial guess of complex probe.
+        ref_obj: complex reference image for object (used at the finest level).
+        ref_probe: complex reference image for probe.
+        joint_recon: option to estimate complex probe for blind ptychography.
+        recon_win: pre-defined window for showing and comparing reconstruction results (finest level).
+        save_dir: directory to save reconstruction results (one sub-directory per coarse level).
+        **kwargs: further keyword arguments of recon_func.
+
+    Returns:
+        result dictionary of the finest level, with the per-level iteration counts in 'level_iters'.
+    """
+    if level_iters is None:
+        level_iters = [num_iter // len(scales)] * (len(scales) - 1) + [num_iter - num_iter // len(scales) * (len(scales) - 1)]
+    img_shape = init_obj.shape
+    est_obj, est_probe, prev_scale = init_obj, init_probe if joint_recon else ref_probe, 1
+
+    for level, (scale, n_iter) in enumerate(zip(scales, level_iters)):
+        finest = level == len(scales) - 1
+        if scale == 1:
+            y_level, coords, shape = y_meas, patch_bounds, img_shape
+        else:
+            y_level, coords, shape = downsample_data(y_meas, patch_bounds, img_shape, scale)
+        frm_shape = y_level.shape[-2:]
+
+        # initialize the level from the previous estimates (the known probe is resampled from full resolution)
+        obj_level = resize_object(est_obj, shape, scale / prev_scale) if est_obj.shape != shape else est_obj
+        probe_src = est_probe if joint_recon else ref_probe
+        probe_level = fourier_resample(probe_src, frm_shape) if probe_src.shape != frm_shape else probe_src
+
+        # reference images are only compared at the finest level, so that intermediate results are not phase-normalized
+        level_args = dict(init_probe=probe_level, ref_probe=probe_level, joint_recon=joint_recon)
+        if finest:
+            level_args.update(ref_obj=ref_obj, recon_win=recon_win, save_dir=save_dir)
+            if joint_recon:
+                level_args.update(ref_probe=ref_probe)
+        else:
+            level_args.update(save_dir=os.path.join(save_dir, 'level_{}/'.format(scale)) if save_dir is not None else None)
+            if joint_recon:
+                level_args.update(ref_probe=None)
+        print('Level {}/{}: scale {}, frames {}, object {}.'.format(level + 1, len(scales), scale, frm_shape, shape))
+        output = recon_func(y_level, coords, obj_level, num_iter=n_iter, **level_args, **kwargs)
+        est_obj, est_probe, prev_scale = output['object'], output['probe'], scale
+
+    output['level_iters'] = list(level_iters)
+
+    return output
@@ -0,0 +1,182 @@
+import os
+import queue
+import threading
+import numpy as np
+from paper_TCI2023.ptycho_pmace.pmace.utils import *
+
+
+'''
+This file defines the iteration observers of the reconstruction engines. An observer is notified after every
+iteration with the current estimates and may request the reconstruction to stop. The snapshot writer saves
+object and probe snapshots in a background thread, so that the solver loop does not wait for the disk.
+'''
+
+
+class Observer:
+    """Iteration observer (the base class observes nothing)."""
+
+    def start(self, approach):
+        """Called before the first iteration of a reconstruction.
+
+        Args:
+            approach: name of the reconstruction approach.
+        """
+        pass
+
+    def update(self, iteration, est_obj, est_probe):
+        """Called after every iteration.
+
+        The arrays are the live estimates of the engine, which may be modified in place by later iterations.
+
+        Args:
+            iteration: number of completed iterations.
+            est_obj: current estimate of complex object.
+            est_probe: current estimate of complex probe.
+
+        Returns:
+            True to stop the reconstruction.
+        """
+        return False
+
+    def finish(self):
+        """Called after the last iteration of a reconstruction."""
+        pass
+
+
+class CallbackObserver(Observer):
+    """Observer calling a function callback(iteration, est_obj, est_probe) after every iteration."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def update(self, iteration, est_obj, est_probe):
+        return bool(self.callback(iteration, est_obj, est_probe))
+
+
+class ObserverList(Observer):
+    """Observer notifying several observers (the reconstruction stops if any of them requests it)."""
+
+    def __init__(self, observers):
+        self.observers = observers
+
+    def start(self, approach):
+        for observer in self.observers:
+            observer.start(approach)
+
+    def update(self, iteration, est_obj, est_probe):
+        return any([observer.update(iteration, est_obj, est_probe) for observer in self.observers])
+
+    def finish(self):
+        for observer in self.observers:
+            observer.finish()
+
+
+class SnapshotWriter(Observer):
+    """Observer saving object and probe snapshots every k iterations in a background thread.
+
+    The estimates are copied into a bounded queue. If the writer falls behind, the oldest queued snapshot is
+    dropped in favor of the new one, so the solver loop never waits for the disk. The thread is started by
+    start(), so a writer can be passed to worker processes before the reconstruction starts. If writing a
+    snapshot fails (e.g. on a full disk), later snapshots are skipped and the error is reported by finish() and
+    kept in the attribute error.
+
+    Args:
+        save_dir: directory to save the snapshots.
+        every: save a snapshot every k iterations.
+        maxsize: maximum number of queued snapshots.
+        save_probe: option to also save the probe.
+    """
+
+    def __init__(self, save_dir, every=10, maxsize=2, save_probe=True):
+        self.save_dir = save_dir
+        self.every = every
+        self.maxsize = maxsize
+        self.save_probe = save_probe
+        self.approach = None
+        self.num_dropped = 0
+        self.error = None
+        self._queue = None
+        self._thread = None
+
+    def start(self, approach):
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.approach = approach
+        self.num_dropped = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=self.maxsize)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def update(self, iteration, est_obj, est_probe):
+        if iteration % self.every != 0 or self.error is not None or not self._thread.is_alive():
+            return False
+        item = (iteration, np.copy(est_obj), np.copy(est_probe) if self.save_probe else None)
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                break
+            except queue.Full:
+                # drop the stale snapshot at the head of the queue
+                try:
+                    self._queue.get_nowait()
+                    self.num_dropped += 1
+                except queue.Empty:
+                    pass
+
+        return False
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # drain the queue after a failure
+                continue
+            iteration, est_obj, est_probe = item
+            try:
+                save_tiff(est_obj, os.path.join(self.save_dir, '{}_obj_iter_{}.tiff'.format(self.approach, iteration)))
+                if est_probe is not None:
+                    save_tiff(est_probe, os.path.join(self.save_dir, '{}_probe_iter_{}.tiff'.format(self.approach, iteration)))
+            except Exception as err:
+                self.error = err
+
+    def finish(self):
+        """Write the queued snapshots, stop the background thread and report a failure of the writer."""
+        if self._thread is None:
+            return
+        # never wait on a full queue that a dead thread no longer drains
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        self._thread = None
+        if self.num_dropped > 0:
+            print('{} snapshots of {} dropped under backpressure.'.format(self.num_dropped, self.approach))
+        if self.error is not None:
+            print('Writing snapshots of {} to {} failed: {!r}'.format(self.approach, self.save_dir, self.error))
+
+
+def get_observer(callback=None):
+    """Resolve the iteration observer of a reconstruction.
+
+    Args:
+        callback: None, function callback(iteration, est_obj, est_probe) returning True to stop, Observer instance,
+            or list of these.
+
+    Returns:
+        Observer instance.
+    """
+    if callback is None:
+        return Observer()
+    if isinstance(callback, Observer):
+        return callback
+    if isinstance(callback, (list, tuple)):
+        return ObserverList([get_observer(item) for item in callback])
+    if callable(callback):
+        return CallbackObserver(callback)
+
+    raise ValueError('Invalid callback: {}'.format(callback))
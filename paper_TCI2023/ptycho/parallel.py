@@ -0,0 +1,126 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+'''
+This file defines the frame-parallel executor of the per-frame work in the reconstruction engines (FFT, magnitude
+replacement, IFFT and probe multiplication). The frame stack is split into chunks that fit in the cache, and the
+chunks are processed by a thread pool. NumPy and the FFT libraries release the GIL in these operations, so the
+threads run on separate cores without copying the frames to other processes. Multithreaded FFT backends use one
+thread per transform inside the workers (see fft_threads), so that the cores are not oversubscribed.
+'''
+
+
+# number of frame-sized buffers touched per frame by the per-frame work (input, spectrum, magnitudes and output)
+BUFFERS_PER_FRAME = 4
+
+# marks the threads of a FrameExecutor while they process a chunk
+_worker = threading.local()
+
+
+def fft_threads(threads):
+    """Number of threads of one FFT, which is 1 inside the workers of a FrameExecutor.
+
+    Args:
+        threads: number of threads of an FFT outside the workers.
+
+    Returns:
+        number of threads to use in the calling thread.
+    """
+    return 1 if getattr(_worker, 'active', False) else threads
+
+
+def _run_in_worker(func, chunk):
+    _worker.active = True
+    try:
+        func(chunk)
+    finally:
+        _worker.active = False
+
+
+class FrameExecutor:
+    """Run per-frame work on chunks of frames.
+
+    Args:
+        num_workers: number of threads (defaults to all cores, 1 processes the chunks in the calling thread).
+        chunk_frames: number of frames per chunk (None derives it from cache_bytes).
+        cache_bytes: cache size the buffers of one chunk should fit in.
+    """
+
+    def __init__(self, num_workers=None, chunk_frames=None, cache_bytes=2 ** 21):
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.chunk_frames = chunk_frames
+        self.cache_bytes = cache_bytes
+        self._pool = ThreadPoolExecutor(max_workers=self.num_workers) if self.num_workers > 1 else None
+
+    def chunks(self, num_frames, frame_nbytes):
+        """Split num_frames frames of frame_nbytes bytes into chunks.
+
+        Returns:
+            list of slices of the frame stack.
+        """
+        chunk_frames = self.chunk_frames
+        if chunk_frames is None:
+            chunk_frames = max(1, self.cache_bytes // (BUFFERS_PER_FRAME * frame_nbytes))
+
+        return [slice(start, min(start + chunk_frames, num_frames)) for start in range(0, num_frames, chunk_frames)]
+
+    def run(self, func, num_frames, frame_nbytes):
+        """Call func(chunk) for every chunk of the frame stack, where chunk is a slice of the frame stack.
+
+        Args:
+            func: function processing the frames in one chunk (writing its results in place).
+            num_frames: number of frames.
+            frame_nbytes: size of one complex frame in bytes.
+        """
+        chunks = self.chunks(num_frames, frame_nbytes)
+        if self._pool is None or len(chunks) == 1:
+            for chunk in chunks:
+                func(chunk)
+        else:
+            # list() re-raises exceptions of the workers
+            list(self._pool.map(_run_in_worker, [func] * len(chunks), chunks))
+
+
+class SerialExecutor(FrameExecutor):
+    """Process the whole frame stack in one call (no chunking)."""
+
+    def __init__(self):
+        self.num_workers = 1
+        self.chunk_frames = None
+        self._pool = None
+
+    def chunks(self, num_frames, frame_nbytes):
+        return [slice(0, num_frames)]
+
+
+_serial_executor = SerialExecutor()
+_executors = {}
+
+
+def get_frame_executor(parallel=None):
+    """Resolve a frame executor.
+
+    Executors are created once per setting and shared, so that their threads are reused across calls.
+
+    Args:
+        parallel: None (no chunking), number of threads, dictionary of keyword arguments of FrameExecutor, or
+            FrameExecutor instance.
+
+    Returns:
+        FrameExecutor instance.
+    """
+    if isinstance(parallel, FrameExecutor):
+        return parallel
+    if parallel is None:
+        return _serial_executor
+    if isinstance(parallel, dict):
+        kwargs = parallel
+    else:
+        kwargs = dict(num_workers=int(parallel))
+    key = tuple(sorted(kwargs.items()))
+    if key not in _executors:
+        _executors[key] = FrameExecutor(**kwargs)
+
+    return _executors[key]
@@ -0,0 +1,157 @@
+import numpy as np
+from scipy import signal
+from paper_TCI2023.ptycho_pmace.pmace.utils import divide_cmplx_numbers
+from paper_TCI2023.ptycho.precision import complex_dtype
+
+
+class PatchOperator:
+    """Projection operator between a full-size image and a stack of patches.
+
+    The flat pixel indices of all patches are computed once from patch_bounds (as int32 unless the image is too
+    large). Patches are gathered with np.take and scattered back with np.bincount on the real and imaginary
+    parts, so that neither direction loops over patches in Python and only the index table is stored. The
+    methods match img2patch and patch2img from the pmace utilities.
+
+    Args:
+        patch_bounds: scan coordinates of projections.
+        img_shape: shape of full-size image.
+        patch_shape: shape of the patch stack (number of patches, patch height, patch width).
+    """
+
+    def __init__(self, patch_bounds, img_shape, patch_shape):
+        self.patch_bounds = np.array(patch_bounds)
+        self.img_shape = tuple(img_shape)
+        self.patch_shape = tuple(patch_shape)
+
+        # flat index of every patch pixel in the full-size image
+        self.index = self._patch_index(self.patch_bounds[:, [0, 2]]).ravel()
+
+        # number of patches starting at / covering each pixel
+        self.scan_map = np.zeros(self.img_shape)
+        np.add.at(self.scan_map, (self.patch_bounds[:, 0], self.patch_bounds[:, 2]), 1)
+        self.coverage = np.bincount(self.index, minlength=self.img_shape[0] * self.img_shape[1]).reshape(self.img_shape)
+        self._illum_cache = None
+
+    def _patch_index(self, corners):
+        """Flat indices in the full-size image of the pixels of patches with the given upper-left corners."""
+        patch_h, patch_w = self.patch_shape[1:]
+        rows = corners[:, 0][:, None, None] + np.arange(patch_h)[None, :, None]
+        cols = corners[:, 1][:, None, None] + np.arange(patch_w)[None, None, :]
+        index_dtype = np.int32 if self.img_shape[0] * self.img_shape[1] < 2 ** 31 else np.int64
+
+        return (rows * self.img_shape[1] + cols).astype(index_dtype).reshape(len(corners), -1)
+
+    def move_patches(self, frames, corners):
+        """Move patches to new upper-left corners in place.
+
+        Only the rows of the moved patches are rewritten in the index table, and their old and new pixels
+        are subtracted from and added to the scan position map and the coverage. The cached illumination
+        weight is dropped.
+
+        Args:
+            frames: indices of the moved patches.
+            corners: array of new (row, column) upper-left corners, one per moved patch.
+        """
+        frames = np.asarray(frames)
+        corners = np.asarray(corners)
+        num_pixels = self.img_shape[0] * self.img_shape[1]
+        index = self.index.reshape(self.patch_shape[0], -1)
+        old_index = index[frames]
+        new_index = self._patch_index(corners)
+        index[frames] = new_index
+        self.coverage -= np.bincount(old_index.ravel(), minlength=num_pixels).reshape(self.img_shape)
+        self.coverage += np.bincount(new_index.ravel(), minlength=num_pixels).reshape(self.img_shape)
+        np.subtract.at(self.scan_map, (self.patch_bounds[frames, 0], self.patch_bounds[frames, 2]), 1)
+        np.add.at(self.scan_map, (corners[:, 0], corners[:, 1]), 1)
+        self.patch_bounds[frames] = np.stack([corners[:, 0], corners[:, 0] + self.patch_shape[1],
+                                              corners[:, 1], corners[:, 1] + self.patch_shape[2]], axis=1)
+        self._illum_cache = None
+
+    def img2patch(self, full_img, out=None, frames=None):
+        """Extract patches from the full-size image.
+
+        Args:
+            full_img: full-size image.
+            out: optional pre-allocated array to store the patches.
+            frames: optional indices of the patches to extract (all patches by default).
+
+        Returns:
+            stack of patches.
+        """
+        if frames is None:
+            index, patch_shape = self.index, self.patch_shape
+        else:
+            index = self.index.reshape(self.patch_shape[0], -1)[frames].ravel()
+            patch_shape = (len(frames),) + self.patch_shape[1:]
+        if out is None:
+            return np.take(full_img, index).reshape(patch_shape)
+        # mode='clip' avoids the buffering of out (the indices are valid)
+        np.take(full_img, index, out=out.reshape(-1), mode='clip')
+
+        return out
+
+    def patch2img(self, img_patch, patch_weight=None, chunk_frames=64):
+        """Sum patches into the full-size image and normalize by patch_weight.
+
+        Args:
+            img_patch: stack of patches.
+            patch_weight: optional weight to normalize the full-size image.
+            chunk_frames: number of patches summed at once (bounding the temporary copies of their parts).
+
+        Returns:
+            full-size image.
+        """
+        num_pixels = self.img_shape[0] * self.img_shape[1]
+        chunk_size = chunk_frames * self.patch_shape[1] * self.patch_shape[2]
+        flat_patch = np.ravel(img_patch)
+        parts = [np.real] + ([np.imag] if np.iscomplexobj(img_patch) else [])
+        sums = [np.zeros(num_pixels) for _ in parts]
+        for start in range(0, flat_patch.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            for part, part_sum in zip(parts, sums):
+                part_sum += np.bincount(self.index[chunk], weights=part(flat_patch[chunk]), minlength=num_pixels)
+        full_img = np.empty(self.img_shape, dtype=complex_dtype(img_patch))
+        full_img.real = sums[0].reshape(self.img_shape)
+        full_img.imag = sums[1].reshape(self.img_shape) if len(sums) > 1 else 0
+        if patch_weight is None:
+            return full_img
+
+        return divide_cmplx_numbers(full_img, patch_weight)
+
+    def illumination_weight(self, probe):
+        """Compute the image weight sum_j |probe|^2 placed at every scan position.
+
+        The weight is the convolution of the scan position map with |probe|^2, computed with one FFT
+        convolution instead of scattering a replicated probe stack. The result of the last call is cached
+        and reused while the probe is unchanged. A stack of per-frame probes (e.g. shifted by subpixel scan
+        positions) is summed with patch2img instead.
+
+        Args:
+            probe: complex probe or stack of probes of all frames.
+
+        Returns:
+            full-size image weight, equal to patch2img(np.abs([probe] * num_patches) ** 2).
+        """
+        dtype = complex_dtype(probe)
+        if np.ndim(probe) == 3:
+            return self.patch2img(np.abs(probe) ** 2).astype(dtype, copy=False)
+
+        probe_int = np.abs(probe).astype(np.float64) ** 2
+        if self._illum_cache is not None and self._illum_cache[1].dtype == dtype and np.array_equal(probe_int, self._illum_cache[0]):
+            return self._illum_cache[1]
+
+        img_wgt = signal.fftconvolve(self.scan_map, probe_int)[:self.img_shape[0], :self.img_shape[1]]
+        # remove round-off error outside the illuminated area
+        img_wgt[(self.coverage == 0) | (img_wgt < 1e-12 * np.amax(img_wgt))] = 0
+        img_wgt = img_wgt.astype(dtype)
+        self._illum_cache = (probe_int, img_wgt)
+
+        return img_wgt
+
+
+def get_patch_operator(patch_bounds, img_shape, patch_shape):
+    """Return patch_bounds if it is already a PatchOperator, otherwise build one."""
+    if isinstance(patch_bounds, PatchOperator):
+        return patch_bounds
+
+    return PatchOperator(patch_bounds, img_shape, patch_shape)
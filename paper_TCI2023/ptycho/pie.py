@@ -1,20 +1,148 @@
 import time
+import random
 from random import shuffle
 from tqdm import tqdm
 from paper_TCI2023.ptycho_pmace.pmace.utils import *
 from paper_TCI2023.ptycho_pmace.pmace.nrmse import *
+from paper_TCI2023.ptycho.checkpoint import save_checkpoint, load_checkpoint, HISTORY_KEYS
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.metrics import get_metrics_policy, meas_nrmse
+from paper_TCI2023.ptycho.observers import get_observer
+from paper_TCI2023.ptycho.patch_ops import get_patch_operator
+from paper_TCI2023.ptycho.positions import get_position_refiner, shift_probe
+from paper_TCI2023.ptycho.precision import get_precision
+from paper_TCI2023.ptycho.projection import replace_magnitude
+from paper_TCI2023.ptycho.stopping import get_stopping_criterion
+from paper_TCI2023.ptycho.telemetry import get_telemetry
+
+
+def find_overlaps(patch_bounds):
+    """Patch overlap graph.
+
+    Function to find, for every scan position, the other scan positions whose patches overlap with it.
+
+    Args:
+        patch_bounds: scan coordinates of projections.
+
+    Returns:
+        list of arrays containing the indices of overlapping scan positions.
+    """
+    neighbors = []
+    for j in range(len(patch_bounds)):
+        crd0, crd1, crd2, crd3 = patch_bounds[j]
+        overlap = (crd0 < patch_bounds[:, 1]) & (crd1 > patch_bounds[:, 0]) & (crd2 < patch_bounds[:, 3]) & (crd3 > patch_bounds[:, 2])
+        overlap[j] = False
+        neighbors.append(np.nonzero(overlap)[0])
+
+    return neighbors
+
+
+def color_batches(neighbors, batch_size):
+    """Scan position coloring.
+
+    Function to group scan positions into mini-batches of mutually non-overlapping patches. Positions are
+    assigned greedily to the first batch that is not full and contains no overlapping patch. The batches only
+    depend on the overlap graph, so they are computed once and reused by every iteration.
+
+    Args:
+        neighbors: indices of overlapping scan positions, as returned by find_overlaps.
+        batch_size: maximum number of scan positions in one batch.
+
+    Returns:
+        batch index of every scan position.
+    """
+    batch_idx = np.full(len(neighbors), -1)
+    batch_cnt = np.zeros(len(neighbors), dtype=int)
+    num_batches = 0
+    for j in range(len(neighbors)):
+        # batches that are full or already contain an overlapping patch
+        available = batch_cnt[:num_batches + 1] < batch_size
+        nb_idx = batch_idx[neighbors[j]]
+        available[nb_idx[nb_idx >= 0]] = False
+        k = np.argmax(available)
+        batch_idx[j] = k
+        batch_cnt[k] += 1
+        num_batches = max(num_batches, k + 1)
+
+    return batch_idx
+
+
+def schedule_batches(seq, batch_idx=None):
+    """Scan position scheduler.
+
+    Function to order the mini-batches of one iteration. Batches are visited in the order of their first position
+    in seq, and the positions of every batch keep their order in seq, so that shuffling seq shuffles both the
+    batches and the positions within them without Python loops over the positions.
+
+    Args:
+        seq: (shuffled) order of scan positions.
+        batch_idx: batch index of every scan position, as returned by color_batches (None for single positions).
+
+    Returns:
+        list of arrays, each containing the indices of scan positions in one batch.
+    """
+    if batch_idx is None:
+        return [np.asarray([j]) for j in seq]
+
+    seq = np.asarray(seq)
+    seq_batch = batch_idx[seq]
+    # rank of every batch by its first position in seq
+    first = np.full(np.amax(batch_idx) + 1, len(seq))
+    np.minimum.at(first, seq_batch, np.arange(len(seq)))
+    rank = np.argsort(np.argsort(first))
+    order = np.argsort(rank[seq_batch], kind='stable')
+    counts = np.bincount(rank[seq_batch])
+
+    return np.split(seq[order], np.cumsum(counts)[:-1])
+
+
+def epie_update(est_obj, est_probe, index, y_frm, obj_step_sz, probe_step_sz, joint_recon, fft, frm_probe=None,
+                frm_shifts=None):
+    """Update the object and probe estimates in place from one frame or one batch of non-overlapping frames.
+
+    Args:
+        est_obj: estimate of complex object (updated in place).
+        est_probe: estimate of complex probe (updated in place if joint_recon).
+        index: index of the patch (slice) or patches (rows, cols) in est_obj.
+        y_frm: measurements of the frames.
+        obj_step_sz: step size of object update function.
+        probe_step_sz: step size of probe update function.
+        joint_recon: option to update the probe.
+        fft: FFT backend.
+        frm_probe: optional probes of the frames (e.g. shifted by subpixel scan positions), est_probe by default.
+            The probe update is applied to est_probe.
+        frm_shifts: optional subpixel (row, column) shifts of frm_probe against est_probe, one per frame. The
+            probe updates of the frames are shifted back by them before they are applied to est_probe.
+    """
+    probe = est_probe if frm_probe is None else frm_probe
+    projected_img = np.copy(est_obj[index])
+    frm = projected_img * probe
+    # take Fourier Transform
+    f = fft.ft(frm)
+    # revise estimate of frame data
+    delta_frm = fft.ift(replace_magnitude(f, y_frm.reshape(frm.shape), out=f)) - frm
+    # revise estimates of complex object
+    est_obj[index] += (obj_step_sz * np.conj(probe) * delta_frm / (np.amax(np.abs(probe)) ** 2)).reshape(projected_img.shape)
+    if joint_recon:
+        # average probe updates over the batch
+        probe_step = np.conj(projected_img) * delta_frm / (np.amax(np.abs(projected_img), axis=(-2, -1), keepdims=True) ** 2)
+        if frm_shifts is not None:
+            probe_step = shift_probe(probe_step.reshape((-1,) + est_probe.shape), -np.asarray(frm_shifts), fft)
+        est_probe += probe_step_sz * np.average(probe_step.reshape((-1,) + est_probe.shape), axis=0)
 
 
 def epie_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, ref_probe=None,
                num_iter=100, joint_recon=False, recon_win=None, save_dir=None,
-               obj_step_sz=0.5, probe_step_sz=0.5):
+               obj_step_sz=0.5, probe_step_sz=0.5, batch_size=1, fft_backend=None, metrics=None,
+               checkpoint_every=None, resume_from=None, stop=None, precision=None, telemetry=None, callback=None,
+               refine_positions=None):
     """extended Ptychographic Iterative Engine (ePIE).
     
     Function to perform ePIE reconstruction on ptychographic data.
     
     Args:
         y_meas: pre-processed measurements (diffraction patterns).
-        patch_bounds: scan coordinates of projections.
+        patch_bounds: scan coordinates of projections or PatchOperator (reusing its index maps and image weights).
         init_obj: formulated initial guess of complex object.
         init_probe: formulated initial guess of complex probe.
         ref_obj: complex reference image for object.
@@ -25,89 +153,173 @@ def epie_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, re
         save_dir: directory to save reconstruction results.
         obj_step_sz: step size parameter for updating object estimate.
         probe_step_sz: step size parameter for updating probe estimate.
+        batch_size: maximum number of non-overlapping scan positions updated together (1 gives sequential ePIE).
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        metrics: metrics policy (see metrics.get_metrics_policy).
+        checkpoint_every: save a checkpoint of the solver state to save_dir every k iterations.
+        resume_from: path to a checkpoint file to resume the reconstruction from.
+        stop: stopping criterion (see stopping.get_stopping_criterion).
+        precision: precision policy (see precision.get_precision).
+        telemetry: iteration telemetry (see telemetry.get_telemetry).
+        callback: function or observer notified after every iteration (see observers.get_observer).
+        refine_positions: subpixel scan-position refinement (see positions.get_position_refiner).
         
     Returns:
         Reconstructed complex images and NRMSE between reconstructions and reference images. 
     """
-    cdtype = np.complex64
+    prec = get_precision(precision)
+    cdtype = prec.cdtype
     approach = 'ePIE'
+    telemetry = get_telemetry(telemetry)
+    fft = telemetry.wrap_fft(get_fft_backend(fft_backend))
+    metrics = get_metrics_policy(metrics)
+    stop = get_stopping_criterion(stop)
+    observer = get_observer(callback)
+    refiner = get_position_refiner(refine_positions)
     
     # check directory
     if save_dir is not None:
         os.makedirs(save_dir, exist_ok=True)
+    elif checkpoint_every:
+        raise ValueError('save_dir is required for saving checkpoints.')
 
     # initialization
-    if recon_win is None:
-        recon_win = np.ones_like(init_obj)
+    y_meas = prec.real(y_meas)
+    recon_win = prec.real(recon_win) if recon_win is not None else np.ones(init_obj.shape, dtype=prec.rdtype)
 
     nrmse_obj = []
     nrmse_probe = []
     nrmse_meas = []
+    metric_iters = []
     seq = np.arange(0, len(y_meas), 1).tolist()
 
     est_obj = np.copy(init_obj).astype(cdtype)
+    patch_op = telemetry.wrap_patch_op(get_patch_operator(patch_bounds, est_obj.shape, y_meas.shape))
     est_probe = np.copy(init_probe).astype(cdtype) if joint_recon else np.copy(ref_probe).astype(cdtype)
 
+    # restore solver state from checkpoint
+    start_iter = 0
+    positions = None
+    if resume_from is not None:
+        ckpt = load_checkpoint(resume_from, approach)
+        start_iter, est_obj, est_probe, seq = ckpt['iteration'], ckpt['object'], ckpt['probe'], ckpt['seq'].tolist()
+        nrmse_obj, nrmse_probe, nrmse_meas, metric_iters = [ckpt[key] for key in HISTORY_KEYS]
+        random.setstate((3, tuple(int(val) for val in ckpt['rng_state']), None))
+        positions = ckpt.get('positions')
+
+    # start scan-position refinement (probes of the frames are shifted by the subpixel positions once refined)
+    patch_op = refiner.start(patch_op, positions=positions, wrap=telemetry.wrap_patch_op)
+    patch_bounds = patch_op.patch_bounds
+    batch_idx = color_batches(find_overlaps(patch_bounds), batch_size) if batch_size > 1 else None
+
     # ePIE reconstruction
     # start_time = time.time()
     print('ePIE recon starts ...')
-    for i in tqdm(range(num_iter)):
-        shuffle(seq)
-        for j in seq:
-            crd0, crd1, crd2, crd3 = patch_bounds[j, 0], patch_bounds[j, 1], patch_bounds[j, 2], patch_bounds[j, 3]
-            projected_img = np.copy(est_obj[crd0:crd1, crd2:crd3])
-            frm = projected_img * est_probe
-            # take Fourier Transform
-            f = compute_ft(frm)
-            # revise estimate of frame data
-            delta_frm = compute_ift(y_meas[j] * np.exp(1j * np.angle(f))) - frm
-            # revise estimates of complex object
-            est_obj[crd0:crd1, crd2:crd3] += obj_step_sz * np.conj(est_probe) * delta_frm / (np.amax(np.abs(est_probe)) ** 2)
-            if joint_recon:
-                est_probe += probe_step_sz * np.conj(projected_img) * delta_frm / (np.amax(np.abs(projected_img)) ** 2)
+    stop.start()
+    telemetry.start(approach, save_dir)
+    observer.start(approach)
+    stop_reason = None
+    # estimates returned if the checkpoint already reached num_iter
+    i = start_iter - 1
+    revy_obj, revy_probe = est_obj, est_probe
+    try:
+        for i in tqdm(range(start_iter, num_iter), initial=start_iter, total=num_iter):
+            with telemetry.phase('update'):
+                shuffle(seq)
+                for batch in schedule_batches(seq, batch_idx):
+                    if len(batch) == 1:
+                        crd0, crd1, crd2, crd3 = patch_bounds[batch[0], 0], patch_bounds[batch[0], 1], patch_bounds[batch[0], 2], patch_bounds[batch[0], 3]
+                        index = np.s_[crd0:crd1, crd2:crd3]
+                    else:
+                        # pixel indices of the non-overlapping patches in current batch
+                        rows = patch_bounds[batch, 0][:, None, None] + np.arange(y_meas.shape[1])[None, :, None]
+                        cols = patch_bounds[batch, 2][:, None, None] + np.arange(y_meas.shape[2])[None, None, :]
+                        index = (rows, cols)
+                    epie_update(est_obj, est_probe, index, y_meas[batch], obj_step_sz, probe_step_sz, joint_recon, fft,
+                                frm_probe=refiner.frame_probe(est_probe, fft, frames=batch),
+                                frm_shifts=refiner.subpixel[batch] if refiner.refined else None)
+            if refiner.due(i):
+                with telemetry.phase('positions'):
+                    # refine scan positions (and update the overlap graph if their integer parts changed)
+                    patch_op = refiner.update(est_obj, est_probe, y_meas, fft)
+                    patch_bounds = patch_op.patch_bounds
+                    if len(refiner.moved) > 0:
+                        batch_idx = color_batches(find_overlaps(patch_bounds), batch_size) if batch_size > 1 else None
  
-        # phase normalization and scale image to minimize the intensity difference
-        if ref_obj is not None:
-            revy_obj = phase_norm(np.copy(est_obj) * recon_win, ref_obj * recon_win, cstr=recon_win)
-            err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
-            nrmse_obj.append(err_obj)
-        else:
-            revy_obj = est_obj 
-        if joint_recon:
-            if ref_probe is not None:
-                revy_probe = phase_norm(np.copy(est_probe), ref_probe)
-                err_probe = compute_nrmse(revy_probe, ref_probe)
-                nrmse_probe.append(err_probe)
-            else:
-                revy_probe = est_probe
-        else:
-            revy_probe = est_probe
-
-        # calculate error in measurement domain
-        est_patch = img2patch(est_obj, patch_bounds, y_meas.shape).astype(cdtype)
-        est_meas = np.abs(compute_ft(est_probe * est_patch))
-        nrmse_meas.append(compute_nrmse(est_meas, y_meas))
-
-    # # calculate time consumption
-    # print('Time consumption of {}:'.format(approach), time.time() - start_time)
-
-    # save recon results
-    if save_dir is not None:
-        save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
-        if nrmse_obj:
-            save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
-        if nrmse_meas:
-            save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
-        if joint_recon:
-            save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
-            if nrmse_probe:
-                save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+            # check stopping criterion (the plateau of err_meas is tested after its evaluation)
+            stop_reason = stop.check(i + 1, est_obj)
+            # notify the observer, which may request to stop
+            if observer.update(i + 1, est_obj, est_probe) and not stop_reason:
+                stop_reason = 'callback'
+
+            # evaluate convergence metrics according to metrics policy (and when stopping)
+            if metrics.due(i, num_iter) or stop_reason:
+                with telemetry.phase('metrics'):
+                    metric_iters.append(i + 1)
+                    # phase normalization and scale image to minimize the intensity difference
+                    if ref_obj is not None:
+                        revy_obj = phase_norm(est_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        nrmse_obj.append(err_obj)
+                    else:
+                        revy_obj = est_obj 
+                    if joint_recon:
+                        if ref_probe is not None:
+                            revy_probe = phase_norm(np.copy(est_probe), ref_probe)
+                            err_probe = compute_nrmse(revy_probe, ref_probe)
+                            nrmse_probe.append(err_probe)
+                        else:
+                            revy_probe = est_probe
+                    else:
+                        revy_probe = est_probe
+
+                    # calculate error in measurement domain
+                    nrmse_meas.append(meas_nrmse(est_obj, refiner.frame_probe(est_probe, fft), y_meas, patch_op, fft, frames=metrics.frames(len(y_meas))))
+                # test the plateau of err_meas with its new value
+                if not stop_reason:
+                    stop_reason = stop.check_meas(i + 1, nrmse_meas)
+
+            # save checkpoint of solver state
+            if checkpoint_every and (i + 1) % checkpoint_every == 0:
+                with telemetry.phase('io'):
+                    save_checkpoint(save_dir + 'checkpoint.h5', approach, i + 1, object=est_obj, probe=est_probe, seq=seq, rng_state=random.getstate()[1],
+                                    positions=refiner.positions, err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas, metric_iters=metric_iters)
+
+            telemetry.end_iteration(i + 1, metric_iters, err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas)
+
+            if stop_reason:
+                print('{} recon stopped after {} iterations ({}).'.format(approach, i + 1, stop_reason))
+                break
+
+        # # calculate time consumption
+        # print('Time consumption of {}:'.format(approach), time.time() - start_time)
+
+        # save recon results
+        with telemetry.phase('io'):
+            if save_dir is not None:
+                save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
+                if nrmse_obj:
+                    save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
+                if nrmse_meas:
+                    save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
+                if joint_recon:
+                    save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
+                    if nrmse_probe:
+                        save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    except BaseException:
+        stop_reason = 'error'
+        raise
+    finally:
+        observer.finish()
+        telemetry.close(stop_reason=stop_reason or 'num_iter')
 
     # return recon results
     print('{} recon completed.'.format(approach))
-    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas']
-    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas]
+    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas', 'metric_iters', 'num_iter', 'stop_reason']
+    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas, metric_iters, i + 1, stop_reason or 'num_iter']
     output = dict(zip(keys, vals))
+    if refiner.enabled:
+        output['positions'] = refiner.positions
 
     return output
 
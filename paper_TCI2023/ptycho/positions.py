@@ -0,0 +1,236 @@
+import numpy as np
+from paper_TCI2023.ptycho.patch_ops import PatchOperator
+from paper_TCI2023.ptycho.projection import replace_magnitude
+
+
+'''
+This file defines the scan-position refinement of the reconstruction engines. Every scan position is split into
+an integer part, which selects the object patch through a PatchOperator, and a subpixel part, which shifts the
+probe of the frame with a Fourier phase ramp. Shifting the probe by s against the object patch simulates the
+same Fourier magnitudes as extracting the object patch at the fractional position. The subpixel shifts of all
+frames are estimated together by a least-squares fit of the probe gradient to the Fourier-projection residual.
+'''
+
+
+def frequency_grid(shape):
+    """Frequencies (in cycles per pixel) of the centered Fourier transforms of the FFT backends.
+
+    Args:
+        shape: shape of the frames.
+
+    Returns:
+        column of row frequencies and row of column frequencies.
+    """
+    ky = np.fft.ifftshift(np.fft.fftfreq(shape[0]))[:, None]
+    kx = np.fft.ifftshift(np.fft.fftfreq(shape[1]))[None, :]
+
+    return ky, kx
+
+
+def shift_probe(probe, shifts, fft, gradient=False):
+    """Shift a probe (or every probe of a stack by its own amount) by subpixel amounts.
+
+    Args:
+        probe: complex probe, or stack of probes with one probe per shift.
+        shifts: array of (row, column) shifts in pixels, one per frame.
+        fft: FFT backend.
+        gradient: option to also return the row and column derivatives of the shifted probes.
+
+    Returns:
+        stack of shifted probes (and the stacks of their row and column derivatives).
+    """
+    shifts = np.asarray(shifts, dtype=np.float64)
+    ky, kx = frequency_grid(probe.shape[-2:])
+    # phase ramps of the shift theorem, separable in rows and columns
+    ramp_y = np.exp(-2j * np.pi * ky[None] * shifts[:, 0, None, None]).astype(probe.dtype)
+    ramp_x = np.exp(-2j * np.pi * kx[None] * shifts[:, 1, None, None]).astype(probe.dtype)
+    spectrum = fft.ft(probe) * ramp_y * ramp_x
+    probes = fft.ift(spectrum)
+    if not gradient:
+        return probes
+
+    grad_y = fft.ift(spectrum * (2j * np.pi * ky).astype(probe.dtype))
+    grad_x = fft.ift(spectrum * (2j * np.pi * kx).astype(probe.dtype))
+
+    return probes, grad_y, grad_x
+
+
+class PositionRefiner:
+    """Subpixel scan-position refinement.
+
+    Starting at iteration first_iter, the positions are refined every k iterations by one least-squares step,
+    which is bounded by max_step pixels per frame and scaled by relax. The mean step of all frames is removed,
+    since a common translation of all positions only shifts the reconstruction.
+
+    Args:
+        first_iter: first iteration (0-based) of the refinement.
+        every: refine the positions every k iterations.
+        max_step: maximum change of a position per refinement in pixels.
+        relax: relaxation parameter of the position update.
+        max_shift: maximum distance of a refined position from its initial position in pixels (None unbounded).
+    """
+    enabled = True
+
+    def __init__(self, first_iter=20, every=1, max_step=0.2, relax=0.5, max_shift=None):
+        self.first_iter = first_iter
+        self.every = every
+        self.max_step = max_step
+        self.relax = relax
+        self.max_shift = max_shift
+        self.positions = None
+        self.refined = False
+        self.patch_op = None
+        self.moved = np.zeros(0, dtype=int)
+
+    def start(self, patch_op, positions=None, wrap=None):
+        """Start the refinement from the integer positions of patch_op.
+
+        Args:
+            patch_op: PatchOperator of the initial scan positions.
+            positions: optional refined positions to resume from (e.g. from a checkpoint).
+            wrap: optional function applied to the private PatchOperator of the moved patches (e.g. Telemetry.wrap_patch_op).
+
+        Returns:
+            PatchOperator of the integer parts of the positions.
+        """
+        self._wrap = wrap if wrap is not None else (lambda op: op)
+        self.img_shape = patch_op.img_shape
+        self.patch_shape = patch_op.patch_shape
+        self.init_positions = patch_op.patch_bounds[:, [0, 2]].astype(np.float64)
+        self.patch_op = patch_op
+        # patch_op may be shared (e.g. by batch_recon), so the patches are moved in a private copy
+        self._own_patch_op = False
+        self.positions = np.copy(self.init_positions)
+        self.refined = False
+        self.moved = np.zeros(0, dtype=int)
+        self._cache = None
+        if positions is not None:
+            self._set_positions(np.asarray(positions, dtype=np.float64))
+            self.refined = True
+
+        return self.patch_op
+
+    def due(self, iteration):
+        """Check whether the positions are refined after iteration (0-based)."""
+        return iteration >= self.first_iter and (iteration - self.first_iter) % self.every == 0
+
+    @property
+    def subpixel(self):
+        """Subpixel parts of the positions (between -0.5 and 0.5)."""
+        return self.positions - np.round(self.positions)
+
+    def _set_positions(self, positions):
+        """Bound the positions and move the patches of the frames whose integer parts changed."""
+        if self.max_shift is not None:
+            positions = np.clip(positions, self.init_positions - self.max_shift, self.init_positions + self.max_shift)
+        max_corner = np.array(self.img_shape) - np.array(self.patch_shape[1:])
+        self.positions = np.clip(positions, 0, max_corner)
+        self._cache = None
+
+        corners = np.round(self.positions).astype(int)
+        self.moved = np.flatnonzero(np.any(corners != self.patch_op.patch_bounds[:, [0, 2]], axis=1))
+        if len(self.moved) == 0:
+            return
+        if not self._own_patch_op:
+            self.patch_op = self._wrap(PatchOperator(self.patch_op.patch_bounds, self.img_shape, self.patch_shape))
+            self._own_patch_op = True
+        self.patch_op.move_patches(self.moved, corners[self.moved])
+
+    def frame_probe(self, probe, fft, frames=None):
+        """Probes of the frames shifted by the subpixel parts of their positions.
+
+        The stack of all frames is cached while the probe is unchanged.
+
+        Args:
+            probe: complex probe.
+            fft: FFT backend.
+            frames: optional indices of the frames (all frames by default).
+
+        Returns:
+            probe (before the first refinement) or stack of shifted probes.
+        """
+        if not self.refined:
+            return probe
+        if self._cache is not None and np.array_equal(self._cache[0], probe):
+            return self._cache[1] if frames is None else self._cache[1][frames]
+        if frames is not None:
+            return shift_probe(probe, self.subpixel[frames], fft)
+        probes = shift_probe(probe, self.subpixel, fft)
+        self._cache = (np.copy(probe), probes)
+
+        return probes
+
+    def update(self, est_obj, probe, y_meas, fft):
+        """Refine the positions of all frames by one least-squares step.
+
+        The indices of the frames whose integer positions changed are stored in moved.
+
+        Args:
+            est_obj: current estimate of complex object.
+            probe: current estimate of complex probe.
+            y_meas: pre-processed measurements.
+            fft: FFT backend.
+
+        Returns:
+            PatchOperator of the integer parts of the refined positions.
+        """
+        patch = self.patch_op.img2patch(est_obj)
+        probes, grad_y, grad_x = shift_probe(probe, self.subpixel, fft, gradient=True)
+        frm = patch * probes
+        f = fft.ft(frm)
+        # residual of the Fourier projection
+        delta_frm = fft.ift(replace_magnitude(f, y_meas, out=f)) - frm
+
+        # the frame data changes by -patch * grad(probe) per unit shift of the probe
+        step = np.empty_like(self.positions)
+        for axis, grad in enumerate([grad_y, grad_x]):
+            dfrm = -patch * grad
+            num = np.real(np.sum(np.conj(dfrm) * delta_frm, axis=(-2, -1)))
+            den = np.sum(np.abs(dfrm) ** 2, axis=(-2, -1))
+            step[:, axis] = np.divide(num, den, out=np.zeros_like(num), where=(den > 0))
+        step -= np.mean(step, axis=0)
+        step = self.relax * np.clip(step, -self.max_step, self.max_step)
+
+        self._set_positions(self.positions + step)
+        self.refined = True
+
+        return self.patch_op
+
+
+class NullPositionRefiner:
+    """Disabled position refinement keeping the scan positions fixed."""
+    enabled = False
+    positions = None
+    refined = False
+    moved = np.zeros(0, dtype=int)
+
+    def start(self, patch_op, positions=None, wrap=None):
+        return patch_op
+
+    def due(self, iteration):
+        return False
+
+    def frame_probe(self, probe, fft, frames=None):
+        return probe
+
+
+def get_position_refiner(refine_positions=None):
+    """Resolve the scan-position refinement of a reconstruction.
+
+    Args:
+        refine_positions: None or False (fixed positions), True (default refinement), dictionary of keyword
+            arguments of PositionRefiner (e.g. from a config file), or PositionRefiner instance.
+
+    Returns:
+        PositionRefiner or NullPositionRefiner instance.
+    """
+    if refine_positions is None or refine_positions is False:
+        return NullPositionRefiner()
+    if isinstance(refine_positions, (PositionRefiner, NullPositionRefiner)):
+        return refine_positions
+    if refine_positions is True:
+        return PositionRefiner()
+    if isinstance(refine_positions, dict):
+        return PositionRefiner(**refine_positions)
+
+    raise ValueError('Invalid position refinement: {}'.format(refine_positions))
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+'''
+This file defines the precision policy of the reconstruction engines. All arrays entering the iterations are
+converted once to the complex and real dtypes of the policy, so that no intermediate is silently upcast.
+'''
+
+
+class Precision:
+    """Precision policy.
+
+    Args:
+        cdtype: complex dtype of images, probes and frame data (np.complex64 or np.complex128).
+    """
+
+    def __init__(self, cdtype=np.complex64):
+        self.cdtype = np.dtype(cdtype)
+        if self.cdtype not in [np.dtype(np.complex64), np.dtype(np.complex128)]:
+            raise ValueError('Unsupported complex dtype: {}'.format(self.cdtype))
+        # real dtype of measurements, weights and windows
+        self.rdtype = np.finfo(self.cdtype).dtype
+
+    def complex(self, arr):
+        """Convert to the complex dtype (without copying if arr already has it)."""
+        return np.asarray(arr, dtype=self.cdtype)
+
+    def real(self, arr):
+        """Convert to the real dtype (without copying if arr already has it)."""
+        return np.asarray(arr, dtype=self.rdtype)
+
+
+def get_precision(precision=None):
+    """Resolve a precision policy.
+
+    Args:
+        precision: None or 'single' (complex64), 'double' (complex128), complex dtype or Precision instance.
+
+    Returns:
+        Precision instance.
+    """
+    if isinstance(precision, Precision):
+        return precision
+    if precision is None or precision == 'single':
+        return Precision(np.complex64)
+    if precision == 'double':
+        return Precision(np.complex128)
+
+    return Precision(precision)
+
+
+def complex_dtype(arr):
+    """Return the complex dtype matching the precision of an array (complex64 for single or lower precision)."""
+    return np.result_type(arr.dtype, np.complex64)
@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+'''
+This file defines a content-addressed cache for the prepared inputs of the experiment scripts (measurements,
+patch bounds, initial guesses and windows). Entries are keyed on the hashes of the input files and on the
+preprocessing configuration, and the least recently used entries are evicted above a size limit.
+'''
+
+
+class PrepCache:
+    """Content-addressed cache of prepared reconstruction inputs.
+
+    Args:
+        cache_dir: directory holding the cache entries.
+        max_bytes: maximum total size of the cache entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # content digests of input files, reused while path, size and modification time are unchanged
+        self._digest_file = os.path.join(cache_dir, 'file_digests.json')
+        self._digests = {}
+        if os.path.exists(self._digest_file):
+            with open(self._digest_file, 'r') as f:
+                self._digests = json.load(f)
+
+    def _file_digest(self, fname):
+        stat = os.stat(fname)
+        tag = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+        fname = os.path.abspath(fname)
+        if self._digests.get(fname, [None])[0] != tag:
+            sha = hashlib.sha256()
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    sha.update(block)
+            self._digests[fname] = [tag, sha.hexdigest()]
+
+        return self._digests[fname][1]
+
+    def key(self, paths, config):
+        """Compute the cache key of a set of input files/directories and a preprocessing configuration.
+
+        Args:
+            paths: list of input files or directories (searched recursively).
+            config: JSON-serializable preprocessing configuration.
+
+        Returns:
+            hexadecimal cache key.
+        """
+        sha = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode())
+        for path in paths:
+            if os.path.isdir(path):
+                fnames = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            else:
+                fnames = [path]
+            for fname in fnames:
+                sha.update(os.path.relpath(fname, path).encode())
+                sha.update(self._file_digest(fname).encode())
+        # temporary file of this process, since concurrent runs share the digest index
+        tmp_file = '{}.{}.tmp'.format(self._digest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(tmp_file, self._digest_file)
+
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """Load a cache entry.
+
+        Args:
+            key: cache key.
+
+        Returns:
+            dictionary of arrays, or None if the entry does not exist.
+        """
+        fname = self._entry(key)
+        try:
+            os.utime(fname)
+            with np.load(fname, allow_pickle=False) as data:
+                return {name: data[name] for name in data.files}
+        except OSError:
+            # missing, or evicted by a concurrent run
+            return None
+
+    def save(self, key, arrays):
+        """Save a cache entry and evict least recently used entries above max_bytes.
+
+        Args:
+            key: cache key.
+            arrays: dictionary of arrays. Entries with value None are skipped.
+        """
+        fname = self._entry(key)
+        # temporary file of this process, which is not mistaken for an entry by evict()
+        tmp_file = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **{name: val for name, val in arrays.items() if val is not None})
+        os.replace(tmp_file, fname)
+        self.evict(keep=key)
+
+    def get_or_compute(self, paths, config, func):
+        """Load the entry for (paths, config), computing and saving it with func() on a cache miss.
+
+        Args:
+            paths: list of input files or directories.
+            config: JSON-serializable preprocessing configuration.
+            func: function without arguments returning a dictionary of arrays.
+
+        Returns:
+            dictionary of arrays.
+        """
+        key = self.key(paths, config)
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = func()
+            self.save(key, arrays)
+        else:
+            print('Loaded prepared data from cache entry {}.'.format(key[:12]))
+
+        return arrays
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache size is below max_bytes.
+
+        Args:
+            keep: optional key of an entry that is never evicted (e.g. the entry just written).
+        """
+        keep_fname = self._entry(keep) if keep is not None else None
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            fname = os.path.join(self.cache_dir, name)
+            if not name.endswith('.npz') or fname == keep_fname:
+                continue
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                # evicted by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        if keep_fname is not None and os.path.exists(keep_fname):
+            total += os.path.getsize(keep_fname)
+        while entries and total > self.max_bytes:
+            _, size, fname = entries.pop(0)
+            total -= size
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+'''
+This file defines the Fourier magnitude replacement shared by the reconstruction engines. It computes
+y * f / |f| instead of y * exp(1j * angle(f)), which avoids the arctan2 and the complex exponential per element,
+and works on chunks of frames so that temporaries stay small.
+'''
+
+
+def replace_magnitude(f, y, out=None, chunk_frames=64):
+    """Replace the magnitude of f with y while keeping the phase of f.
+
+    The result equals y * np.exp(1j * np.angle(f)), including the elements with f = 0, where it is y.
+
+    Args:
+        f: complex Fourier transforms of the frame data (a frame or a stack of frames).
+        y: magnitudes (e.g. pre-processed measurements) with the shape of f.
+        out: optional pre-allocated C-contiguous array to store the result (may be f for an in-place update).
+        chunk_frames: number of frames processed at once.
+
+    Returns:
+        complex array with magnitude y and the phase of f.
+    """
+    if y.shape != f.shape:
+        raise ValueError('Shape of magnitudes {} does not match shape of Fourier data {}.'.format(y.shape, f.shape))
+    output = np.empty_like(f) if out is None else out
+    frm_shape = f.shape[-2:]
+    f_frm, y_frm, out_frm = [np.reshape(arr, (-1,) + frm_shape) for arr in (f, y, output)]
+
+    for start in range(0, len(f_frm), chunk_frames):
+        chunk = slice(start, start + chunk_frames)
+        # scale = y / |f|, computed in the buffer of |f|
+        scale = np.abs(f_frm[chunk])
+        zero = scale == 0
+        np.divide(y_frm[chunk], scale, out=scale, where=~zero)
+        np.multiply(f_frm[chunk], scale, out=out_frm[chunk])
+        # the phase of f = 0 is 0
+        out_frm[chunk][zero] = y_frm[chunk][zero]
+
+    return output
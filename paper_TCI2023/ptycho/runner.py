@@ -0,0 +1,87 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from paper_TCI2023.ptycho.precision import get_precision
+
+
+'''
+This file defines the runner that dispatches independent reconstructions of the same data set to worker
+processes. The measurement stack is placed in shared memory once instead of being pickled for every job.
+'''
+
+
+def share_array(arr, dtype=None):
+    """Copy an array into a new shared memory block.
+
+    Args:
+        arr: array to share.
+        dtype: optional data type of the shared array (arr is cast while it is copied, without a temporary copy).
+
+    Returns:
+        shared memory block and (name, shape, dtype) descriptor used to attach to it.
+    """
+    arr = np.asarray(arr)
+    dtype = arr.dtype if dtype is None else np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.size * dtype.itemsize, 1))
+    shared_arr = np.ndarray(arr.shape, dtype=dtype, buffer=shm.buf)
+    shared_arr[...] = arr
+    del shared_arr
+
+    return shm, (shm.name, arr.shape, dtype.str)
+
+
+def attach_array(desc):
+    """Attach to an array in shared memory created by share_array.
+
+    Args:
+        desc: (name, shape, dtype) descriptor returned by share_array.
+
+    Returns:
+        shared memory block and array view on it.
+    """
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_shared_job(func, desc, patch_bounds, kwargs):
+    """Run one reconstruction in a worker process on the shared measurement stack."""
+    shm, y_meas = attach_array(desc)
+    try:
+        return func(y_meas, patch_bounds, **kwargs)
+    finally:
+        del y_meas
+        shm.close()
+
+
+def run_recon_jobs(jobs, y_meas, patch_bounds, num_workers=None, precision=None):
+    """Run independent reconstructions of the same data set.
+
+    Args:
+        jobs: list of (name, func, kwargs), where func(y_meas, patch_bounds, **kwargs) returns the result
+            dictionary of a reconstruction approach. func must be importable at module level.
+        y_meas: pre-processed measurements shared by all jobs.
+        patch_bounds: scan coordinates of projections.
+        num_workers: number of worker processes (defaults to the number of jobs). 1 runs all jobs in the
+            current process, one after another.
+        precision: precision policy of the engines (see precision.get_precision). The shared measurements are
+            converted to its real dtype once, so that the workers do not convert them to private copies.
+
+    Returns:
+        dictionary mapping the job names to the result dictionaries.
+    """
+    num_workers = len(jobs) if num_workers is None else num_workers
+    if num_workers <= 1:
+        return {name: func(y_meas, patch_bounds, **kwargs) for name, func, kwargs in jobs}
+
+    shm, desc = share_array(y_meas, dtype=get_precision(precision).rdtype)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [(name, executor.submit(_run_shared_job, func, desc, patch_bounds, kwargs)) for name, func, kwargs in jobs]
+            results = {name: future.result() for name, future in futures}
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
@@ -2,9 +2,20 @@ import time
 from tqdm import tqdm
 from paper_TCI2023.ptycho_pmace.pmace.utils import *
 from paper_TCI2023.ptycho_pmace.pmace.nrmse import *
-
-
-def fourier_projector(frame_data, y_meas):
+from paper_TCI2023.ptycho.checkpoint import save_checkpoint, load_checkpoint, HISTORY_KEYS
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.metrics import get_metrics_policy, meas_nrmse
+from paper_TCI2023.ptycho.observers import get_observer
+from paper_TCI2023.ptycho.parallel import get_frame_executor, SerialExecutor
+from paper_TCI2023.ptycho.patch_ops import get_patch_operator
+from paper_TCI2023.ptycho.positions import get_position_refiner, shift_probe
+from paper_TCI2023.ptycho.precision import get_precision, complex_dtype
+from paper_TCI2023.ptycho.projection import replace_magnitude
+from paper_TCI2023.ptycho.stopping import get_stopping_criterion
+from paper_TCI2023.ptycho.telemetry import get_telemetry
+
+
+def fourier_projector(frame_data, y_meas, fft_backend=None, out=None, executor=None):
     """Fourier projector.
 
     This Fourier projector projects frame data onto the Fourier magnitude constraints.
@@ -12,20 +23,29 @@ def fourier_projector(frame_data, y_meas):
     Args:
         frame_data: product between illuminated object and probe.
         y_meas: pre-processed data (square root of recorded phaseless intensity measurements).
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        out: optional pre-allocated array to store the result.
+        executor: frame-parallel executor (see parallel.get_frame_executor).
 
     Returns:
         revised estimates of frame data.
     """
-    # FT
-    f_tmp = compute_ft(frame_data)
-    
-    # IFT 
-    output = compute_ift(y_meas * np.exp(1j * np.angle(f_tmp)))
+    fft = get_fft_backend(fft_backend)
+    executor = get_frame_executor(executor)
+    output = np.empty(frame_data.shape, dtype=complex_dtype(frame_data)) if out is None else out
+
+    def project(chunk):
+        # FT
+        f_tmp = fft.ft(frame_data[chunk])
+        # IFT
+        output[chunk] = fft.ift(replace_magnitude(f_tmp, y_meas[chunk], out=f_tmp))
+
+    executor.run(project, len(frame_data), output[0].nbytes)
 
     return output
 
 
-def space_projector(frame_data, probe, coords, img_wgt, img_sz):
+def space_projector(frame_data, probe, coords, img_wgt, img_sz, out=None):
     """Space projector.
     
     This image projector matches the object with object domain constraint.
@@ -33,31 +53,104 @@ def space_projector(frame_data, probe, coords, img_wgt, img_sz):
     Args:
         frame_data: product between illuminated object and probe.
         probe: complex beam profile function.
-        coords: coordinates of projections.
+        coords: coordinates of projections or PatchOperator.
         img_wgt: image weight.
         img_sz: shape of full-size image.
+        out: optional pre-allocated array (other than frame_data) to store the result, also used as workspace.
         
     Returns:
         revised estimates of frame data.
     """
+    patch_op = get_patch_operator(coords, img_sz, frame_data.shape)
+
     # frame data to weighted image
-    img_tmp = patch2img(frame_data * np.conj(probe), coords, img_sz, img_wgt)
+    if out is None:
+        img_tmp = patch_op.patch2img(frame_data * np.conj(probe), img_wgt)
+    else:
+        img_tmp = patch_op.patch2img(conj_product(frame_data, probe, out=out), img_wgt)
     
     # image to frame data
-    output = img2patch(img_tmp, coords, frame_data.shape) * probe
+    output = patch_op.img2patch(img_tmp, out=out)
+    output *= probe
 
     return output
 
 
+def conj_product(frame_data, probe, out):
+    """Compute frame_data * conj(probe) in a pre-allocated array.
+
+    Args:
+        frame_data: frame data.
+        probe: complex probe or stack of probes of all frames.
+        out: pre-allocated array with the shape of frame_data (other than frame_data).
+
+    Returns:
+        out containing the product.
+    """
+    np.conjugate(probe, out=out)
+    out *= frame_data
+
+    return out
+
+
+def relax_in_place(cur_frm, frm_f, frm_s, frm_fs, relax_pm, sign=1):
+    """In-place SHARP/SHARP+ relaxation step.
+
+    Function to compute 2 * relax_pm * frm_fs + (1 - 2 * relax_pm) * frm_f + sign * relax_pm * (frm_s - cur_frm)
+    without allocating new frame stacks. The inputs frm_f and frm_s are overwritten.
+
+    Args:
+        cur_frm: current estimate of frame data.
+        frm_f: Fourier projection of cur_frm.
+        frm_s: space projection of cur_frm.
+        frm_fs: space projection of frm_f, overwritten by the result.
+        relax_pm: relaxation parameter.
+        sign: 1 for SHARP and -1 for SHARP+.
+
+    Returns:
+        frm_fs containing the new estimate of frame data.
+    """
+    np.subtract(frm_s, cur_frm, out=frm_s)
+    frm_s *= sign * relax_pm
+    frm_f *= 1 - 2 * relax_pm
+    frm_fs *= 2 * relax_pm
+    frm_fs += frm_f
+    frm_fs += frm_s
+
+    return frm_fs
+
+
+def alloc_workspace(frm, approach):
+    """Frame buffer allocation for in-place SHARP/SHARP+.
+
+    The buffers hold the projections of an iteration and serve as workspace of the object and probe updates. The
+    peak memory of an iteration is measured by Telemetry(track_allocations=True) or benchmark.in_place_memory.
+
+    Args:
+        frm: initial frame data.
+        approach: name of approach for reporting.
+
+    Returns:
+        tuple of three frame buffers with the same shape and dtype as frm.
+    """
+    buffers = tuple(np.empty_like(frm) for _ in range(3))
+    print('{} in-place mode: {:.1f} MB of frame buffers allocated once.'.format(approach, 3 * frm.nbytes / 2 ** 20))
+
+    return buffers
+
+
 def sharp_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, ref_probe=None, 
-                num_iter=100, joint_recon=False, recon_win=None, save_dir=None, relax_pm=0.75):
+                num_iter=100, joint_recon=False, recon_win=None, save_dir=None, relax_pm=0.75,
+                fft_backend=None, in_place=False, metrics=None,
+                checkpoint_every=None, resume_from=None, stop=None, precision=None, telemetry=None, callback=None,
+                parallel=None, refine_positions=None):
     """SHARP.
     
     Function to perform SHARP reconstruction on ptychographic data. 
     
     Args:
         y_meas: pre-processed data (square root of recorded phaseless intensity measurements).
-        patch_bounds: scan coordinates of projections.
+        patch_bounds: scan coordinates of projections or PatchOperator (reusing its index maps and image weights).
         init_obj: formulated initial guess of complex object.
         init_probe: formulated initial guess of complex probe.
         ref_obj: complex reference image for object.
@@ -67,115 +160,234 @@ def sharp_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, r
         recon_win: pre-defined window for showing and comparing reconstruction results.
         save_dir: directory to save reconstruction results.
         relax_pm: relaxation parameter.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        in_place: option to update frame data in pre-allocated buffers to reduce peak memory.
+        metrics: metrics policy (see metrics.get_metrics_policy).
+        checkpoint_every: save a checkpoint of the solver state to save_dir every k iterations.
+        resume_from: path to a checkpoint file to resume the reconstruction from.
+        stop: stopping criterion (see stopping.get_stopping_criterion).
+        precision: precision policy (see precision.get_precision).
+        telemetry: iteration telemetry (see telemetry.get_telemetry).
+        callback: function or observer notified after every iteration (see observers.get_observer).
+        parallel: frame-parallel executor of the Fourier projection (see parallel.get_frame_executor).
+        refine_positions: subpixel scan-position refinement (see positions.get_position_refiner).
         
     Returns:
         Reconstructed complex images and NRMSE between reconstructions and reference images.  
     """
     approach = 'SHARP'
-    cdtype = np.complex64
+    prec = get_precision(precision)
+    cdtype = prec.cdtype
+    telemetry = get_telemetry(telemetry)
+    fft = telemetry.wrap_fft(get_fft_backend(fft_backend))
+    metrics = get_metrics_policy(metrics)
+    stop = get_stopping_criterion(stop)
+    observer = get_observer(callback)
+    executor = get_frame_executor(parallel)
+    refiner = get_position_refiner(refine_positions)
     
     # check directory
     if save_dir is not None:
         os.makedirs(save_dir, exist_ok=True)
+    elif checkpoint_every:
+        raise ValueError('save_dir is required for saving checkpoints.')
 
     # initialization
-    if recon_win is None:
-        recon_win = np.ones_like(init_obj)
+    y_meas = prec.real(y_meas)
+    recon_win = prec.real(recon_win) if recon_win is not None else np.ones(init_obj.shape, dtype=prec.rdtype)
 
     nrmse_obj = []
     nrmse_probe = []
     nrmse_meas = []
+    metric_iters = []
 
     est_obj = np.copy(init_obj).astype(cdtype)
-    est_patch = img2patch(est_obj, patch_bounds, y_meas.shape)
+    patch_op = telemetry.wrap_patch_op(get_patch_operator(patch_bounds, est_obj.shape, y_meas.shape))
     est_probe = np.asarray(init_probe, dtype=cdtype) if joint_recon else ref_probe.astype(cdtype)
-    est_frm = est_patch * est_probe
-    cur_frm = np.copy(est_frm)
+    cur_frm = patch_op.img2patch(est_obj)
+    cur_frm *= est_probe
+
+    # restore solver state from checkpoint
+    start_iter = 0
+    positions = None
+    if resume_from is not None:
+        ckpt = load_checkpoint(resume_from, approach)
+        start_iter, est_obj, est_probe, cur_frm = ckpt['iteration'], ckpt['object'], ckpt['probe'], ckpt['cur_frm']
+        nrmse_obj, nrmse_probe, nrmse_meas, metric_iters = [ckpt[key] for key in HISTORY_KEYS]
+        positions = ckpt.get('positions')
+
+    # start scan-position refinement (probes of the frames are shifted by the subpixel positions once refined)
+    patch_op = refiner.start(patch_op, positions=positions, wrap=telemetry.wrap_patch_op)
+    frm_probe = refiner.frame_probe(est_probe, fft)
     
     # calculate spatially-varying image weights
     img_sz = est_obj.shape
-    img_wgt = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, img_sz)
+    img_wgt = patch_op.illumination_weight(frm_probe)
+    if in_place:
+        frm_f, frm_s, frm_fs = alloc_workspace(cur_frm, approach)
+        if isinstance(executor, SerialExecutor):
+            # Fourier projection in cache-sized chunks, so that its temporaries are small
+            executor = get_frame_executor(1)
+    fourier_proj = telemetry.wrap('fourier_projection', fourier_projector)
 
     # SHARP reconstruction
     start_time = time.time()
     print('SHARP recon starts ...')
-    for i in tqdm(range(num_iter)):
-        # take projections
-        tmp_frm_f = fourier_projector(cur_frm, y_meas)
-        tmp_frm_s = space_projector(cur_frm, est_probe, patch_bounds, img_wgt, img_sz)
-        # SHARP+ updates 
-        est_frm = 2 * relax_pm * space_projector(tmp_frm_f, est_probe, patch_bounds, img_wgt, img_sz) + (1 - 2 * relax_pm) * tmp_frm_f + relax_pm * (tmp_frm_s - cur_frm)
-        # update current estimate of frame data
-        cur_frm = np.copy(est_frm)
-
-        # obtain estimate of complex object
-        est_obj = patch2img(est_frm * np.conj(est_probe), patch_bounds, img_sz, img_wgt)
-        if joint_recon:
-            # obtain estimate of complex probe
-            tmp_n = np.average(img2patch(np.conj(est_obj), patch_bounds, y_meas.shape) * est_frm, axis=0)
-            tmp_d = np.average(img2patch(np.abs(est_obj) ** 2, patch_bounds, y_meas.shape), axis=0)
-            est_probe = np.divide(tmp_n, tmp_d, where=(tmp_d!=0))
-            # update image weights
-            img_wgt = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, img_sz)
-
-        # # dynamic strategy for updating beta
-        # beta = beta + (1 - beta) * (1 - np.exp(-(i/7)**3))
+    stop.start()
+    telemetry.start(approach, save_dir)
+    observer.start(approach)
+    stop_reason = None
+    # estimates returned if the checkpoint already reached num_iter
+    i = start_iter - 1
+    revy_obj, revy_probe = est_obj, est_probe
+    try:
+        for i in tqdm(range(start_iter, num_iter), initial=start_iter, total=num_iter):
+            with telemetry.phase('update'):
+                if in_place:
+                    # take projections into pre-allocated buffers
+                    fourier_proj(cur_frm, y_meas, fft_backend=fft, out=frm_f, executor=executor)
+                    space_projector(cur_frm, frm_probe, patch_op, img_wgt, img_sz, out=frm_s)
+                    space_projector(frm_f, frm_probe, patch_op, img_wgt, img_sz, out=frm_fs)
+                    # SHARP+ updates and swap buffers instead of copying
+                    est_frm = relax_in_place(cur_frm, frm_f, frm_s, frm_fs, relax_pm, sign=1)
+                    cur_frm, frm_fs = est_frm, cur_frm
+                else:
+                    # take projections
+                    tmp_frm_f = fourier_proj(cur_frm, y_meas, fft_backend=fft, executor=executor)
+                    tmp_frm_s = space_projector(cur_frm, frm_probe, patch_op, img_wgt, img_sz)
+                    # SHARP+ updates 
+                    est_frm = 2 * relax_pm * space_projector(tmp_frm_f, frm_probe, patch_op, img_wgt, img_sz) + (1 - 2 * relax_pm) * tmp_frm_f + relax_pm * (tmp_frm_s - cur_frm)
+                    # update current estimate of frame data
+                    cur_frm = np.copy(est_frm)
+
+                # obtain estimate of complex object (the projections are no longer needed, so frm_s serves as workspace)
+                if in_place:
+                    est_obj = patch_op.patch2img(conj_product(est_frm, frm_probe, out=frm_s), img_wgt)
+                else:
+                    est_obj = patch_op.patch2img(est_frm * np.conj(frm_probe), img_wgt)
+            if joint_recon:
+                with telemetry.phase('probe_update'):
+                    # obtain estimate of complex probe
+                    if in_place:
+                        tmp_d = np.average(patch_op.img2patch((np.abs(est_obj) ** 2).astype(cdtype), out=frm_f), axis=0).real
+                    else:
+                        tmp_d = np.average(patch_op.img2patch(np.abs(est_obj) ** 2), axis=0)
+                    if refiner.refined:
+                        # the frames have shifted probes: correct est_probe by the residuals shifted back from the
+                        # subpixel positions (a least-squares step, whose fixed point is the consistent probe)
+                        obj_patch = patch_op.img2patch(est_obj)
+                        frm_n = shift_probe(np.conj(obj_patch) * (est_frm - obj_patch * frm_probe), -refiner.subpixel, fft)
+                        tmp_n = np.average(frm_n, axis=0)
+                        est_probe = est_probe + np.divide(tmp_n, tmp_d, out=np.zeros_like(tmp_n), where=(tmp_d!=0))
+                    else:
+                        if in_place:
+                            tmp_n = np.average(np.multiply(patch_op.img2patch(np.conj(est_obj), out=frm_s), est_frm, out=frm_s), axis=0)
+                        else:
+                            tmp_n = np.average(patch_op.img2patch(np.conj(est_obj)) * est_frm, axis=0)
+                        est_probe = np.divide(tmp_n, tmp_d, out=np.zeros_like(tmp_n), where=(tmp_d!=0))
+                    # update image weights
+                    frm_probe = refiner.frame_probe(est_probe, fft)
+                    img_wgt = patch_op.illumination_weight(frm_probe)
+            if refiner.due(i):
+                with telemetry.phase('positions'):
+                    # refine scan positions and update image weights
+                    patch_op = refiner.update(est_obj, est_probe, y_meas, fft)
+                    frm_probe = refiner.frame_probe(est_probe, fft)
+                    img_wgt = patch_op.illumination_weight(frm_probe)
+
+            # # dynamic strategy for updating beta
+            # beta = beta + (1 - beta) * (1 - np.exp(-(i/7)**3))
  
-        # phase normalization and scale image to minimize the intensity difference
-        if ref_obj is not None:
-            revy_obj = phase_norm(np.copy(est_obj) * recon_win, ref_obj * recon_win, cstr=recon_win)
-            err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
-            nrmse_obj.append(err_obj)
-        else:
-            revy_obj = est_obj 
-        if joint_recon:
-            if ref_probe is not None:
-                revy_probe = phase_norm(np.copy(est_probe), ref_probe)
-                err_probe = compute_nrmse(revy_probe, ref_probe)
-                nrmse_probe.append(err_probe)
-            else:
-                revy_probe = est_probe
-        else:
-            revy_probe = est_probe
-
-        # calculate error in measurement domain
-        est_patch = img2patch(est_obj, patch_bounds, y_meas.shape).astype(cdtype)
-        est_meas = np.abs(compute_ft(est_probe * est_patch))
-        nrmse_meas.append(compute_nrmse(est_meas, y_meas))
-
-    # # calculate time consumption
-    # print('Time consumption of {}:'.format(approach), time.time() - start_time)
-
-    # save recon results
-    if save_dir is not None:
-        save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
-        if nrmse_obj:
-            save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
-        if nrmse_meas:
-            save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
-        if joint_recon:
-            save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
-            if nrmse_probe:
-                save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+            # check stopping criterion (the plateau of err_meas is tested after its evaluation)
+            stop_reason = stop.check(i + 1, est_obj)
+            # notify the observer, which may request to stop
+            if observer.update(i + 1, est_obj, est_probe) and not stop_reason:
+                stop_reason = 'callback'
+
+            # evaluate convergence metrics according to metrics policy (and when stopping)
+            if metrics.due(i, num_iter) or stop_reason:
+                with telemetry.phase('metrics'):
+                    metric_iters.append(i + 1)
+                    # phase normalization and scale image to minimize the intensity difference
+                    if ref_obj is not None:
+                        revy_obj = phase_norm(est_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        nrmse_obj.append(err_obj)
+                    else:
+                        revy_obj = est_obj 
+                    if joint_recon:
+                        if ref_probe is not None:
+                            revy_probe = phase_norm(np.copy(est_probe), ref_probe)
+                            err_probe = compute_nrmse(revy_probe, ref_probe)
+                            nrmse_probe.append(err_probe)
+                        else:
+                            revy_probe = est_probe
+                    else:
+                        revy_probe = est_probe
+
+                    # calculate error in measurement domain
+                    nrmse_meas.append(meas_nrmse(est_obj, frm_probe, y_meas, patch_op, fft, frames=metrics.frames(len(y_meas))))
+                # test the plateau of err_meas with its new value
+                if not stop_reason:
+                    stop_reason = stop.check_meas(i + 1, nrmse_meas)
+
+            # save checkpoint of solver state
+            if checkpoint_every and (i + 1) % checkpoint_every == 0:
+                with telemetry.phase('io'):
+                    save_checkpoint(save_dir + 'checkpoint.h5', approach, i + 1, object=est_obj, probe=est_probe, cur_frm=cur_frm, positions=refiner.positions,
+                                    err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas, metric_iters=metric_iters)
+
+            telemetry.end_iteration(i + 1, metric_iters, err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas)
+
+            if stop_reason:
+                print('{} recon stopped after {} iterations ({}).'.format(approach, i + 1, stop_reason))
+                break
+
+        # # calculate time consumption
+        # print('Time consumption of {}:'.format(approach), time.time() - start_time)
+
+        # save recon results
+        with telemetry.phase('io'):
+            if save_dir is not None:
+                save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
+                if nrmse_obj:
+                    save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
+                if nrmse_meas:
+                    save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
+                if joint_recon:
+                    save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
+                    if nrmse_probe:
+                        save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    except BaseException:
+        stop_reason = 'error'
+        raise
+    finally:
+        observer.finish()
+        telemetry.close(stop_reason=stop_reason or 'num_iter')
 
     # return recon results
     print('{} recon completed.'.format(approach))
-    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas']
-    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas]
+    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas', 'metric_iters', 'num_iter', 'stop_reason']
+    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas, metric_iters, i + 1, stop_reason or 'num_iter']
     output = dict(zip(keys, vals))
+    if refiner.enabled:
+        output['positions'] = refiner.positions
 
     return output
 
 
 def sharp_plus_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, ref_probe=None,
-                     num_iter=100, joint_recon=False, recon_win=None, save_dir=None, relax_pm=0.75):
+                     num_iter=100, joint_recon=False, recon_win=None, save_dir=None, relax_pm=0.75,
+                     fft_backend=None, in_place=False, metrics=None,
+                     checkpoint_every=None, resume_from=None, stop=None, precision=None, telemetry=None, callback=None,
+                     parallel=None, refine_positions=None):
     """SHARP+.
     
     Function to perform SHARP+ reconstruction on ptychographic data.
     
     Args:
         y_meas: pre-processed data (square root of recorded phaseless intensity measurements).
-        patch_bounds: scan coordinates of projections.
+        patch_bounds: scan coordinates of projections or PatchOperator (reusing its index maps and image weights).
         init_obj: formulated initial guess of complex object.
         init_probe: formulated initial guess of complex probe.
         ref_obj: complex reference image for object.
@@ -185,98 +397,214 @@ def sharp_plus_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=No
         recon_win: pre-defined window for showing and comparing reconstruction results.
         save_dir: directory to save reconstruction results.
         relax_pm: relaxation parameter.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        in_place: option to update frame data in pre-allocated buffers to reduce peak memory.
+        metrics: metrics policy (see metrics.get_metrics_policy).
+        checkpoint_every: save a checkpoint of the solver state to save_dir every k iterations.
+        resume_from: path to a checkpoint file to resume the reconstruction from.
+        stop: stopping criterion (see stopping.get_stopping_criterion).
+        precision: precision policy (see precision.get_precision).
+        telemetry: iteration telemetry (see telemetry.get_telemetry).
+        callback: function or observer notified after every iteration (see observers.get_observer).
+        parallel: frame-parallel executor of the Fourier projection (see parallel.get_frame_executor).
+        refine_positions: subpixel scan-position refinement (see positions.get_position_refiner).
         
     Returns:
         Reconstructed complex images and NRMSE between reconstructions and reference images.
     """
     approach = 'SHARP+'
-    cdtype = np.complex64
+    prec = get_precision(precision)
+    cdtype = prec.cdtype
+    telemetry = get_telemetry(telemetry)
+    fft = telemetry.wrap_fft(get_fft_backend(fft_backend))
+    metrics = get_metrics_policy(metrics)
+    stop = get_stopping_criterion(stop)
+    observer = get_observer(callback)
+    executor = get_frame_executor(parallel)
+    refiner = get_position_refiner(refine_positions)
     
     # check directory
     if save_dir is not None:
         os.makedirs(save_dir, exist_ok=True)
+    elif checkpoint_every:
+        raise ValueError('save_dir is required for saving checkpoints.')
 
     # initialization
-    if recon_win is None:
-        recon_win = np.ones_like(init_obj)
+    y_meas = prec.real(y_meas)
+    recon_win = prec.real(recon_win) if recon_win is not None else np.ones(init_obj.shape, dtype=prec.rdtype)
 
     nrmse_obj = []
     nrmse_probe = []
     nrmse_meas = []
+    metric_iters = []
 
     est_obj = np.copy(init_obj).astype(cdtype)
-    est_patch = img2patch(est_obj, patch_bounds, y_meas.shape)
+    patch_op = telemetry.wrap_patch_op(get_patch_operator(patch_bounds, est_obj.shape, y_meas.shape))
     est_probe = np.asarray(init_probe, dtype=cdtype) if joint_recon else ref_probe.astype(cdtype)
-    est_frm = est_patch * est_probe
-    cur_frm = np.copy(est_frm)
+    cur_frm = patch_op.img2patch(est_obj)
+    cur_frm *= est_probe
+
+    # restore solver state from checkpoint
+    start_iter = 0
+    positions = None
+    if resume_from is not None:
+        ckpt = load_checkpoint(resume_from, approach)
+        start_iter, est_obj, est_probe, cur_frm = ckpt['iteration'], ckpt['object'], ckpt['probe'], ckpt['cur_frm']
+        nrmse_obj, nrmse_probe, nrmse_meas, metric_iters = [ckpt[key] for key in HISTORY_KEYS]
+        positions = ckpt.get('positions')
+
+    # start scan-position refinement (probes of the frames are shifted by the subpixel positions once refined)
+    patch_op = refiner.start(patch_op, positions=positions, wrap=telemetry.wrap_patch_op)
+    frm_probe = refiner.frame_probe(est_probe, fft)
     
     # calculate spatially-varying image weights
     img_sz = est_obj.shape
-    img_wgt = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, img_sz)
+    img_wgt = patch_op.illumination_weight(frm_probe)
+    if in_place:
+        frm_f, frm_s, frm_fs = alloc_workspace(cur_frm, approach)
+        if isinstance(executor, SerialExecutor):
+            # Fourier projection in cache-sized chunks, so that its temporaries are small
+            executor = get_frame_executor(1)
+    fourier_proj = telemetry.wrap('fourier_projection', fourier_projector)
 
     # SHARP+ reconstruction
     # start_time = time.time()
     print('SHARP+ recon starts ...')
-    for i in tqdm(range(num_iter)):
-        # take projections
-        tmp_frm_f = fourier_projector(cur_frm, y_meas)
-        tmp_frm_s = space_projector(cur_frm, est_probe, patch_bounds, img_wgt, img_sz)
-        # SHARP+ updates 
-        est_frm = 2 * relax_pm * space_projector(tmp_frm_f, est_probe, patch_bounds, img_wgt, img_sz) + (1 - 2 * relax_pm) * tmp_frm_f - relax_pm * (tmp_frm_s - cur_frm)
-        # update current estimate of frame data
-        cur_frm = np.copy(est_frm)
-
-        # obtain estimate of complex object
-        est_obj = patch2img(est_frm * np.conj(est_probe), patch_bounds, img_sz, img_wgt)
-        if joint_recon:
-            # obtain estimate of complex probe
-            tmp_n = np.average(img2patch(np.conj(est_obj), patch_bounds, y_meas.shape) * est_frm, axis=0)
-            tmp_d = np.average(img2patch(np.abs(est_obj) ** 2, patch_bounds, y_meas.shape), axis=0)
-            est_probe = np.divide(tmp_n, tmp_d, where=(tmp_d!=0))
-            # update image weights
-            img_wgt = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, img_sz)
-
-        # phase normalization and scale image to minimize the intensity difference
-        if ref_obj is not None:
-            revy_obj = phase_norm(np.copy(est_obj) * recon_win, ref_obj * recon_win, cstr=recon_win)
-            err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
-            nrmse_obj.append(err_obj)
-        else:
-            revy_obj = est_obj 
-        if joint_recon:
-            if ref_probe is not None:
-                revy_probe = phase_norm(np.copy(est_probe), ref_probe)
-                err_probe = compute_nrmse(revy_probe, ref_probe)
-                nrmse_probe.append(err_probe)
-            else:
-                revy_probe = est_probe
-        else:
-            revy_probe = est_probe
-
-        # calculate error in measurement domain
-        est_patch = img2patch(est_obj, patch_bounds, y_meas.shape).astype(cdtype)
-        est_meas = np.abs(compute_ft(est_probe * est_patch))
-        nrmse_meas.append(compute_nrmse(est_meas, y_meas))
-
-    # # calculate time consumption
-    # print('Time consumption of {}:'.format(approach), time.time() - start_time)
-
-    # save recon results
-    if save_dir is not None:
-        save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
-        if nrmse_obj:
-            save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
-        if nrmse_meas:
-            save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
-        if joint_recon:
-            save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
-            if nrmse_probe:
-                save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    stop.start()
+    telemetry.start(approach, save_dir)
+    observer.start(approach)
+    stop_reason = None
+    # estimates returned if the checkpoint already reached num_iter
+    i = start_iter - 1
+    revy_obj, revy_probe = est_obj, est_probe
+    try:
+        for i in tqdm(range(start_iter, num_iter), initial=start_iter, total=num_iter):
+            with telemetry.phase('update'):
+                if in_place:
+                    # take projections into pre-allocated buffers
+                    fourier_proj(cur_frm, y_meas, fft_backend=fft, out=frm_f, executor=executor)
+                    space_projector(cur_frm, frm_probe, patch_op, img_wgt, img_sz, out=frm_s)
+                    space_projector(frm_f, frm_probe, patch_op, img_wgt, img_sz, out=frm_fs)
+                    # SHARP+ updates and swap buffers instead of copying
+                    est_frm = relax_in_place(cur_frm, frm_f, frm_s, frm_fs, relax_pm, sign=-1)
+                    cur_frm, frm_fs = est_frm, cur_frm
+                else:
+                    # take projections
+                    tmp_frm_f = fourier_proj(cur_frm, y_meas, fft_backend=fft, executor=executor)
+                    tmp_frm_s = space_projector(cur_frm, frm_probe, patch_op, img_wgt, img_sz)
+                    # SHARP+ updates 
+                    est_frm = 2 * relax_pm * space_projector(tmp_frm_f, frm_probe, patch_op, img_wgt, img_sz) + (1 - 2 * relax_pm) * tmp_frm_f - relax_pm * (tmp_frm_s - cur_frm)
+                    # update current estimate of frame data
+                    cur_frm = np.copy(est_frm)
+
+                # obtain estimate of complex object (the projections are no longer needed, so frm_s serves as workspace)
+                if in_place:
+                    est_obj = patch_op.patch2img(conj_product(est_frm, frm_probe, out=frm_s), img_wgt)
+                else:
+                    est_obj = patch_op.patch2img(est_frm * np.conj(frm_probe), img_wgt)
+            if joint_recon:
+                with telemetry.phase('probe_update'):
+                    # obtain estimate of complex probe
+                    if in_place:
+                        tmp_d = np.average(patch_op.img2patch((np.abs(est_obj) ** 2).astype(cdtype), out=frm_f), axis=0).real
+                    else:
+                        tmp_d = np.average(patch_op.img2patch(np.abs(est_obj) ** 2), axis=0)
+                    if refiner.refined:
+                        # the frames have shifted probes: correct est_probe by the residuals shifted back from the
+                        # subpixel positions (a least-squares step, whose fixed point is the consistent probe)
+                        obj_patch = patch_op.img2patch(est_obj)
+                        frm_n = shift_probe(np.conj(obj_patch) * (est_frm - obj_patch * frm_probe), -refiner.subpixel, fft)
+                        tmp_n = np.average(frm_n, axis=0)
+                        est_probe = est_probe + np.divide(tmp_n, tmp_d, out=np.zeros_like(tmp_n), where=(tmp_d!=0))
+                    else:
+                        if in_place:
+                            tmp_n = np.average(np.multiply(patch_op.img2patch(np.conj(est_obj), out=frm_s), est_frm, out=frm_s), axis=0)
+                        else:
+                            tmp_n = np.average(patch_op.img2patch(np.conj(est_obj)) * est_frm, axis=0)
+                        est_probe = np.divide(tmp_n, tmp_d, out=np.zeros_like(tmp_n), where=(tmp_d!=0))
+                    # update image weights
+                    frm_probe = refiner.frame_probe(est_probe, fft)
+                    img_wgt = patch_op.illumination_weight(frm_probe)
+            if refiner.due(i):
+                with telemetry.phase('positions'):
+                    # refine scan positions and update image weights
+                    patch_op = refiner.update(est_obj, est_probe, y_meas, fft)
+                    frm_probe = refiner.frame_probe(est_probe, fft)
+                    img_wgt = patch_op.illumination_weight(frm_probe)
+
+            # check stopping criterion (the plateau of err_meas is tested after its evaluation)
+            stop_reason = stop.check(i + 1, est_obj)
+            # notify the observer, which may request to stop
+            if observer.update(i + 1, est_obj, est_probe) and not stop_reason:
+                stop_reason = 'callback'
+
+            # evaluate convergence metrics according to metrics policy (and when stopping)
+            if metrics.due(i, num_iter) or stop_reason:
+                with telemetry.phase('metrics'):
+                    metric_iters.append(i + 1)
+                    # phase normalization and scale image to minimize the intensity difference
+                    if ref_obj is not None:
+                        revy_obj = phase_norm(est_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        nrmse_obj.append(err_obj)
+                    else:
+                        revy_obj = est_obj 
+                    if joint_recon:
+                        if ref_probe is not None:
+                            revy_probe = phase_norm(np.copy(est_probe), ref_probe)
+                            err_probe = compute_nrmse(revy_probe, ref_probe)
+                            nrmse_probe.append(err_probe)
+                        else:
+                            revy_probe = est_probe
+                    else:
+                        revy_probe = est_probe
+
+                    # calculate error in measurement domain
+                    nrmse_meas.append(meas_nrmse(est_obj, frm_probe, y_meas, patch_op, fft, frames=metrics.frames(len(y_meas))))
+                # test the plateau of err_meas with its new value
+                if not stop_reason:
+                    stop_reason = stop.check_meas(i + 1, nrmse_meas)
+
+            # save checkpoint of solver state
+            if checkpoint_every and (i + 1) % checkpoint_every == 0:
+                with telemetry.phase('io'):
+                    save_checkpoint(save_dir + 'checkpoint.h5', approach, i + 1, object=est_obj, probe=est_probe, cur_frm=cur_frm, positions=refiner.positions,
+                                    err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas, metric_iters=metric_iters)
+
+            telemetry.end_iteration(i + 1, metric_iters, err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas)
+
+            if stop_reason:
+                print('{} recon stopped after {} iterations ({}).'.format(approach, i + 1, stop_reason))
+                break
+
+        # # calculate time consumption
+        # print('Time consumption of {}:'.format(approach), time.time() - start_time)
+
+        # save recon results
+        with telemetry.phase('io'):
+            if save_dir is not None:
+                save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
+                if nrmse_obj:
+                    save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
+                if nrmse_meas:
+                    save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
+                if joint_recon:
+                    save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
+                    if nrmse_probe:
+                        save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    except BaseException:
+        stop_reason = 'error'
+        raise
+    finally:
+        observer.finish()
+        telemetry.close(stop_reason=stop_reason or 'num_iter')
 
     # return recon results
     print('{} recon completed.'.format(approach))
-    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas']
-    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas]
+    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas', 'metric_iters', 'num_iter', 'stop_reason']
+    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas, metric_iters, i + 1, stop_reason or 'num_iter']
     output = dict(zip(keys, vals))
+    if refiner.enabled:
+        output['positions'] = refiner.positions
 
     return output
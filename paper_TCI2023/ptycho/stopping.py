@@ -0,0 +1,92 @@
+import time
+import numpy as np
+
+
+'''
+This file defines the stopping criterion shared by the reconstruction engines. A reconstruction stops before
+num_iter when the object no longer changes, when the NRMSE in measurement domain has plateaued, or when its
+wall-clock budget is used up.
+'''
+
+
+class StoppingCriterion:
+    """Stopping criterion of the reconstruction engines.
+
+    Args:
+        obj_tol: stop when the relative change of the object between two iterations is below obj_tol.
+        meas_tol: stop when the relative decrease of err_meas over the last `patience` evaluations is below
+            meas_tol (requires err_meas to be evaluated, see metrics.MetricsPolicy).
+        patience: number of err_meas evaluations for the plateau test.
+        time_budget: stop when the wall-clock time of the reconstruction exceeds time_budget seconds.
+        min_iter: minimum number of iterations before the object and plateau tests apply.
+    """
+
+    def __init__(self, obj_tol=None, meas_tol=None, patience=5, time_budget=None, min_iter=1):
+        self.obj_tol = obj_tol
+        self.meas_tol = meas_tol
+        self.patience = patience
+        self.time_budget = time_budget
+        self.min_iter = min_iter
+        self._prev_obj = None
+        self._start_time = None
+
+    def start(self):
+        """Start the clock of the wall-clock budget and reset the previous object."""
+        self._prev_obj = None
+        self._start_time = time.time()
+
+    def check(self, iteration, est_obj):
+        """Check whether the reconstruction stops after the given iteration because of the object or the time.
+
+        Args:
+            iteration: number of completed iterations.
+            est_obj: current estimate of complex object.
+
+        Returns:
+            reason for stopping ('obj_tol' or 'time_budget'), or None to continue.
+        """
+        if self.time_budget is not None and time.time() - self._start_time > self.time_budget:
+            return 'time_budget'
+
+        if self.obj_tol is not None:
+            prev_obj, self._prev_obj = self._prev_obj, np.copy(est_obj)
+            if prev_obj is not None and iteration >= self.min_iter:
+                obj_change = np.linalg.norm(est_obj - prev_obj) / max(np.linalg.norm(est_obj), np.finfo(np.float32).tiny)
+                if obj_change < self.obj_tol:
+                    return 'obj_tol'
+
+        return None
+
+    def check_meas(self, iteration, err_meas):
+        """Check whether err_meas has plateaued, right after a new value was evaluated in the given iteration.
+
+        Args:
+            iteration: number of completed iterations.
+            err_meas: list of NRMSE values in measurement domain evaluated so far (ending with the new value).
+
+        Returns:
+            'meas_tol' for stopping, or None to continue.
+        """
+        if self.meas_tol is not None and len(err_meas) > self.patience and iteration >= self.min_iter:
+            if err_meas[-1 - self.patience] - err_meas[-1] < self.meas_tol * err_meas[-1 - self.patience]:
+                return 'meas_tol'
+
+        return None
+
+
+def get_stopping_criterion(stop=None):
+    """Resolve a stopping criterion.
+
+    Args:
+        stop: None (run all iterations), dictionary of StoppingCriterion arguments (e.g. from a config file)
+            or StoppingCriterion instance.
+
+    Returns:
+        StoppingCriterion instance.
+    """
+    if isinstance(stop, StoppingCriterion):
+        return stop
+    if stop is None:
+        return StoppingCriterion()
+
+    return StoppingCriterion(**stop)
@@ -0,0 +1,243 @@
+import os
+import glob
+import time
+import queue
+import threading
+import numpy as np
+import tifffile
+from paper_TCI2023.ptycho_pmace.pmace.utils import *
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.meas_store import read_translations
+from paper_TCI2023.ptycho.pie import epie_update, epie_recon
+from paper_TCI2023.ptycho.precision import get_precision
+
+
+'''
+This file defines the streaming ePIE reconstruction, which consumes (frame, position) pairs while the scan is
+still running. The object canvas grows with the scanned area, updates are interleaved over the frames seen so
+far, and snapshots of the current object are published at a fixed rate. A directory watcher and a simulated
+detector provide the frames.
+'''
+
+
+def watch_directory(data_dir, poll_interval=1.0, timeout=60.0):
+    """Yield the frames and scan positions of a running scan as they are written to disk.
+
+    Frame files in 'frame_data/' are matched in sorted order with the rows of 'Translations.tsv.txt'. Files that
+    can not be read yet (e.g. while they are being written) are retried at the next poll.
+
+    Args:
+        data_dir: directory containing 'frame_data/' and 'Translations.tsv.txt'.
+        poll_interval: time between two polls in seconds.
+        timeout: stop after this many seconds without new frames.
+
+    Yields:
+        (frame, position) pairs.
+    """
+    num_seen = 0
+    last_frame_time = time.time()
+    while time.time() - last_frame_time < timeout:
+        fnames = sorted(glob.glob(os.path.join(data_dir, 'frame_data', '*.tif*')))
+        try:
+            positions = read_translations(os.path.join(data_dir, 'Translations.tsv.txt'))
+        except (OSError, ValueError, KeyError):
+            positions = np.zeros((0, 2))
+        while num_seen < min(len(fnames), len(positions)):
+            try:
+                frame = tifffile.imread(fnames[num_seen])
+            except (OSError, ValueError):
+                break
+            yield frame, positions[num_seen]
+            num_seen += 1
+            last_frame_time = time.time()
+        time.sleep(poll_interval)
+
+
+def simulate_detector(y_meas, positions, frame_rate=None):
+    """Yield recorded frames and scan positions one by one, as a stand-in for the detector.
+
+    Args:
+        y_meas: recorded frames.
+        positions: scan positions of the frames.
+        frame_rate: frames per second (None yields the frames without delay).
+
+    Yields:
+        (frame, position) pairs.
+    """
+    for frame, position in zip(y_meas, positions):
+        if frame_rate is not None:
+            time.sleep(1 / frame_rate)
+        yield frame, position
+
+
+def feed_queue(frame_source, maxsize=0):
+    """Move (frame, position) pairs from an iterator to a queue in a background thread.
+
+    The reconstruction then keeps updating over the frames seen so far while it waits for new frames.
+
+    Args:
+        frame_source: iterator of (frame, position) pairs (e.g. watch_directory).
+        maxsize: maximum size of the queue (0 for unbounded).
+
+    Returns:
+        queue receiving the pairs, followed by None at the end of the stream.
+    """
+    frame_queue = queue.Queue(maxsize=maxsize)
+
+    def worker():
+        for item in frame_source:
+            frame_queue.put(item)
+        frame_queue.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    return frame_queue
+
+
+class Canvas:
+    """Complex object on a canvas that grows on demand.
+
+    Positions are global pixel coordinates, and the canvas stores the global coordinate of its first pixel.
+
+    Args:
+        init_value: value of newly added pixels.
+        margin: minimum number of pixels added on a side when the canvas grows.
+        dtype: complex dtype of the object.
+    """
+
+    def __init__(self, init_value=1, margin=0, dtype=np.complex64):
+        self.init_value = init_value
+        self.margin = margin
+        self.dtype = dtype
+        self.origin = None
+        self.img = None
+
+    def fit(self, lower, upper):
+        """Grow the canvas to contain the global pixel range [lower, upper)."""
+        lower, upper = np.asarray(lower), np.asarray(upper)
+        if self.img is None:
+            self.origin = lower - self.margin
+            self.img = np.full(tuple(upper - lower + 2 * self.margin), self.init_value, dtype=self.dtype)
+            return
+        end = self.origin + np.array(self.img.shape)
+        if np.all(lower >= self.origin) and np.all(upper <= end):
+            return
+        new_origin = np.where(lower < self.origin, lower - self.margin, self.origin)
+        new_end = np.where(upper > end, upper + self.margin, end)
+        img = np.full(tuple(new_end - new_origin), self.init_value, dtype=self.dtype)
+        offset = self.origin - new_origin
+        img[offset[0]:offset[0] + self.img.shape[0], offset[1]:offset[1] + self.img.shape[1]] = self.img
+        self.origin, self.img = new_origin, img
+
+    def local_bounds(self, bounds):
+        """Convert global scan coordinates to coordinates on the canvas."""
+        return np.asarray(bounds) - np.repeat(self.origin, 2)
+
+
+def stream_epie_recon(frame_source, init_probe, obj_step_sz=0.5, probe_step_sz=0.5, joint_recon=False,
+                      updates_per_frame=4, window=None, init_value=1, snapshot_interval=5.0, on_snapshot=None,
+                      final_iter=0, save_dir=None, fft_backend=None, seed=0, precision=None):
+    """Streaming ePIE.
+
+    Function to reconstruct the object while frames arrive. Every new frame is used for one ePIE update, followed
+    by updates_per_frame updates on randomly chosen frames seen so far. If the source is a queue, these updates
+    also continue while no new frame is available. After the stream ends, final_iter iterations of epie_recon run
+    on all frames. A stream that ends before its first frame (e.g. a directory watcher timing out) raises ValueError.
+
+    Args:
+        frame_source: iterator or queue of (frame, position) pairs, where position is the (row, col) of the frame
+            center in object pixels. A queue ends with None.
+        init_probe: complex probe (initial guess if joint_recon).
+        obj_step_sz: step size of object update function.
+        probe_step_sz: step size of probe update function.
+        joint_recon: option to estimate complex probe for blind ptychography.
+        updates_per_frame: number of updates on previously seen frames per new frame (or per idle poll).
+        window: optional window multiplied with every frame (e.g. a Tukey window).
+        init_value: initial value of the object.
+        snapshot_interval: time between two snapshots in seconds.
+        on_snapshot: function on_snapshot(est_obj, est_probe, num_frames) called with every snapshot.
+        final_iter: number of epie_recon iterations on all frames after the stream ends.
+        save_dir: directory to save snapshots and reconstruction results.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        seed: random seed for choosing the frames of the interleaved updates.
+        precision: precision policy (see precision.get_precision).
+
+    Returns:
+        Reconstructed complex images, the collected frames ('y_meas') and their scan coordinates on the final
+        canvas ('patch_bounds').
+    """
+    prec = get_precision(precision)
+    fft = get_fft_backend(fft_backend)
+    rng = np.random.default_rng(seed)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    est_probe = np.copy(init_probe).astype(prec.cdtype)
+    frm_shape = np.array(est_probe.shape)
+    canvas = Canvas(init_value=init_value, margin=int(np.amax(frm_shape)), dtype=prec.cdtype)
+    frames, global_bounds = [], []
+    num_snapshots, last_snapshot = 0, time.time()
+
+    def update(j):
+        r0, r1, c0, c1 = canvas.local_bounds(global_bounds[j])
+        epie_update(canvas.img, est_probe, np.s_[r0:r1, c0:c1], frames[j], obj_step_sz, probe_step_sz, joint_recon, fft)
+
+    def publish():
+        if on_snapshot is not None:
+            on_snapshot(canvas.img, est_probe, len(frames))
+        if save_dir is not None:
+            save_tiff(canvas.img, save_dir + 'snapshot_{:04d}.tiff'.format(num_snapshots))
+
+    print('Streaming ePIE recon starts ...')
+    is_queue = isinstance(frame_source, queue.Queue)
+    frame_iter = None if is_queue else iter(frame_source)
+    while True:
+        # receive the next frame (a queue is polled, so that idle time is used for updates on seen frames)
+        if is_queue:
+            try:
+                item = frame_source.get(timeout=0.01)
+            except queue.Empty:
+                if frames:
+                    for j in rng.integers(0, len(frames), updates_per_frame):
+                        update(j)
+                item = False
+        else:
+            item = next(frame_iter, None)
+        if item is None:
+            break
+
+        if item is not False:
+            # place the new frame on the canvas and update with it first
+            frame, position = item
+            frame = prec.real(frame) if window is None else prec.real(frame * window)
+            lower = np.round(np.asarray(position) - frm_shape / 2).astype(int)
+            canvas.fit(lower, lower + frm_shape)
+            frames.append(frame)
+            global_bounds.append([lower[0], lower[0] + frm_shape[0], lower[1], lower[1] + frm_shape[1]])
+            update(len(frames) - 1)
+            # interleave updates over the frames seen so far
+            for j in rng.integers(0, len(frames), updates_per_frame):
+                update(j)
+
+        # publish snapshot of current object (once the canvas holds a frame)
+        if frames and time.time() - last_snapshot >= snapshot_interval:
+            publish()
+            num_snapshots, last_snapshot = num_snapshots + 1, time.time()
+
+    print('Stream ended after {} frames.'.format(len(frames)))
+    if not frames:
+        raise ValueError('No frames received from the frame source.')
+    publish()
+
+    # refine with all frames
+    y_meas = np.asarray(frames)
+    patch_bounds = canvas.local_bounds(global_bounds)
+    if final_iter > 0:
+        output = epie_recon(y_meas, patch_bounds, canvas.img, init_probe=est_probe, ref_probe=None if joint_recon else est_probe,
+                            num_iter=final_iter, joint_recon=joint_recon, save_dir=save_dir, obj_step_sz=obj_step_sz,
+                            probe_step_sz=probe_step_sz, fft_backend=fft, precision=prec)
+    else:
+        output = dict(object=canvas.img, probe=est_probe)
+    output.update(y_meas=y_meas, patch_bounds=patch_bounds)
+
+    return output
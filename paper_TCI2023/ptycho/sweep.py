@@ -0,0 +1,124 @@
+import os
+import inspect
+
+
+'''
+This file defines the hyperparameter sweep of the reconstruction engines. Trials run in parallel on the local
+cores with ray tune, share the measurements through the ray object store, and bad trials are stopped early
+by successive halving (ASHA) on their convergence curves. ray, ray tune and hyperopt are optional dependencies
+(pip install .[sweep]), imported only when a sweep runs.
+'''
+
+
+def build_search_space(param_ranges):
+    """Convert parameter ranges from a config file to a ray tune search space.
+
+    Args:
+        param_ranges: dictionary mapping keyword arguments of the engine to either a fixed value or a
+            single-entry dictionary {distribution: arguments}, e.g. {'uniform': [0.3, 1.0]},
+            {'loguniform': [0.01, 1]}, {'choice': [1, 2, 4]} or {'grid_search': [0.5, 0.6, 0.7]}.
+
+    Returns:
+        ray tune search space.
+    """
+    from ray import tune
+
+    space = {}
+    for name, spec in param_ranges.items():
+        if isinstance(spec, dict):
+            (dist, args), = spec.items()
+            space[name] = getattr(tune, dist)(args) if dist in ['choice', 'grid_search'] else getattr(tune, dist)(*args)
+        else:
+            space[name] = spec
+
+    return space
+
+
+def get_milestones(num_iter, grace_iter, reduction_factor):
+    """Return the iterations at which trials report, matching the rungs of successive halving."""
+    milestones = []
+    milestone = grace_iter
+    while milestone < num_iter:
+        milestones.append(milestone)
+        milestone *= reduction_factor
+
+    return milestones + [num_iter]
+
+
+def _run_trial(config, func=None, data=None, fixed_args=None, num_iter=100, milestones=None, metric='err_meas'):
+    """Run one trial and report its metric at every milestone.
+
+    Engines supporting checkpoints continue from the checkpoint of the previous milestone, other engines
+    (e.g. PMACE) are restarted with more iterations.
+    """
+    from ray.air import session
+
+    y_meas, patch_bounds = data
+    kwargs = dict(fixed_args, **config)
+    trial_dir = os.path.join(session.get_trial_dir(), '')
+    resumable = 'resume_from' in inspect.signature(func).parameters
+    checkpoint_fname = trial_dir + 'checkpoint.h5'
+
+    for start, end in zip([0] + milestones[:-1], milestones):
+        if resumable:
+            result = func(y_meas, patch_bounds, num_iter=end, save_dir=trial_dir, checkpoint_every=end,
+                          resume_from=checkpoint_fname if start > 0 else None, **kwargs)
+        else:
+            result = func(y_meas, patch_bounds, num_iter=end, **kwargs)
+        session.report({metric: float(result[metric][-1]), 'iteration': end})
+
+
+def run_sweep(func, param_ranges, y_meas, patch_bounds, fixed_args=None, num_iter=100, metric='err_meas',
+              num_samples=20, search='hyperopt', grace_iter=10, reduction_factor=3, num_cpus=None,
+              save_dir=None, name='sweep'):
+    """Sweep the hyperparameters of a reconstruction engine.
+
+    Args:
+        func: reconstruction function func(y_meas, patch_bounds, **kwargs) returning a result dictionary,
+            e.g. sharp.sharp_recon, pie.epie_recon or pmace_recon.
+        param_ranges: parameter ranges of func (see build_search_space).
+        y_meas: pre-processed measurements.
+        patch_bounds: scan coordinates of projections.
+        fixed_args: keyword arguments of func shared by all trials (e.g. init_obj, ref_obj).
+        num_iter: number of iterations of the full trials.
+        metric: convergence curve used to rank and early-stop trials ('err_meas' or 'err_obj').
+        num_samples: number of sampled configurations (repetitions of the grid for grid search).
+        search: 'hyperopt' for Bayesian optimization, 'random' for random/grid search.
+        grace_iter: number of iterations every trial runs before it can be stopped.
+        reduction_factor: fraction 1/reduction_factor of the trials is promoted at every milestone.
+        num_cpus: number of local cores used for the trials (defaults to all cores).
+        save_dir: directory of the trial outputs and the summary of the sweep.
+        name: name of the sweep.
+
+    Returns:
+        best configuration and data frame of all trials.
+    """
+    import ray
+    from ray import tune
+    from ray.air import RunConfig
+    from ray.tune.schedulers import ASHAScheduler
+    from ray.tune.search.hyperopt import HyperOptSearch
+
+    if not ray.is_initialized():
+        ray.init(num_cpus=num_cpus)
+    save_dir = os.path.abspath(save_dir if save_dir is not None else os.path.join('.', 'sweep'))
+
+    # measurements are put in the object store once and read without copying by all trials
+    milestones = get_milestones(num_iter, grace_iter, reduction_factor)
+    trainable = tune.with_parameters(_run_trial, func=func, data=(y_meas, patch_bounds), fixed_args=fixed_args or {},
+                                     num_iter=num_iter, milestones=milestones, metric=metric)
+    scheduler = ASHAScheduler(time_attr='iteration', max_t=num_iter, grace_period=grace_iter,
+                              reduction_factor=reduction_factor)
+    search_alg = HyperOptSearch() if search == 'hyperopt' else None
+    tuner = tune.Tuner(tune.with_resources(trainable, {'cpu': 1}), param_space=build_search_space(param_ranges),
+                       tune_config=tune.TuneConfig(metric=metric, mode='min', num_samples=num_samples,
+                                                   scheduler=scheduler, search_alg=search_alg),
+                       run_config=RunConfig(name=name, local_dir=save_dir))
+    results = tuner.fit()
+
+    # summary of the sweep
+    trials = results.get_dataframe()
+    trials.to_csv(os.path.join(save_dir, name + '.csv'), index=False)
+    best_config = results.get_best_result().config
+
+    return best_config, trials
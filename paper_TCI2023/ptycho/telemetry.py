@@ -0,0 +1,247 @@
+import os
+import copy
+import json
+import time
+import resource
+import functools
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from paper_TCI2023.ptycho.fft_backend import FFTBackend
+
+
+'''
+This file defines the iteration telemetry of the reconstruction engines. The engines time named phases of every
+iteration and report them, together with the peak memory, to a callback and/or a JSONL log. FFTs and patch
+operations are timed by wrapping the FFT backend and the PatchOperator of a reconstruction, so that the engines
+run unchanged code when telemetry is disabled.
+'''
+
+
+class PhaseTimer:
+    """Accumulate the exclusive run time of timed code per phase.
+
+    Time spent in a nested timed call is counted for the inner phase, except inside the inclusive phases, which
+    also take the time of their nested calls (e.g. the FFTs of a metric count as 'metrics'). Timed calls in other
+    threads than the one that created or reset the timer (e.g. the FFTs of a frame-parallel executor) are not
+    timed separately and count for the enclosing phase of that thread.
+
+    Args:
+        inclusive: phases including the time of nested timed calls.
+    """
+
+    def __init__(self, inclusive=('metrics',)):
+        self.inclusive = inclusive
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._stack = []
+        self._inclusive_depth = 0
+        self._owner = threading.get_ident()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager counting the run time of its body for phase name."""
+        if self._inclusive_depth > 0 or threading.get_ident() != self._owner:
+            yield
+            return
+        is_inclusive = name in self.inclusive
+        self._inclusive_depth += is_inclusive
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            self._inclusive_depth -= is_inclusive
+            self.totals[name] += elapsed - nested
+            self.counts[name] += 1
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def wrap(self, name, func):
+        """Return func timed for phase name."""
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+
+        return timed
+
+    def reset(self):
+        """Clear the accumulated times and counts."""
+        self.totals.clear()
+        self.counts.clear()
+        self._owner = threading.get_ident()
+
+
+class TimedFFT(FFTBackend):
+    """FFT backend timing the forward and inverse transforms of another backend as phases 'fft' and 'ifft'."""
+
+    def __init__(self, backend, timer):
+        self.name = backend.name
+        self.ft = timer.wrap('fft', backend.ft)
+        self.ift = timer.wrap('ifft', backend.ift)
+
+
+class Telemetry:
+    """Iteration telemetry of a reconstruction.
+
+    After every iteration a record with the iteration number, its wall-clock time, the exclusive time per phase,
+    the peak resident set size and the metrics evaluated in this iteration is passed to callback and appended to
+    the JSONL log. A final record summarizes the reconstruction (including the I/O after the last iteration).
+
+    Args:
+        save_dir: directory of the log file (defaults to the save_dir of the engine, None without log file).
+        callback: function callback(record) called with every record.
+        track_allocations: also record the peak of memory allocated through Python per iteration (tracemalloc,
+            which slows down the reconstruction).
+        log_name: name of the log file.
+    """
+    enabled = True
+
+    def __init__(self, save_dir=None, callback=None, track_allocations=False, log_name='telemetry.jsonl'):
+        self.save_dir = save_dir
+        self.callback = callback
+        self.track_allocations = track_allocations
+        self.log_name = log_name
+        self.timer = PhaseTimer()
+        self.approach = None
+        self._log = None
+
+    def start(self, approach, save_dir=None):
+        """Start the telemetry of a reconstruction.
+
+        Args:
+            approach: name of the reconstruction approach.
+            save_dir: save_dir of the engine, used if no directory was given to the constructor.
+        """
+        self.approach = approach
+        self.timer.reset()
+        self._totals = defaultdict(float)
+        self._num_iter = 0
+        log_dir = self.save_dir if self.save_dir is not None else save_dir
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            self._log = open(os.path.join(log_dir, self.log_name), 'a')
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._start_time = self._iter_start = time.perf_counter()
+
+    def phase(self, name):
+        """Context manager timing its body as phase name."""
+        return self.timer.phase(name)
+
+    def wrap(self, name, func):
+        """Return func timed as phase name."""
+        return self.timer.wrap(name, func)
+
+    def wrap_fft(self, fft):
+        """Return the FFT backend timed as phases 'fft' and 'ifft'."""
+        return TimedFFT(fft, self.timer)
+
+    def wrap_patch_op(self, patch_op):
+        """Return a copy of a PatchOperator timing its patch extraction ('gather') and summation ('scatter')."""
+        patch_op = copy.copy(patch_op)
+        patch_op.img2patch = self.timer.wrap('gather', patch_op.img2patch)
+        patch_op.patch2img = self.timer.wrap('scatter', patch_op.patch2img)
+
+        return patch_op
+
+    def _emit(self, record):
+        if self.callback is not None:
+            self.callback(record)
+        if self._log is not None:
+            self._log.write(json.dumps(record) + '\n')
+            self._log.flush()
+
+    def end_iteration(self, iteration, metric_iters, **history):
+        """Emit the record of an iteration.
+
+        Args:
+            iteration: number of completed iterations.
+            metric_iters: iterations at which metrics were evaluated.
+            **history: metric histories (e.g. err_obj=nrmse_obj); their last values are reported if the metrics
+                were evaluated in this iteration.
+        """
+        now = time.perf_counter()
+        record = dict(approach=self.approach, iteration=iteration, time_s=now - self._iter_start,
+                      phases_s=dict(self.timer.totals), max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+        if self.track_allocations:
+            record['alloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.reset_peak()
+        if len(metric_iters) > 0 and metric_iters[-1] == iteration:
+            record.update({key: float(val[-1]) for key, val in history.items() if len(val) > 0})
+        for key, val in self.timer.totals.items():
+            self._totals[key] += val
+        self._num_iter += 1
+        self.timer.reset()
+        self._emit(record)
+        self._iter_start = time.perf_counter()
+
+    def close(self, **summary):
+        """Emit the summary record and close the log.
+
+        Args:
+            **summary: further entries of the summary record (e.g. the stop reason).
+        """
+        for key, val in self.timer.totals.items():
+            self._totals[key] += val
+        self.timer.reset()
+        self._emit(dict(approach=self.approach, event='end', num_iter=self._num_iter, time_s=time.perf_counter() - self._start_time,
+                        phases_s=dict(self._totals), max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, **summary))
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class NullTelemetry:
+    """Disabled telemetry with no-op methods."""
+    enabled = False
+    _null_context = nullcontext()
+
+    def start(self, approach, save_dir=None):
+        pass
+
+    def phase(self, name):
+        return self._null_context
+
+    def wrap(self, name, func):
+        return func
+
+    def wrap_fft(self, fft):
+        return fft
+
+    def wrap_patch_op(self, patch_op):
+        return patch_op
+
+    def end_iteration(self, iteration, metric_iters, **history):
+        pass
+
+    def close(self, **summary):
+        pass
+
+
+def get_telemetry(telemetry=None):
+    """Resolve the telemetry of a reconstruction.
+
+    Args:
+        telemetry: None or False (disabled), True (JSONL log in the save_dir of the engine), callback function,
+            dictionary of keyword arguments of Telemetry, or Telemetry instance.
+
+    Returns:
+        Telemetry or NullTelemetry instance.
+    """
+    if telemetry is None or telemetry is False:
+        return NullTelemetry()
+    if isinstance(telemetry, (Telemetry, NullTelemetry)):
+        return telemetry
+    if telemetry is True:
+        return Telemetry()
+    if callable(telemetry):
+        return Telemetry(callback=telemetry)
+    if isinstance(telemetry, dict):
+        return Telemetry(**telemetry)
+
+    raise ValueError('Invalid telemetry setting: {}'.format(telemetry))
@@ -0,0 +1,262 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from paper_TCI2023.ptycho_pmace.pmace.utils import *
+from paper_TCI2023.ptycho_pmace.pmace.nrmse import *
+from paper_TCI2023.ptycho.meas_store import open_measurement
+from paper_TCI2023.ptycho.patch_ops import PatchOperator
+from paper_TCI2023.ptycho.precision import get_precision
+from paper_TCI2023.ptycho.runner import share_array, attach_array
+
+
+'''
+This file defines the tiled (domain decomposition) reconstruction for large fields of view. The scan is split
+into overlapping spatial tiles that are reconstructed independently by worker processes, and the tile objects
+are phase-aligned and blended into the full object after every outer iteration. A worker only holds the frames
+and the object of its tile.
+'''
+
+
+def partition_scan(patch_bounds, tile_size, overlap=0):
+    """Partition the scan positions into overlapping spatial tiles.
+
+    A frame belongs to every tile whose core region, extended by overlap pixels, contains the frame center.
+
+    Args:
+        patch_bounds: scan coordinates of projections.
+        tile_size: side length of the tile cores in object pixels.
+        overlap: extension of the tile cores in object pixels.
+
+    Returns:
+        list of tiles, each a dictionary with the frame indices ('frames'), the tile origin in the full object
+        ('origin'), the tile shape ('shape') and the scan coordinates relative to the tile ('bounds').
+    """
+    patch_bounds = np.asarray(patch_bounds)
+    centers = (patch_bounds[:, [0, 2]] + patch_bounds[:, [1, 3]]) / 2
+    lower = np.amin(centers, axis=0)
+    num_tiles = np.ceil((np.amax(centers, axis=0) - lower + 1) / tile_size).astype(int)
+
+    tiles = []
+    for tile_row in range(num_tiles[0]):
+        for tile_col in range(num_tiles[1]):
+            core = lower + np.array([tile_row, tile_col]) * tile_size
+            inside = np.all((centers >= core - overlap) & (centers < core + tile_size + overlap), axis=1)
+            frames = np.flatnonzero(inside)
+            if len(frames) == 0:
+                continue
+            bounds = patch_bounds[frames]
+            origin = np.amin(bounds[:, [0, 2]], axis=0)
+            shape = np.amax(bounds[:, [1, 3]], axis=0) - origin
+            tiles.append(dict(frames=frames, origin=tuple(origin), shape=tuple(shape),
+                              bounds=bounds - np.repeat(origin, 2)))
+
+    return tiles
+
+
+def _tile_slice(tile):
+    return tuple(slice(o, o + n) for o, n in zip(tile['origin'], tile['shape']))
+
+
+def _recon_tile(recon_func, source, frames, bounds, tile_obj, kwargs, meas_window=None):
+    """Reconstruct one tile in a worker process from the shared measurements or a measurement store."""
+    if isinstance(source, str):
+        store = open_measurement(source, window=meas_window)
+        try:
+            y_tile = store[frames]
+        finally:
+            store.close()
+    else:
+        shm, y_meas = attach_array(source)
+        try:
+            y_tile = y_meas[frames]
+        finally:
+            del y_meas
+            shm.close()
+
+    return recon_func(y_tile, bounds, tile_obj, **kwargs)
+
+
+def align_phase(tile_obj, ref_obj, weight):
+    """Return the unit complex factor that aligns the global phase of tile_obj to ref_obj."""
+    inner = np.sum(weight * np.conj(tile_obj) * ref_obj)
+
+    return inner / np.abs(inner) if np.abs(inner) > 0 else 1
+
+
+def stitch_tiles(prev_obj, tiles, tile_objs, tile_wgts):
+    """Stitch tile objects into the full object.
+
+    Tiles are processed in order. Every tile is phase-aligned to the part of the object already stitched in its
+    overlap region (or to the previous object if there is no overlap yet) and blended with its illumination weight.
+
+    Args:
+        prev_obj: previous estimate of the full object (kept where no tile has weight).
+        tiles: list of tiles (see partition_scan).
+        tile_objs: list of reconstructed tile objects.
+        tile_wgts: list of blending weights of the tiles.
+
+    Returns:
+        stitched full object.
+    """
+    acc_obj = np.zeros(prev_obj.shape, dtype=np.complex128)
+    acc_wgt = np.zeros(prev_obj.shape)
+    for tile, tile_obj, tile_wgt in zip(tiles, tile_objs, tile_wgts):
+        region = _tile_slice(tile)
+        overlap_wgt = np.minimum(acc_wgt[region], tile_wgt)
+        if np.any(overlap_wgt > 0):
+            stitched = acc_obj[region] / np.where(acc_wgt[region] > 0, acc_wgt[region], 1)
+            phase = align_phase(tile_obj, stitched, overlap_wgt)
+        else:
+            phase = align_phase(tile_obj, prev_obj[region], tile_wgt)
+        acc_obj[region] += tile_wgt * phase * tile_obj
+        acc_wgt[region] += tile_wgt
+
+    output = np.copy(prev_obj)
+    output[acc_wgt > 0] = acc_obj[acc_wgt > 0] / acc_wgt[acc_wgt > 0]
+
+    return output.astype(prev_obj.dtype)
+
+
+def tiled_recon(y_meas, patch_bounds, init_obj, recon_func, tile_size=512, overlap=64, outer_iter=10,
+                inner_iter=10, init_probe=None, ref_obj=None, ref_probe=None, joint_recon=False, recon_win=None,
+                save_dir=None, num_workers=None, meas_window=None, precision=None, **kwargs):
+    """Tiled reconstruction.
+
+    Function to reconstruct a large field of view tile by tile. Every outer iteration runs inner_iter iterations
+    of recon_func on all tiles in parallel, starting from the current full object, and stitches the results.
+
+    Every outer iteration restarts recon_func from the stitched object and the current probe, so the internal
+    state of the engine is not carried across stitches (e.g. the frame estimates and relaxation of SHARP, the
+    previous estimates of AWF, the scan order of ePIE). inner_iter should be long enough for the engine to
+    converge from such a restart.
+
+    The memory of the main process is bounded by a tile only if y_meas is the path of a measurement store. In-memory
+    measurements are copied once into shared memory for the worker processes (num_workers > 1), in addition to
+    the array held by the caller.
+
+    Args:
+        y_meas: pre-processed measurements, or path to a measurement store (see meas_store) from which the workers
+            read only the frames of their tiles.
+        patch_bounds: scan coordinates of projections.
+        init_obj: formulated initial guess of complex object.
+        recon_func: reconstruction engine, e.g. sharp.sharp_recon, pie.epie_recon or wf.wf_recon.
+        tile_size: side length of the tile cores in object pixels.
+        overlap: extension of the tile cores in object pixels.
+        outer_iter: number of outer (stitching) iterations (at least 1).
+        inner_iter: number of iterations of recon_func per tile and outer iteration.
+        init_probe: formulated initial guess of complex probe.
+        ref_obj: complex reference image for object.
+        ref_probe: complex reference image for probe.
+        joint_recon: option to estimate complex probe for blind ptychography (tile probes are averaged).
+        recon_win: pre-defined window for showing and comparing reconstruction results.
+        save_dir: directory to save reconstruction results.
+        num_workers: number of worker processes (defaults to the number of tiles). 1 reconstructs the tiles in the
+            current process, one after another.
+        meas_window: optional window applied to the frames read from a measurement store.
+        precision: precision policy (see precision.get_precision), also passed to recon_func.
+        **kwargs: further keyword arguments of recon_func.
+
+    Returns:
+        Reconstructed complex images and NRMSE between reconstructions and reference images.
+    """
+    approach = 'tiled'
+    if outer_iter < 1:
+        raise ValueError('Invalid number of outer iterations: {}'.format(outer_iter))
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+    prec = get_precision(precision)
+    recon_win = prec.real(recon_win) if recon_win is not None else np.ones(init_obj.shape, dtype=prec.rdtype)
+
+    nrmse_obj = []
+    nrmse_probe = []
+    nrmse_meas = []
+    metric_iters = []
+
+    tiles = partition_scan(patch_bounds, tile_size, overlap=overlap)
+    num_workers = len(tiles) if num_workers is None else num_workers
+    if isinstance(y_meas, str):
+        store = open_measurement(y_meas)
+        frm_shape = store.shape[1:]
+        store.close()
+        source, shm = y_meas, None
+    else:
+        frm_shape = y_meas.shape[1:]
+        shm, source = share_array(y_meas, dtype=prec.rdtype) if num_workers > 1 else (None, None)
+        if shm is not None:
+            print('Tiled recon shares a copy of the in-memory measurements ({:.3g} GB) with the workers; pass the '
+                  'path of a measurement store to bound the memory to a tile.'.format(shm.size / 2 ** 30))
+
+    est_obj = prec.complex(init_obj)
+    est_probe = prec.complex(init_probe if joint_recon else ref_probe)
+    print('Tiled recon with {} tiles of {} to {} frames.'.format(len(tiles), min(len(t['frames']) for t in tiles),
+                                                                   max(len(t['frames']) for t in tiles)))
+
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        for i in range(outer_iter):
+            # reconstruct the tiles from the current estimates (without reference images, so that the tile
+            # objects are neither phase-normalized nor windowed)
+            tile_args = [dict(init_probe=est_probe, ref_probe=None if joint_recon else est_probe, num_iter=inner_iter,
+                              joint_recon=joint_recon, precision=prec, **kwargs) for _ in tiles]
+            if executor is not None:
+                futures = [executor.submit(_recon_tile, recon_func, source, tile['frames'], tile['bounds'],
+                                           est_obj[_tile_slice(tile)], args, meas_window) for tile, args in zip(tiles, tile_args)]
+                results = [future.result() for future in futures]
+            elif isinstance(y_meas, str):
+                results = [_recon_tile(recon_func, y_meas, tile['frames'], tile['bounds'], est_obj[_tile_slice(tile)],
+                                       args, meas_window) for tile, args in zip(tiles, tile_args)]
+            else:
+                results = [recon_func(y_meas[tile['frames']], tile['bounds'], est_obj[_tile_slice(tile)], **args)
+                           for tile, args in zip(tiles, tile_args)]
+
+            # blend the tiles with their illumination weights
+            tile_wgts = [np.abs(PatchOperator(tile['bounds'], tile['shape'], (len(tile['frames']),) + tuple(frm_shape))
+                                .illumination_weight(result['probe'])) for tile, result in zip(tiles, results)]
+            est_obj = stitch_tiles(est_obj, tiles, [result['object'] for result in results], tile_wgts)
+            if joint_recon:
+                # average the tile probes after aligning their phases to the current probe
+                est_probe = np.average([align_phase(result['probe'], est_probe, 1) * result['probe'] for result in results],
+                                       axis=0, weights=[len(tile['frames']) for tile in tiles]).astype(prec.cdtype)
+
+            # evaluate convergence metrics
+            metric_iters.append((i + 1) * inner_iter)
+            if ref_obj is not None:
+                revy_obj = phase_norm(est_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                nrmse_obj.append(compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win))
+            else:
+                revy_obj = est_obj
+            if joint_recon and ref_probe is not None:
+                revy_probe = phase_norm(np.copy(est_probe), ref_probe)
+                nrmse_probe.append(compute_nrmse(revy_probe, ref_probe))
+            else:
+                revy_probe = est_probe
+            # NRMSE in measurement domain combined from the tiles (frames in overlaps count once per tile)
+            tile_frames = np.array([len(tile['frames']) for tile in tiles])
+            nrmse_meas.append(np.sqrt(np.average([result['err_meas'][-1] ** 2 for result in results], weights=tile_frames)))
+            print('Outer iteration {}/{}: err_meas {:.4g}.'.format(i + 1, outer_iter, nrmse_meas[-1]))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    # save recon results
+    if save_dir is not None:
+        save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(outer_iter * inner_iter))
+        if nrmse_obj:
+            save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
+        if nrmse_meas:
+            save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
+        if joint_recon:
+            save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(outer_iter * inner_iter))
+            if nrmse_probe:
+                save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+
+    # return recon results
+    print('{} recon completed.'.format(approach))
+    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas', 'metric_iters', 'num_iter']
+    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas, metric_iters, outer_iter * inner_iter]
+    output = dict(zip(keys, vals))
+
+    return output
@@ -2,9 +2,81 @@ import time
 from tqdm import tqdm
 from paper_TCI2023.ptycho_pmace.pmace.utils import *
 from paper_TCI2023.ptycho_pmace.pmace.nrmse import *
+from paper_TCI2023.ptycho.checkpoint import save_checkpoint, load_checkpoint, HISTORY_KEYS
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.metrics import get_metrics_policy, meas_nrmse, ft_nrmse
+from paper_TCI2023.ptycho.observers import get_observer
+from paper_TCI2023.ptycho.parallel import get_frame_executor
+from paper_TCI2023.ptycho.patch_ops import get_patch_operator
+from paper_TCI2023.ptycho.precision import get_precision
+from paper_TCI2023.ptycho.projection import replace_magnitude
+from paper_TCI2023.ptycho.stopping import get_stopping_criterion
+from paper_TCI2023.ptycho.telemetry import get_telemetry
 
 
-def wf_obj_func(cur_est, probe, y_meas, patch_bounds, discretized_sys_mat, prm=1):
+def wf_residual(patch, probe, y_meas, fft_backend=None, executor=None):
+    """Fourier residual function.
+
+    Function to calculate the Fourier transform of the frame data and the inverse Fourier transform of the residual
+    of the amplitude loss, chunk by chunk of frames.
+
+    Args:
+        patch: projected image patches.
+        probe: complex probe.
+        y_meas: pre-processed measurements.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        executor: frame-parallel executor (see parallel.get_frame_executor).
+
+    Returns:
+        Fourier transform of the frame data and inverse Fourier transform of the residual.
+    """
+    fft = get_fft_backend(fft_backend)
+    executor = get_frame_executor(executor)
+    f_tmp = np.empty(patch.shape, dtype=np.result_type(patch, probe))
+    inv_f = np.empty_like(f_tmp)
+
+    def residual_chunk(chunk):
+        # FT
+        f_tmp[chunk] = fft.ft(patch[chunk] * probe)
+        # IFT
+        residual = replace_magnitude(f_tmp[chunk], y_meas[chunk])
+        inv_f[chunk] = fft.ift(np.subtract(f_tmp[chunk], residual, out=residual))
+
+    executor.run(residual_chunk, len(patch), f_tmp[0].nbytes)
+
+    return f_tmp, inv_f
+
+
+def wf_obj_grad(cur_est, probe, y_meas, patch_bounds, fft_backend=None, executor=None):
+    """Object gradient function.
+
+    Function to calculate the Wirtinger gradient of the amplitude loss with respect to the complex object.
+
+    Args:
+        cur_est: current estimate of complex object.
+        probe: complex probe.
+        y_meas: pre-processed measurements.
+        patch_bounds: scan coordinates of projections or PatchOperator.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        executor: frame-parallel executor (see parallel.get_frame_executor).
+
+    Returns:
+        gradient at cur_est and Fourier transform of the frame data at cur_est.
+    """
+    patch_op = get_patch_operator(patch_bounds, cur_est.shape, y_meas.shape)
+
+    # take projection of image
+    patch = patch_op.img2patch(cur_est)
+    
+    # FT and IFT of the residual
+    f_tmp, inv_f = wf_residual(patch, probe, y_meas, fft_backend=fft_backend, executor=executor)
+    
+    # back projection
+    return patch_op.patch2img(inv_f * np.conj(probe)), f_tmp
+
+
+def wf_obj_func(cur_est, probe, y_meas, patch_bounds, discretized_sys_mat, prm=1, fft_backend=None, return_ft=False,
+                executor=None):
     """Object update function.
     
     Function to revise estimate of complex object using WF.
@@ -13,64 +85,96 @@ def wf_obj_func(cur_est, probe, y_meas, patch_bounds, discretized_sys_mat, prm=1
         cur_est: current estimate of complex object. 
         probe: complex probe. 
         y_meas: pre-processed measurements.
-        patch_bounds: scan coordinates of projections.
+        patch_bounds: scan coordinates of projections or PatchOperator.
         discretized_sys_mat: the eigen value is used to obtain step size.
         prm: val = 1 when FT is orthonormal.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        return_ft: option to also return the Fourier transform of the frame data at cur_est.
+        executor: frame-parallel executor (see parallel.get_frame_executor).
         
     Returns:
         revised estimate of complex object.
     """
-    # take projection of image
-    patch = img2patch(cur_est, patch_bounds, y_meas.shape)
+    grad, f_tmp = wf_obj_grad(cur_est, probe, y_meas, patch_bounds, fft_backend=fft_backend, executor=executor)
+    output = cur_est - grad / np.amax(prm * discretized_sys_mat)
     
-    # FT
-    f_tmp = compute_ft(patch * probe)
-    
-    # IFT
-    inv_f = compute_ift(f_tmp - y_meas * np.exp(1j * np.angle(f_tmp)))
-    
-    # back projection
-    output = cur_est - patch2img(inv_f * np.conj(probe), patch_bounds, cur_est.shape) / np.amax(prm * discretized_sys_mat)
-    
-    return output.astype(np.complex64)
+    if return_ft:
+        return output.astype(cur_est.dtype, copy=False), f_tmp
 
+    return output.astype(cur_est.dtype, copy=False)
 
-# def wf_probe_func(cur_est, img_patch, y_meas, discretized_sys_mat, prm=1):
-#     """Probe update function.
-    
-#     Function to revise estimate of complex probe using WF.
-    
-#     Args:
-#         cur_est: current estimate of complex probe.
-#         img_patch: projected image patches.
-#         y_meas: pre-processed measurements.
-#         discretized_sys_mat: the eigen value is used to obtain step size for probe function.
-#         prm: val = 1 if FT is orthonormal.
-        
-#     Returns:
-#         new estimate of complex probe.
-#     """
-#     # FT
-#     f_tmp = compute_ft(cur_est * img_patch)
-    
-#     # IFT
-#     inv_f = compute_ift(f_tmp - y_meas * np.exp(1j * np.angle(f)))
-    
-#     # step_sz = inverse of biggest eigenvalue of semi positive deifnite matrix 
-#     output = cur_est - np.average(np.conj(img_patch) * inv_f / np.amax(prm * discretized_sys_mat), axis=0)
-    
-#     return output.astype(np.complex64)
+
+def bb_step_size(diff_est, diff_grad, min_step, max_step):
+    """Calculate the (short) Barzilai-Borwein step size <s, y> / <y, y>.
+
+    Args:
+        diff_est: difference s between the current and the previous point of evaluation.
+        diff_grad: difference y between the gradients at these points.
+        min_step: lower bound of the step size.
+        max_step: upper bound of the step size.
+
+    Returns:
+        step size (min_step if the curvature along diff_est is not positive).
+    """
+    curvature = np.real(np.vdot(diff_est, diff_grad))
+    if curvature <= 0:
+        return min_step
+
+    return float(np.clip(curvature / np.real(np.vdot(diff_grad, diff_grad)), min_step, max_step))
+
+
+def wf_joint_func(cur_obj, cur_probe, y_meas, patch_bounds, prm=1, fft_backend=None, return_ft=False, executor=None):
+    """Joint object and probe update function.
+
+    Function to revise estimates of complex object and complex probe using WF. Both gradients are computed from
+    the same residual, so one update costs a single forward and a single inverse FFT of the frame data.
+
+    Args:
+        cur_obj: current estimate of complex object.
+        cur_probe: current estimate of complex probe.
+        y_meas: pre-processed measurements.
+        patch_bounds: scan coordinates of projections or PatchOperator.
+        prm: val = 1 when FT is orthonormal.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        return_ft: option to also return the Fourier transform of the frame data at (cur_obj, cur_probe).
+        executor: frame-parallel executor (see parallel.get_frame_executor).
+
+    Returns:
+        revised estimates of complex object and complex probe.
+    """
+    patch_op = get_patch_operator(patch_bounds, cur_obj.shape, y_meas.shape)
+
+    # take projection of image
+    patch = patch_op.img2patch(cur_obj)
+
+    # shared residual of both gradients
+    f_tmp, inv_f = wf_residual(patch, cur_probe, y_meas, fft_backend=fft_backend, executor=executor)
+
+    # step sizes from the weight matrices of the current estimates (the object weight is cached by the PatchOperator)
+    obj_wgt_mat = patch_op.illumination_weight(cur_probe)
+    probe_wgt_mat = np.sum(np.abs(patch) ** 2, 0)
+
+    # back projection (both blocks are updated simultaneously, so the step sizes are halved)
+    est_obj = cur_obj - patch_op.patch2img(inv_f * np.conj(cur_probe)) / np.amax(2 * prm * np.abs(obj_wgt_mat))
+    est_probe = cur_probe - np.sum(np.conj(patch) * inv_f, axis=0) / np.amax(2 * prm * probe_wgt_mat)
+
+    if return_ft:
+        return est_obj.astype(cur_obj.dtype, copy=False), est_probe.astype(cur_probe.dtype, copy=False), f_tmp
+
+    return est_obj.astype(cur_obj.dtype, copy=False), est_probe.astype(cur_probe.dtype, copy=False)
 
 
 def wf_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, ref_probe=None, 
-             num_iter=100, joint_recon=False, recon_win=None, save_dir=None, accel=True):
+             num_iter=100, joint_recon=False, recon_win=None, save_dir=None, accel=True,
+             fft_backend=None, metrics=None, checkpoint_every=None, resume_from=None, step_rule='fixed',
+             max_step_ratio=10, stop=None, precision=None, telemetry=None, callback=None, parallel=None):
     """Wirtinger Flow.
     
     Function to perform WF/AWF reconstruction on ptychographic data.
     
     Args:
         y_meas: pre-processed measurements (diffraction patterns / intensity data).
-        patch_bounds: scan coordinates of projections.
+        patch_bounds: scan coordinates of projections or PatchOperator (reusing its index maps and image weights).
         init_obj: formulated initial guess of complex object.
         init_probe: formulated initial guess of complex probe.
         ref_obj: complex reference image for object.
@@ -80,98 +184,200 @@ def wf_recon(y_meas, patch_bounds, init_obj, init_probe=None, ref_obj=None, ref_
         recon_win: pre-defined window for showing and comparing reconstruction results.
         save_dir: directory to save reconstruction results.
         accel: option to add Nesterov's acceleration.
+        fft_backend: FFT backend name or instance (see fft_backend.get_fft_backend).
+        metrics: metrics policy (see metrics.get_metrics_policy).
+        checkpoint_every: save a checkpoint of the solver state to save_dir every k iterations.
+        resume_from: path to a checkpoint file to resume the reconstruction from.
+        stop: stopping criterion (see stopping.get_stopping_criterion).
+        precision: precision policy (see precision.get_precision).
+        telemetry: iteration telemetry (see telemetry.get_telemetry).
+        callback: function or observer notified after every iteration (see observers.get_observer).
+        step_rule: 'fixed' for the step size 1 / max(illumination weight), 'bb' for Barzilai-Borwein step sizes
+            with restart of the acceleration whenever the amplitude loss rises (object update only).
+        max_step_ratio: upper bound of the Barzilai-Borwein step size relative to the fixed step size.
+        parallel: frame-parallel executor of the FFTs and magnitude replacements (see parallel.get_frame_executor).
         
     Returns:
         Reconstructed complex images and NRMSE between reconstructions and reference images.
     """
-    cdtype = np.complex64
+    prec = get_precision(precision)
+    cdtype = prec.cdtype
     approach = 'AWF' if accel else 'WF'
+    if step_rule not in ['fixed', 'bb']:
+        raise ValueError('Unknown step rule: {}'.format(step_rule))
+    if step_rule == 'bb' and joint_recon:
+        raise ValueError("step_rule='bb' is only supported for the object update (joint_recon=False).")
+    telemetry = get_telemetry(telemetry)
+    fft = telemetry.wrap_fft(get_fft_backend(fft_backend))
+    metrics = get_metrics_policy(metrics)
+    stop = get_stopping_criterion(stop)
+    observer = get_observer(callback)
+    executor = get_frame_executor(parallel)
     # check directory
     if save_dir is not None:
         os.makedirs(save_dir, exist_ok=True)
+    elif checkpoint_every:
+        raise ValueError('save_dir is required for saving checkpoints.')
 
     # initialization
-    if recon_win is None:
-        recon_win = np.ones_like(init_obj)
+    y_meas = prec.real(y_meas)
+    recon_win = prec.real(recon_win) if recon_win is not None else np.ones(init_obj.shape, dtype=prec.rdtype)
 
     nrmse_obj = []
     nrmse_probe = []
     nrmse_meas = []
+    metric_iters = []
 
     est_obj = np.asarray(init_obj, dtype=cdtype)
     old_obj = np.copy(est_obj)
+    patch_op = telemetry.wrap_patch_op(get_patch_operator(patch_bounds, est_obj.shape, y_meas.shape))
 
     est_probe = np.asarray(init_probe, dtype=cdtype) if joint_recon else ref_probe.astype(cdtype)
     old_probe = np.copy(est_probe)
 
+    # state of the acceleration restarts and of the Barzilai-Borwein step sizes
+    accel_start = 0
+    prev_obj, prev_grad, prev_loss = None, None, None
+
+    # restore solver state from checkpoint
+    start_iter = 0
+    if resume_from is not None:
+        ckpt = load_checkpoint(resume_from, approach)
+        start_iter, est_obj, old_obj, est_probe, old_probe = [ckpt[key] for key in ['iteration', 'object', 'old_obj', 'probe', 'old_probe']]
+        nrmse_obj, nrmse_probe, nrmse_meas, metric_iters = [ckpt[key] for key in HISTORY_KEYS]
+        accel_start = int(ckpt.get('accel_start', 0))
+        prev_obj, prev_grad, prev_loss = [ckpt.get(key) for key in ['prev_obj', 'prev_grad', 'prev_loss']]
+
     # calculate weight matrix for object update function
-    obj_wgt_mat = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, est_obj.shape)
+    obj_wgt_mat = patch_op.illumination_weight(est_probe)
+    fixed_step = 1 / np.amax(np.abs(obj_wgt_mat))
 
     # WF reconstruction
     # start_time = time.time()
     print('{} recon starts ...'.format(approach))
-    for i in tqdm(range(num_iter)):
-        if accel:
-            beta = (i + 2) / (i + 4)
-        else:
-            beta = 0
-        # revise estimate of complex object
-        cur_obj = est_obj + beta * (est_obj - old_obj)
-        old_obj = np.copy(est_obj)
-        est_obj = wf_obj_func(cur_obj, est_probe, y_meas, patch_bounds, obj_wgt_mat)
-
-        if joint_recon:
-            # calculate weight matrix for probe update function
-            est_patch = img2patch(est_obj, patch_bounds, y_meas.shape)
-            probe_wgt_mat = np.sum(np.abs(est_patch) ** 2, 0)
-            # revise estimate of complex probe
-            cur_probe = est_probe + beta * (est_probe - old_probe)
-            old_probe = np.copy(est_probe)
-            est_probe = wf_probe_func(cur_probe, est_patch, y_meas, probe_wgt_mat)
-            # update weight matrix for object update function
-            obj_wgt_mat = patch2img(np.abs([est_probe] * len(y_meas)) ** 2, patch_bounds, est_obj.shape)
-
-        # phase normalization and scale image to minimize the intensity difference
-        if ref_obj is not None:
-            revy_obj = phase_norm(np.copy(est_obj) * recon_win, ref_obj * recon_win, cstr=recon_win)
-            err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
-            nrmse_obj.append(err_obj)
-        else:
-            revy_obj = est_obj 
-        if joint_recon:
-            if ref_probe is not None:
-                revy_probe = phase_norm(np.copy(est_probe), ref_probe)
-                err_probe = compute_nrmse(revy_probe, ref_probe)
-                nrmse_probe.append(err_probe)
-            else:
-                revy_probe = est_probe
-        else:
-            revy_probe = est_probe
-
-        # calculate error in measurement domain
-        est_patch = img2patch(est_obj, patch_bounds, y_meas.shape).astype(cdtype)
-        est_meas = np.abs(compute_ft(est_probe * est_patch))
-        nrmse_meas.append(compute_nrmse(est_meas, y_meas))
-
-    # # calculate time consumption
-    # print('Time consumption of {}:'.format(approach), time.time() - start_time)
-
-    # save recon results
-    if save_dir is not None:
-        save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
-        if nrmse_obj:
-            save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
-        if nrmse_meas:
-            save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
-        if joint_recon:
-            save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
-            if nrmse_probe:
-                save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    stop.start()
+    telemetry.start(approach, save_dir)
+    observer.start(approach)
+    stop_reason = None
+    # estimates returned if the checkpoint already reached num_iter
+    i = start_iter - 1
+    revy_obj, revy_probe = est_obj, est_probe
+    try:
+        for i in tqdm(range(start_iter, num_iter), initial=start_iter, total=num_iter):
+            with telemetry.phase('update'):
+                if accel:
+                    beta = (i - accel_start + 2) / (i - accel_start + 4)
+                else:
+                    beta = 0
+                # revise estimate of complex object
+                cur_obj = est_obj + beta * (est_obj - old_obj)
+                old_obj = np.copy(est_obj)
+                if joint_recon:
+                    # revise estimates of complex object and complex probe with one FFT/IFFT pair
+                    cur_probe = est_probe + beta * (est_probe - old_probe)
+                    old_probe = np.copy(est_probe)
+                    if metrics.lagged_meas:
+                        est_obj, est_probe, est_ft = wf_joint_func(cur_obj, cur_probe, y_meas, patch_op, fft_backend=fft, return_ft=True, executor=executor)
+                    else:
+                        est_obj, est_probe = wf_joint_func(cur_obj, cur_probe, y_meas, patch_op, fft_backend=fft, executor=executor)
+                elif step_rule == 'bb':
+                    # gradient and amplitude loss share the residual of a single FFT/IFFT pair
+                    grad, est_ft = wf_obj_grad(cur_obj, est_probe, y_meas, patch_op, fft_backend=fft, executor=executor)
+                    loss = np.sum((np.abs(est_ft) - y_meas) ** 2)
+                    if prev_loss is not None and loss > prev_loss:
+                        # fall back to the fixed step size and restart the acceleration from the last estimate
+                        # (the only case with an extra FFT/IFFT pair)
+                        prev_obj, prev_grad = None, None
+                        if accel:
+                            cur_obj, accel_start = old_obj, i + 1
+                            grad, est_ft = wf_obj_grad(cur_obj, est_probe, y_meas, patch_op, fft_backend=fft, executor=executor)
+                            loss = np.sum((np.abs(est_ft) - y_meas) ** 2)
+                    if prev_obj is None:
+                        step_sz = fixed_step
+                    else:
+                        step_sz = bb_step_size(cur_obj - prev_obj, grad - prev_grad, fixed_step, max_step_ratio * fixed_step)
+                    est_obj = (cur_obj - step_sz * grad).astype(cdtype)
+                    prev_obj, prev_grad, prev_loss = cur_obj, grad, loss
+                elif metrics.lagged_meas:
+                    est_obj, est_ft = wf_obj_func(cur_obj, est_probe, y_meas, patch_op, obj_wgt_mat, fft_backend=fft, return_ft=True, executor=executor)
+                else:
+                    est_obj = wf_obj_func(cur_obj, est_probe, y_meas, patch_op, obj_wgt_mat, fft_backend=fft, executor=executor)
+
+            # check stopping criterion (the plateau of err_meas is tested after its evaluation)
+            stop_reason = stop.check(i + 1, est_obj)
+            # notify the observer, which may request to stop
+            if observer.update(i + 1, est_obj, est_probe) and not stop_reason:
+                stop_reason = 'callback'
+
+            # evaluate convergence metrics according to metrics policy (and when stopping)
+            if metrics.due(i, num_iter) or stop_reason:
+                with telemetry.phase('metrics'):
+                    metric_iters.append(i + 1)
+                    # phase normalization and scale image to minimize the intensity difference
+                    if ref_obj is not None:
+                        revy_obj = phase_norm(est_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        err_obj = compute_nrmse(revy_obj * recon_win, ref_obj * recon_win, cstr=recon_win)
+                        nrmse_obj.append(err_obj)
+                    else:
+                        revy_obj = est_obj 
+                    if joint_recon:
+                        if ref_probe is not None:
+                            revy_probe = phase_norm(np.copy(est_probe), ref_probe)
+                            err_probe = compute_nrmse(revy_probe, ref_probe)
+                            nrmse_probe.append(err_probe)
+                        else:
+                            revy_probe = est_probe
+                    else:
+                        revy_probe = est_probe
+
+                    # calculate error in measurement domain (optionally reusing the FFT of the object update)
+                    if metrics.lagged_meas:
+                        nrmse_meas.append(ft_nrmse(est_ft, y_meas, frames=metrics.frames(len(y_meas))))
+                    else:
+                        nrmse_meas.append(meas_nrmse(est_obj, est_probe, y_meas, patch_op, fft, frames=metrics.frames(len(y_meas))))
+                # test the plateau of err_meas with its new value
+                if not stop_reason:
+                    stop_reason = stop.check_meas(i + 1, nrmse_meas)
+
+            # save checkpoint of solver state
+            if checkpoint_every and (i + 1) % checkpoint_every == 0:
+                with telemetry.phase('io'):
+                    save_checkpoint(save_dir + 'checkpoint.h5', approach, i + 1, object=est_obj, probe=est_probe, old_obj=old_obj, old_probe=old_probe,
+                                    accel_start=accel_start, prev_obj=prev_obj, prev_grad=prev_grad, prev_loss=prev_loss,
+                                    err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas, metric_iters=metric_iters)
+
+            telemetry.end_iteration(i + 1, metric_iters, err_obj=nrmse_obj, err_probe=nrmse_probe, err_meas=nrmse_meas)
+
+            if stop_reason:
+                print('{} recon stopped after {} iterations ({}).'.format(approach, i + 1, stop_reason))
+                break
+
+        # # calculate time consumption
+        # print('Time consumption of {}:'.format(approach), time.time() - start_time)
+
+        # save recon results
+        with telemetry.phase('io'):
+            if save_dir is not None:
+                save_tiff(est_obj, save_dir + 'est_obj_iter_{}.tiff'.format(i + 1))
+                if nrmse_obj:
+                    save_array(nrmse_obj, save_dir + 'nrmse_obj_' + str(nrmse_obj[-1]))
+                if nrmse_meas:
+                    save_array(nrmse_meas, save_dir + 'nrmse_meas_' + str(nrmse_meas[-1]))
+                if joint_recon:
+                    save_tiff(est_probe, save_dir + 'probe_est_iter_{}.tiff'.format(i + 1))
+                    if nrmse_probe:
+                        save_array(nrmse_probe, save_dir + 'nrmse_probe_' + str(nrmse_probe[-1]))
+    except BaseException:
+        stop_reason = 'error'
+        raise
+    finally:
+        observer.finish()
+        telemetry.close(stop_reason=stop_reason or 'num_iter')
 
     # return recon results
     print('{} recon completed.'.format(approach))
-    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas']
-    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas]
+    keys = ['object', 'probe', 'err_obj', 'err_probe', 'err_meas', 'metric_iters', 'num_iter', 'stop_reason']
+    vals = [revy_obj, revy_probe, nrmse_obj, nrmse_probe, nrmse_meas, metric_iters, i + 1, stop_reason or 'num_iter']
     output = dict(zip(keys, vals))
 
     return output
@@ -0,0 +1,45 @@
+import argparse, yaml, os, time
+from shutil import copyfile
+from paper_TCI2023.ptycho import benchmark
+
+
+'''
+This file benchmarks the reconstruction engines on synthetic data generated from the parameters in the config 
+file. The results are written to a time-stamped JSON file in the output directory. 
+'''
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark of the reconstruction engines.')
+    parser.add_argument('config_dir', type=str, help='Path to config file.', 
+                        nargs='?', const='config/benchmark.yaml', 
+                        default='config/benchmark.yaml')
+    return parser
+
+
+def main():
+    # Arguments
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config_dir, 'r') as f:
+        config = yaml.safe_load(f)
+    bench_config = config['benchmark']
+    save_dir = bench_config['out_dir']
+    os.makedirs(save_dir, exist_ok=True)
+
+    # Run benchmark
+    output = os.path.join(save_dir, 'benchmark_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    benchmark.run_benchmark(engines=bench_config['engines'], dataset=config['dataset'], num_iter=bench_config['num_iter'],
+                            warmup=bench_config['warmup'], repeat=bench_config['repeat'],
+                            fft_backend=bench_config['fft_backend'], engine_args=bench_config['engine_args'],
+                            output=output, memory=bench_config.get('memory', False), joint_recon=bench_config['joint_recon'])
+    print('Benchmark results saved to {}.'.format(output))
+
+    # Save config file to output directory
+    copyfile(args.config_dir, os.path.join(save_dir, 'benchmark.yaml'))
+
+
+if __name__ == '__main__':
+    main()
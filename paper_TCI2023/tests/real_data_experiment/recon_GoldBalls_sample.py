@@ -20,6 +20,36 @@ def build_parser():
     return parser
 
 
+def preprocess_data(data_dir, meas_store_path=None):
+    """ Function to load and pre-process the measurements and to generate the initial guess. """
+    # Load intensity only measurements(data) from file and pre-process the data
+    if meas_store_path is not None:
+        # convert the frame data once, then read frames and scan points from the store with the window applied per chunk
+        if not os.path.exists(meas_store_path):
+            meas_store.convert_measurement(data_dir, meas_store_path)
+        store = meas_store.open_measurement(meas_store_path)
+        store.window = gen_tukey_2D_window(np.zeros(store.shape[1:]))
+        y_meas = store.read()
+        scan_loc = store.translations
+        store.close()
+    else:
+        y_tmp = load_measurement(data_dir + 'frame_data/')
+        tukey_win = gen_tukey_2D_window(np.zeros_like(y_tmp[0]))
+        y_meas = y_tmp * tukey_win
+
+        # Load scan points
+        scan_loc = meas_store.read_translations(data_dir + 'Translations.tsv.txt')
+
+    # calculate the coordinates of projections
+    patch_bounds = get_proj_coords_from_data(scan_loc + y_meas.shape[1] / 2, y_meas)
+
+    # Generate formulated initial guess for reconstruction
+    img_sz = math.ceil(np.amax(scan_loc + np.maximum(y_meas.shape[1], y_meas.shape[2])))
+    init_obj = np.ones((img_sz, img_sz), dtype=np.complex64)
+
+    return dict(y_meas=y_meas, patch_bounds=patch_bounds, init_obj=init_obj)
+
+
 def main():
     # Arguments
     parser = build_parser()
@@ -65,21 +95,15 @@ def main():
     # Load ground truth images from file
     ref_probe = load_img(probe_dir)
 
-    # Load intensity only measurements(data) from file and pre-process the data
-    y_tmp = load_measurement(data_dir + 'frame_data/')
-    tukey_win = gen_tukey_2D_window(np.zeros_like(y_tmp[0]))
-    y_meas = y_tmp * tukey_win
-
-    # Load scan points
-    scan_loc_file = pd.read_csv(data_dir + 'Translations.tsv.txt', sep=None, engine='python', header=0)
-    scan_loc = scan_loc_file[['FCx', 'FCy']].to_numpy()
-
-    # calculate the coordinates of projections
-    patch_bounds = get_proj_coords_from_data(scan_loc + y_meas.shape[1] / 2, y_meas)
-
-    # Generate formulated initial guess for reconstruction
-    img_sz = math.ceil(np.amax(scan_loc + np.maximum(y_meas.shape[1], y_meas.shape[2])))
-    init_obj = np.ones((img_sz, img_sz), dtype=np.complex64)
+    # Load intensity only measurements(data) from file and pre-process the data (reusing cached results if enabled)
+    prep_args = dict(data_dir=data_dir, meas_store_path=config['data'].get('meas_store'))
+    if config.get('cache') is not None:
+        cache = prep_cache.PrepCache(config['cache']['dir'], max_bytes=config['cache']['max_gb'] * 2 ** 30)
+        prep = cache.get_or_compute([data_dir + 'frame_data/', data_dir + 'Translations.tsv.txt'], prep_args,
+                                    lambda: preprocess_data(**prep_args))
+    else:
+        prep = preprocess_data(**prep_args)
+    y_meas, patch_bounds, init_obj = prep['y_meas'], prep['patch_bounds'], prep['init_obj']
 
     # Produce the cover/window for comparison
     if comparison_win_crds is not None:
@@ -102,34 +126,45 @@ def main():
                       num_iter=config['recon']['num_iter'], joint_recon=config['recon']['joint_recon'])
     fig_args = dict(display_win=recon_win, phase_norm_win=phase_norm_win, display=display)
 
-    # PMACE recon
+    # Reconstruction jobs
+    stop = config['recon'].get('stop')                  # optional early stopping
+    refine = config['recon'].get('refine_positions')    # optional scan-position refinement
     alpha = config['PMACE']['alpha']                
     rho = config['PMACE']['rho']                       # Mann averaging parameter
     probe_exp = config['PMACE']['probe_exponent']      # probe exponent
     pmace_dir = save_dir + 'PMACE/'
-    pmace_result = pmace_recon(y_meas, patch_bounds, obj_data_fit_prm=alpha, rho=rho, probe_exp=probe_exp, 
-                               add_reg=False, save_dir=pmace_dir, **recon_args)
-    # Plot reconstructed image
-    plot_goldball_img(pmace_result['object'], save_dir=pmace_dir, **fig_args)
-    
-    # ePIE recon
     obj_step_sz = config['ePIE']['obj_step_sz']
     epie_dir = save_dir + 'ePIE/'
-    epie_result = epie_recon(y_meas, patch_bounds, obj_step_sz=obj_step_sz, save_dir=epie_dir, **recon_args)
-    # Plot reconstructed image
-    plot_goldball_img(epie_result['object'], ref_img=pmace_result['object'], save_dir=epie_dir, **fig_args)
-
-    # Accelerated Wirtinger Flow (AWF) recon
     awf_dir = save_dir + 'AWF/'
-    awf_result = wf.wf_recon(y_meas, patch_bounds, accel=True, save_dir=awf_dir, **recon_args)
-    # Plot reconstructed image
-    plot_goldball_img(awf_result['object'], ref_img=pmace_result['object'], save_dir=awf_dir, **fig_args)
-
-    # SHARP recon
     relax_pm = config['SHARP']['relax_pm']
     sharp_dir = save_dir + 'SHARP/'
-    sharp_result = sharp.sharp_recon(y_meas, patch_bounds, relax_pm=relax_pm, save_dir=sharp_dir,**recon_args)
-    # Plot reconstructed image
+    jobs = [('PMACE', pmace_recon, dict(obj_data_fit_prm=alpha, rho=rho, probe_exp=probe_exp, add_reg=False, save_dir=pmace_dir, **recon_args)),
+            ('ePIE', epie_recon, dict(obj_step_sz=obj_step_sz, stop=stop, refine_positions=refine, save_dir=epie_dir, **recon_args)),
+            ('AWF', wf.wf_recon, dict(accel=True, stop=stop, save_dir=awf_dir, **recon_args)),
+            ('SHARP', sharp.sharp_recon, dict(relax_pm=relax_pm, stop=stop, refine_positions=refine, save_dir=sharp_dir, **recon_args))]
+
+    # Background snapshots of the comparison approaches (if enabled)
+    snapshot_every = config['recon'].get('snapshot_every')
+    if snapshot_every is not None:
+        for name, func, kwargs in jobs:
+            if name != 'PMACE':
+                kwargs['callback'] = observers.SnapshotWriter(kwargs['save_dir'] + 'snapshots/', every=snapshot_every)
+
+    # Coarse-to-fine reconstruction of the comparison approaches (if enabled)
+    multires_args = config['recon'].get('multires')
+    if multires_args is not None:
+        jobs = [(name, func, kwargs) if name == 'PMACE' else (name, multires.multires_recon, dict(recon_func=func, **multires_args, **kwargs))
+                for name, func, kwargs in jobs]
+
+    # PMACE, ePIE, Accelerated Wirtinger Flow (AWF) and SHARP recon (in parallel worker processes if enabled)
+    num_workers = None if config['recon'].get('parallel', False) else 1
+    results = runner.run_recon_jobs(jobs, y_meas, patch_bounds, num_workers=num_workers)
+    pmace_result, epie_result, awf_result, sharp_result = [results[name] for name in ['PMACE', 'ePIE', 'AWF', 'SHARP']]
+
+    # Plot reconstructed images
+    plot_goldball_img(pmace_result['object'], save_dir=pmace_dir, **fig_args)
+    plot_goldball_img(epie_result['object'], ref_img=pmace_result['object'], save_dir=epie_dir, **fig_args)
+    plot_goldball_img(awf_result['object'], ref_img=pmace_result['object'], save_dir=awf_dir, **fig_args)
     plot_goldball_img(sharp_result['object'], ref_img=pmace_result['object'], save_dir=sharp_dir, **fig_args)
 
     # Save config file to output directory
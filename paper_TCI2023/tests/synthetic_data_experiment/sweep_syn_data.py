@@ -0,0 +1,91 @@
+import argparse, yaml, os
+from shutil import copyfile
+from paper_TCI2023.ptycho import *
+from paper_TCI2023.ptycho import sweep
+from paper_TCI2023.ptycho.pie import *
+from paper_TCI2023.ptycho_pmace.pmace.pmace import *
+from recon_syn_data import preprocess_data
+
+
+'''
+This file sweeps the hyperparameters of one reconstruction approach on the synthetic data. The parameter 
+ranges are read from the 'sweep' section of the config file. 
+'''
+
+
+ENGINES = {'PMACE': pmace_recon, 'ePIE': epie_recon, 'WF': wf.wf_recon, 'SHARP': sharp.sharp_recon,
+           'SHARP+': sharp.sharp_plus_recon}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep on synthetic data.')
+    parser.add_argument('config_dir', type=str, help='Path to config file.', 
+                        nargs='?', const='config/recon_syn_data.yaml', 
+                        default='config/recon_syn_data.yaml')
+    return parser
+
+
+def main():
+    # Arguments
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config_dir, 'r') as f:
+        config = yaml.safe_load(f)
+    sweep_config = config['sweep']
+
+    # Read data from config file
+    obj_dir = config['data']['obj_dir']
+    probe_dir = config['data']['probe_dir']
+    data_dir = config['data']['data_dir']
+    window_coords = config['recon']['window_coords']
+    save_dir = sweep_config['out_dir']
+    os.makedirs(save_dir, exist_ok=True)
+
+    # Default parameters
+    rand_seed = 0
+    np.random.seed(rand_seed)
+
+    # Load ground truth images from file
+    ref_obj = load_img(obj_dir)
+    ref_probe = load_img(probe_dir)
+
+    # Load intensity only measurements(data) from file and pre-process the data (reusing cached results if enabled)
+    prep_args = dict(data_dir=data_dir, meas_store_path=config['data'].get('meas_store'))
+    if config.get('cache') is not None:
+        cache = prep_cache.PrepCache(config['cache']['dir'], max_bytes=config['cache']['max_gb'] * 2 ** 30)
+        prep = cache.get_or_compute([data_dir + 'frame_data/', data_dir + 'Translations.tsv.txt', obj_dir, probe_dir], prep_args,
+                                    lambda: preprocess_data(ref_obj.shape, ref_probe, **prep_args))
+    else:
+        prep = preprocess_data(ref_obj.shape, ref_probe, **prep_args)
+    y_meas, patch_bounds, init_obj = prep['y_meas'], prep['patch_bounds'], prep['init_obj']
+
+    # Produce the cover/window for comparison
+    if window_coords is not None:
+        xmin, xmax, ymin, ymax = window_coords[0], window_coords[1], window_coords[2], window_coords[3]
+        recon_win = np.zeros_like(init_obj)
+        recon_win[xmin:xmax, ymin:ymax] = 1
+    else:
+        recon_win = None
+
+    # Parameters shared by all trials
+    fixed_args = dict(init_obj=init_obj, ref_obj=ref_obj, ref_probe=ref_probe, recon_win=recon_win, 
+                      joint_recon=config['recon']['joint_recon'], **sweep_config.get('fixed_args', {}))
+
+    # Sweep the parameters of the selected approach
+    best_config, trials = sweep.run_sweep(ENGINES[sweep_config['engine']], sweep_config['params'], y_meas, patch_bounds,
+                                          fixed_args=fixed_args, num_iter=sweep_config['num_iter'],
+                                          metric=sweep_config['metric'], num_samples=sweep_config['num_samples'],
+                                          search=sweep_config['search'], grace_iter=sweep_config['grace_iter'],
+                                          reduction_factor=sweep_config['reduction_factor'],
+                                          num_cpus=sweep_config['num_cpus'], save_dir=save_dir,
+                                          name=sweep_config['engine'])
+    print('Best parameters of {}: {}'.format(sweep_config['engine'], best_config))
+
+    # Save config file to output directory
+    copyfile(args.config_dir, os.path.join(save_dir, 'recon_syn_data.yaml'))
+
+
+if __name__ == '__main__':
+    main()
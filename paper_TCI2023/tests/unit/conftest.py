@@ -0,0 +1,8 @@
+import pytest
+from paper_TCI2023.ptycho.benchmark import make_dataset
+
+
+@pytest.fixture(scope='session')
+def dataset():
+    """Small synthetic data set shared by the unit tests."""
+    return make_dataset(obj_size=64, probe_size=16, step=6, seed=0)
@@ -0,0 +1,79 @@
+import random
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.pie import find_overlaps, color_batches, schedule_batches, epie_update, epie_recon
+
+
+'''
+This file checks the mini-batches of ePIE: the coloring of the scan positions into batches of non-overlapping
+patches, the order in which the batches are visited, and that a batch update equals sequential updates.
+'''
+
+
+def overlap(bounds_a, bounds_b):
+    return bounds_a[0] < bounds_b[1] and bounds_b[0] < bounds_a[1] and bounds_a[2] < bounds_b[3] and bounds_b[2] < bounds_a[3]
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 8])
+def test_batches_do_not_overlap(dataset, batch_size):
+    patch_bounds = np.asarray(dataset['patch_bounds'])
+    batch_idx = color_batches(find_overlaps(patch_bounds), batch_size)
+
+    assert np.all(batch_idx >= 0)
+    assert np.amax(np.bincount(batch_idx)) <= batch_size
+    for k in np.unique(batch_idx):
+        members = np.flatnonzero(batch_idx == k)
+        for a in members:
+            for b in members[members > a]:
+                assert not overlap(patch_bounds[a], patch_bounds[b])
+
+
+def test_schedule_follows_seq(dataset):
+    num_pos = len(dataset['patch_bounds'])
+    batch_idx = color_batches(find_overlaps(dataset['patch_bounds']), 4)
+    seq = list(range(num_pos))
+    random.Random(0).shuffle(seq)
+    batches = schedule_batches(seq, batch_idx)
+
+    # every position once, batches in the order of their first position, positions in the order of seq
+    np.testing.assert_array_equal(np.sort(np.concatenate(batches)), np.arange(num_pos))
+    first = [seq.index(batch[0]) for batch in batches]
+    assert first == sorted(first)
+    for batch in batches:
+        assert len(np.unique(batch_idx[batch])) == 1
+        assert [seq.index(j) for j in batch] == sorted(seq.index(j) for j in batch)
+    assert [list(batch) for batch in schedule_batches(seq)] == [[j] for j in seq]
+
+
+def test_batch_update_equals_sequential(dataset):
+    fft = get_fft_backend('numpy')
+    patch_bounds = np.asarray(dataset['patch_bounds'])
+    batch_idx = color_batches(find_overlaps(patch_bounds), 4)
+    batch = np.flatnonzero(batch_idx == 0)
+    probe = dataset['ref_probe'].astype(np.complex128)
+    y_meas = dataset['y_meas'].astype(np.float64)
+    rng = np.random.default_rng(0)
+    init_obj = np.exp(0.1j * rng.standard_normal(dataset['init_obj'].shape))
+
+    batch_obj = np.copy(init_obj)
+    rows = patch_bounds[batch, 0][:, None, None] + np.arange(y_meas.shape[1])[None, :, None]
+    cols = patch_bounds[batch, 2][:, None, None] + np.arange(y_meas.shape[2])[None, None, :]
+    epie_update(batch_obj, probe, (rows, cols), y_meas[batch], 0.5, 0.5, False, fft)
+
+    seq_obj = np.copy(init_obj)
+    for j in batch:
+        crd0, crd1, crd2, crd3 = patch_bounds[j]
+        epie_update(seq_obj, probe, np.s_[crd0:crd1, crd2:crd3], y_meas[j], 0.5, 0.5, False, fft)
+
+    assert len(batch) > 1
+    np.testing.assert_allclose(batch_obj, seq_obj, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_batched_epie_converges(dataset, batch_size):
+    random.seed(0)
+    output = epie_recon(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], ref_obj=dataset['ref_obj'],
+                        ref_probe=dataset['ref_probe'], num_iter=10, batch_size=batch_size, fft_backend='numpy')
+
+    assert output['err_meas'][-1] < 0.5 * output['err_meas'][0]
@@ -0,0 +1,65 @@
+import random
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.checkpoint import save_checkpoint, load_checkpoint
+from paper_TCI2023.ptycho.pie import epie_recon
+from paper_TCI2023.ptycho.sharp import sharp_recon, sharp_plus_recon
+from paper_TCI2023.ptycho.wf import wf_recon
+
+
+'''
+This file checks the checkpoints of the reconstruction engines: a reconstruction resumed from a checkpoint
+reproduces the uninterrupted one, including the solver state (SHARP frames, AWF momentum, ePIE random order).
+'''
+
+
+ENGINES = [(epie_recon, dict()), (sharp_recon, dict()), (sharp_plus_recon, dict()), (wf_recon, dict(accel=True)),
+           (wf_recon, dict(accel=False))]
+
+
+def run(dataset, recon_func, num_iter, **kwargs):
+    random.seed(0)
+    return recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], init_probe=dataset['ref_probe'],
+                      num_iter=num_iter, joint_recon=True, fft_backend='numpy', **kwargs)
+
+
+@pytest.mark.parametrize('recon_func, kwargs', ENGINES)
+def test_resume_reproduces_uninterrupted(dataset, tmp_path, recon_func, kwargs):
+    save_dir = str(tmp_path) + '/'
+    full = run(dataset, recon_func, 6, **kwargs)
+    first = run(dataset, recon_func, 3, save_dir=save_dir, checkpoint_every=3, **kwargs)
+    # a different random state in between, which the checkpoint restores
+    random.seed(1)
+    resumed = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], init_probe=dataset['ref_probe'],
+                         num_iter=6, joint_recon=True, fft_backend='numpy', resume_from=save_dir + 'checkpoint.h5', **kwargs)
+
+    assert load_checkpoint(save_dir + 'checkpoint.h5')['iteration'] == 3
+    np.testing.assert_array_equal(resumed['object'], full['object'])
+    np.testing.assert_array_equal(resumed['probe'], full['probe'])
+    assert resumed['err_meas'] == full['err_meas']
+    assert resumed['metric_iters'] == full['metric_iters'] == list(range(1, 7))
+    assert first['err_meas'] == full['err_meas'][:3]
+
+
+@pytest.mark.parametrize('recon_func, kwargs', ENGINES)
+def test_resume_at_num_iter(dataset, tmp_path, recon_func, kwargs):
+    save_dir = str(tmp_path) + '/'
+    first = run(dataset, recon_func, 3, save_dir=save_dir, checkpoint_every=3, **kwargs)
+    resumed = run(dataset, recon_func, 3, resume_from=save_dir + 'checkpoint.h5', **kwargs)
+
+    np.testing.assert_array_equal(resumed['object'], first['object'])
+    np.testing.assert_array_equal(resumed['probe'], first['probe'])
+    assert resumed['num_iter'] == 3
+
+
+def test_checkpoint_file(tmp_path):
+    fname = str(tmp_path / 'checkpoint.h5')
+    save_checkpoint(fname, 'SHARP', 2, object=np.ones((4, 4), dtype=np.complex64), err_meas=[0.5, 0.25], probe=None)
+
+    state = load_checkpoint(fname, 'SHARP')
+    assert state['iteration'] == 2
+    assert state['err_meas'] == [0.5, 0.25]
+    assert state['err_obj'] == []
+    assert 'probe' not in state
+    with pytest.raises(ValueError):
+        load_checkpoint(fname, 'ePIE')
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.parallel import FrameExecutor, SerialExecutor, get_frame_executor, fft_threads
+from paper_TCI2023.ptycho.sharp import fourier_projector, sharp_recon
+from paper_TCI2023.ptycho.wf import wf_residual, wf_recon
+
+
+'''
+This file checks the frame-parallel executor: its resolution from the parallel argument of the engines, the
+number of FFT threads inside its workers, and that its results are bit-identical to the serial path.
+'''
+
+
+PARALLEL = dict(num_workers=4, chunk_frames=7)
+
+
+@pytest.mark.parametrize('order', [(None, {}), ({}, None)])
+def test_resolution_independent_of_call_order(order):
+    executors = [get_frame_executor(parallel) for parallel in order]
+
+    for parallel, executor in zip(order, executors):
+        assert isinstance(executor, SerialExecutor) == (parallel is None)
+    assert get_frame_executor(dict(PARALLEL)) is get_frame_executor(dict(PARALLEL))
+
+
+@pytest.mark.parametrize('num_workers, expected', [(1, 8), (4, 1)])
+def test_fft_threads_in_workers(num_workers, expected):
+    executor = FrameExecutor(num_workers=num_workers, chunk_frames=1)
+    threads = []
+    executor.run(lambda chunk: threads.append(fft_threads(8)), 8, 1)
+
+    assert threads == [expected] * 8
+    assert fft_threads(8) == 8
+
+
+@pytest.mark.parametrize('precision', [np.complex64, np.complex128])
+@pytest.mark.parametrize('fft_backend', ['numpy', 'scipy'])
+def test_projections_match_serial(dataset, fft_backend, precision):
+    fft = get_fft_backend(fft_backend)
+    rng = np.random.default_rng(0)
+    shape = dataset['y_meas'].shape
+    frames = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(precision)
+    y_meas = dataset['y_meas'].astype(np.finfo(precision).dtype)
+    probe = dataset['ref_probe'].astype(precision)
+
+    serial = fourier_projector(frames, y_meas, fft_backend=fft)
+    parallel = fourier_projector(frames, y_meas, fft_backend=fft, executor=PARALLEL)
+    np.testing.assert_array_equal(parallel, serial)
+
+    for serial_out, parallel_out in zip(wf_residual(frames, probe, y_meas, fft_backend=fft),
+                                        wf_residual(frames, probe, y_meas, fft_backend=fft, executor=PARALLEL)):
+        np.testing.assert_array_equal(parallel_out, serial_out)
+
+
+@pytest.mark.parametrize('precision', ['single', 'double'])
+@pytest.mark.parametrize('recon_func', [sharp_recon, wf_recon])
+def test_recon_matches_serial(dataset, recon_func, precision):
+    args = dict(init_probe=dataset['ref_probe'], ref_probe=dataset['ref_probe'], num_iter=3, joint_recon=True,
+                fft_backend='numpy', precision=precision)
+    serial = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], **args)
+    parallel = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], parallel=PARALLEL, **args)
+
+    np.testing.assert_array_equal(parallel['object'], serial['object'])
+    np.testing.assert_array_equal(parallel['probe'], serial['probe'])
+    assert parallel['err_meas'] == serial['err_meas']
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.patch_ops import PatchOperator, get_patch_operator
+
+
+'''
+This file checks the patch operator against naive loops over the patches: the gather of patches from the
+full-size image, the scatter-add of patches into it, and the cached illumination weight of a probe.
+'''
+
+
+def naive_img2patch(img, patch_bounds):
+    return np.array([img[r0:r1, c0:c1] for r0, r1, c0, c1 in patch_bounds])
+
+
+def naive_patch2img(patches, patch_bounds, img_shape):
+    img = np.zeros(img_shape, dtype=np.complex128)
+    for patch, (r0, r1, c0, c1) in zip(patches, patch_bounds):
+        img[r0:r1, c0:c1] += patch
+
+    return img
+
+
+@pytest.fixture
+def patch_op(dataset):
+    return PatchOperator(dataset['patch_bounds'], dataset['init_obj'].shape, dataset['y_meas'].shape)
+
+
+def test_index_tables(dataset, patch_op):
+    assert patch_op.index.dtype == np.int32
+    assert patch_op.index.size == np.prod(dataset['y_meas'].shape)
+    np.testing.assert_array_equal(patch_op.coverage, naive_patch2img(np.ones(dataset['y_meas'].shape),
+                                                                     dataset['patch_bounds'], patch_op.img_shape).real)
+    assert get_patch_operator(patch_op, None, None) is patch_op
+
+
+@pytest.mark.parametrize('dtype', [np.complex64, np.complex128])
+def test_img2patch(dataset, patch_op, dtype):
+    rng = np.random.default_rng(0)
+    img = (rng.standard_normal(patch_op.img_shape) + 1j * rng.standard_normal(patch_op.img_shape)).astype(dtype)
+    expected = naive_img2patch(img, dataset['patch_bounds'])
+
+    np.testing.assert_array_equal(patch_op.img2patch(img), expected)
+    out = np.empty(patch_op.patch_shape, dtype=dtype)
+    assert patch_op.img2patch(img, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+    frames = [7, 2, 11]
+    np.testing.assert_array_equal(patch_op.img2patch(img, frames=frames), expected[frames])
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.complex64, np.complex128])
+def test_patch2img(dataset, patch_op, dtype):
+    rng = np.random.default_rng(1)
+    shape = patch_op.patch_shape
+    patches = rng.standard_normal(shape).astype(dtype)
+    if np.iscomplexobj(patches):
+        patches += 1j * rng.standard_normal(shape).astype(dtype)
+    expected = naive_patch2img(patches, dataset['patch_bounds'], patch_op.img_shape)
+
+    for chunk_frames in [1, 5, 64]:
+        img = patch_op.patch2img(patches, chunk_frames=chunk_frames)
+        assert img.dtype == np.result_type(dtype, np.complex64)
+        np.testing.assert_allclose(img, expected, rtol=1e-5, atol=1e-5)
+
+    weight = 1 + patch_op.coverage
+    np.testing.assert_allclose(patch_op.patch2img(patches, weight), expected / weight, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('dtype', [np.complex64, np.complex128])
+def test_illumination_weight(dataset, patch_op, dtype):
+    probe = dataset['ref_probe'].astype(dtype)
+    expected = naive_patch2img(np.abs([probe] * patch_op.patch_shape[0]) ** 2, dataset['patch_bounds'], patch_op.img_shape)
+
+    img_wgt = patch_op.illumination_weight(probe)
+    assert img_wgt.dtype == dtype
+    np.testing.assert_allclose(img_wgt, expected, rtol=1e-4, atol=1e-6 * np.amax(expected.real))
+    assert np.all(img_wgt[patch_op.coverage == 0] == 0)
+
+    # stack of per-frame probes
+    probes = np.array([probe] * patch_op.patch_shape[0])
+    np.testing.assert_allclose(patch_op.illumination_weight(probes), expected, rtol=1e-4, atol=1e-6 * np.amax(expected.real))
+
+
+def test_illumination_weight_cache(dataset, patch_op):
+    probe = dataset['ref_probe']
+    img_wgt = patch_op.illumination_weight(probe)
+
+    assert patch_op.illumination_weight(np.copy(probe)) is img_wgt
+    new_wgt = patch_op.illumination_weight(2 * probe)
+    assert new_wgt is not img_wgt
+    np.testing.assert_allclose(new_wgt, 4 * img_wgt, rtol=1e-5)
+    assert patch_op.illumination_weight(probe.astype(np.complex128)).dtype == np.complex128
@@ -0,0 +1,110 @@
+import random
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.benchmark import make_dataset
+from paper_TCI2023.ptycho.fft_backend import get_fft_backend
+from paper_TCI2023.ptycho.patch_ops import PatchOperator
+from paper_TCI2023.ptycho.pie import epie_recon
+from paper_TCI2023.ptycho.positions import PositionRefiner, shift_probe
+from paper_TCI2023.ptycho.sharp import sharp_recon
+
+
+'''
+This file checks the scan-position refinement: the in-place move of patches against a rebuilt PatchOperator,
+the inverse subpixel shift of per-frame probes, that the engines are unchanged while it is disabled, and that blind
+SHARP recovers the probe from data with subpixel scan positions.
+'''
+
+
+def bounds_of(corners, patch_shape):
+    return np.stack([corners[:, 0], corners[:, 0] + patch_shape[1], corners[:, 1], corners[:, 1] + patch_shape[2]], axis=1)
+
+
+def test_move_patches_matches_rebuild(dataset):
+    img_shape, patch_shape = dataset['init_obj'].shape, dataset['y_meas'].shape
+    patch_op = PatchOperator(dataset['patch_bounds'], img_shape, patch_shape)
+    probe = dataset['ref_probe']
+    patch_op.illumination_weight(probe)
+
+    rng = np.random.default_rng(0)
+    frames = rng.choice(patch_shape[0], size=patch_shape[0] // 3, replace=False)
+    max_corner = np.array(img_shape) - np.array(patch_shape[1:])
+    corners = np.clip(patch_op.patch_bounds[frames][:, [0, 2]] + rng.integers(-1, 2, size=(len(frames), 2)), 0, max_corner)
+    patch_op.move_patches(frames, corners)
+
+    all_corners = np.array(dataset['patch_bounds'])[:, [0, 2]]
+    all_corners[frames] = corners
+    rebuilt = PatchOperator(bounds_of(all_corners, patch_shape), img_shape, patch_shape)
+    for name in ['patch_bounds', 'index', 'scan_map', 'coverage']:
+        np.testing.assert_array_equal(getattr(patch_op, name), getattr(rebuilt, name))
+    np.testing.assert_array_equal(patch_op.illumination_weight(probe), rebuilt.illumination_weight(probe))
+
+
+def test_refiner_keeps_shared_patch_op(dataset):
+    img_shape, patch_shape = dataset['init_obj'].shape, dataset['y_meas'].shape
+    patch_op = PatchOperator(dataset['patch_bounds'], img_shape, patch_shape)
+    index = np.copy(patch_op.index)
+    positions = patch_op.patch_bounds[:, [0, 2]].astype(np.float64)
+    positions[[2, 5]] += [1.2, -0.7]
+
+    refiner = PositionRefiner()
+    refined_op = refiner.start(patch_op, positions=positions)
+
+    np.testing.assert_array_equal(refiner.moved, [2, 5])
+    np.testing.assert_array_equal(patch_op.index, index)
+    np.testing.assert_array_equal(refined_op.patch_bounds, bounds_of(np.round(positions).astype(int), patch_shape))
+
+
+@pytest.mark.parametrize('precision', [np.complex64, np.complex128])
+def test_shift_probe_inverse(dataset, precision):
+    fft = get_fft_backend('numpy')
+    probe = dataset['ref_probe'].astype(precision)
+    shifts = np.random.default_rng(0).uniform(-0.5, 0.5, size=(5, 2))
+
+    probes = shift_probe(probe, shifts, fft)
+    unshifted = shift_probe(probes, -shifts, fft)
+
+    assert unshifted.dtype == precision
+    np.testing.assert_allclose(unshifted, np.broadcast_to(probe, probes.shape), atol=1e-4 * np.amax(np.abs(probe)))
+
+
+@pytest.mark.parametrize('recon_func, kwargs', [(epie_recon, dict(batch_size=4)), (sharp_recon, dict())])
+def test_disabled_refinement_identical(dataset, recon_func, kwargs):
+    num_iter = 3
+    args = dict(init_probe=dataset['ref_probe'], ref_probe=dataset['ref_probe'], num_iter=num_iter, joint_recon=True,
+                fft_backend='numpy', **kwargs)
+
+    outputs = []
+    # a refiner starting after the last iteration runs the refinement code paths without refining
+    for refine_positions in [None, False, PositionRefiner(first_iter=num_iter)]:
+        random.seed(0)
+        outputs.append(recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'],
+                                  refine_positions=refine_positions, **args))
+
+    for output in outputs[1:]:
+        np.testing.assert_array_equal(output['object'], outputs[0]['object'])
+        np.testing.assert_array_equal(output['probe'], outputs[0]['probe'])
+        assert output['err_meas'] == outputs[0]['err_meas']
+
+
+def test_blind_sharp_with_refined_positions():
+    fft = get_fft_backend('numpy')
+    data = make_dataset(obj_size=96, probe_size=24, step=8, seed=0)
+    shape, probe = data['y_meas'].shape, data['ref_probe']
+    # measurements at subpixel offsets of the nominal (integer) scan positions
+    shifts = np.random.default_rng(1).uniform(-0.5, 0.5, size=(shape[0], 2))
+    shifts -= np.mean(shifts, axis=0)
+    patch_op = PatchOperator(data['patch_bounds'], data['ref_obj'].shape, shape)
+    y_meas = np.abs(fft.ft(patch_op.img2patch(data['ref_obj']) * shift_probe(probe, shifts, fft))).astype(np.float32)
+    # initial probe blurred by one pixel
+    init_probe = np.mean(shift_probe(probe, [[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]], fft), axis=0)
+
+    args = dict(init_probe=init_probe, ref_probe=probe, num_iter=120, joint_recon=True, fft_backend='numpy', relax_pm=0.25)
+    fixed = sharp_recon(y_meas, data['patch_bounds'], data['init_obj'], **args)
+    refined = sharp_recon(y_meas, data['patch_bounds'], data['init_obj'],
+                          refine_positions=dict(first_iter=10, relax=1.0, max_step=0.5), **args)
+
+    true_positions = np.array(data['patch_bounds'])[:, [0, 2]] + shifts
+    assert np.mean(np.abs(refined['positions'] - true_positions)) < 0.5 * np.mean(np.abs(shifts))
+    assert refined['err_probe'][-1] <= fixed['err_probe'][-1]
+    assert refined['err_meas'][-1] < fixed['err_meas'][-1]
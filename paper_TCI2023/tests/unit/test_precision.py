@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.fft_backend import NumpyFFT
+from paper_TCI2023.ptycho.pie import epie_recon
+from paper_TCI2023.ptycho.precision import get_precision
+from paper_TCI2023.ptycho.sharp import sharp_recon
+from paper_TCI2023.ptycho.wf import wf_recon
+
+
+'''
+This file checks that the reconstruction engines follow the precision policy: the object, the probe, the frame
+data passing through the FFTs and the convergence metrics keep the dtypes of the policy during an iteration.
+'''
+
+
+class RecordingFFT(NumpyFFT):
+    """FFT backend recording the dtypes of the frame data it transforms."""
+
+    def __init__(self):
+        self.dtypes = set()
+
+    def _transform(self, input_array, inverse):
+        output = super()._transform(input_array, inverse)
+        self.dtypes.update([input_array.dtype, output.dtype])
+        return output
+
+
+@pytest.mark.parametrize('precision', ['single', 'double'])
+@pytest.mark.parametrize('joint_recon', [False, True])
+@pytest.mark.parametrize('recon_func', [epie_recon, sharp_recon, wf_recon])
+def test_iteration_dtypes(dataset, recon_func, joint_recon, precision):
+    prec = get_precision(precision)
+    fft = RecordingFFT()
+    estimates = []
+
+    def record(iteration, est_obj, est_probe):
+        estimates.append((est_obj.dtype, est_probe.dtype))
+
+    output = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], init_probe=dataset['ref_probe'],
+                        ref_obj=dataset['ref_obj'], ref_probe=dataset['ref_probe'], num_iter=1, joint_recon=joint_recon,
+                        fft_backend=fft, precision=precision, callback=record)
+
+    # object and probe during and after the iteration
+    assert estimates == [(prec.cdtype, prec.cdtype)]
+    assert output['object'].dtype == prec.cdtype
+    assert output['probe'].dtype == prec.cdtype
+    # frame data and its Fourier transforms
+    assert fft.dtypes == {prec.cdtype}
+    # convergence metrics
+    assert len(output['err_meas']) == 1
+    assert np.asarray(output['err_meas'][0]).dtype == prec.rdtype
+    assert np.isrealobj(output['err_obj'][0])
+    if joint_recon:
+        assert np.isrealobj(output['err_probe'][0])
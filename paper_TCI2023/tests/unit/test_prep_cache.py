@@ -0,0 +1,69 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+from paper_TCI2023.ptycho import prep_cache
+from paper_TCI2023.ptycho.prep_cache import PrepCache
+
+
+'''
+This file checks the cache of prepared inputs: the round trip of an entry, the eviction of least recently used
+entries, and its use by concurrent runs, which share the digest index and may evict each other's entries.
+'''
+
+
+def compute_keys(cache_dir, data_dir, num_keys):
+    cache = PrepCache(cache_dir)
+    for k in range(num_keys):
+        cache.key([data_dir], dict(k=k))
+
+
+def test_round_trip_and_eviction(tmp_path):
+    cache = PrepCache(str(tmp_path))
+    arrays = dict(a=np.arange(200, dtype=np.float64), b=None)
+    cache.save('k0', arrays)
+    # room for two entries, the oldest of three is evicted
+    cache.max_bytes = 2.5 * os.path.getsize(os.path.join(str(tmp_path), 'k0.npz'))
+    for age, key in enumerate(['k0', 'k1', 'k2']):
+        if key != 'k0':
+            cache.save(key, arrays)
+        os.utime(os.path.join(str(tmp_path), key + '.npz'), (age, age))
+
+    entries = sorted(name for name in os.listdir(str(tmp_path)))
+    assert entries == ['k1.npz', 'k2.npz']
+    loaded = cache.load('k2')
+    assert list(loaded) == ['a']
+    np.testing.assert_array_equal(loaded['a'], arrays['a'])
+    assert cache.load('k0') is None
+
+
+def test_load_entry_evicted_concurrently(tmp_path, monkeypatch):
+    cache = PrepCache(str(tmp_path))
+    cache.save('k0', dict(a=np.zeros(4)))
+
+    # another run evicts the entry right before it is opened
+    def utime_after_eviction(fname, *args):
+        os.remove(fname)
+        return os.utime(fname, *args)
+    monkeypatch.setattr(prep_cache.os, 'utime', utime_after_eviction)
+
+    assert cache.load('k0') is None
+
+
+def test_concurrent_digest_index(tmp_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    for k in range(5):
+        (data_dir / 'frame_{}.bin'.format(k)).write_bytes(bytes([k]) * 1000)
+    cache_dir = str(tmp_path / 'cache')
+
+    procs = [multiprocessing.Process(target=compute_keys, args=(cache_dir, str(data_dir), 50)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    assert [proc.exitcode for proc in procs] == [0] * 4
+    assert os.listdir(cache_dir) == ['file_digests.json']
+    with open(os.path.join(cache_dir, 'file_digests.json')) as f:
+        assert len(json.load(f)) == 5
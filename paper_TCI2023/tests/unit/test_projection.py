@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.projection import replace_magnitude
+
+
+'''
+This file checks the Fourier magnitude replacement against its definition y * exp(1j * angle(f)).
+'''
+
+
+def make_inputs(dtype, shape=(7, 5, 6), seed=0):
+    """Random Fourier data with zero entries, among them a whole frame at a chunk boundary, and magnitudes."""
+    rng = np.random.default_rng(seed)
+    f = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(dtype)
+    f[rng.random(shape) < 0.2] = 0
+    f[3] = 0
+    y = rng.random(shape).astype(np.finfo(dtype).dtype)
+
+    return f, y
+
+
+@pytest.mark.parametrize('dtype', [np.complex64, np.complex128])
+@pytest.mark.parametrize('chunk_frames', [1, 3, 64])
+@pytest.mark.parametrize('in_place', [False, True])
+def test_matches_definition(dtype, chunk_frames, in_place):
+    f, y = make_inputs(dtype)
+    expected = y * np.exp(1j * np.angle(f))
+
+    output = replace_magnitude(f, y, out=f if in_place else None, chunk_frames=chunk_frames)
+
+    assert output.dtype == dtype
+    if in_place:
+        assert output is f
+    np.testing.assert_allclose(output, expected, rtol=10 * np.finfo(dtype).eps, atol=10 * np.finfo(dtype).eps)
+
+
+@pytest.mark.parametrize('dtype', [np.complex64, np.complex128])
+def test_zero_entries(dtype):
+    f, y = make_inputs(dtype)
+    zero = f == 0
+
+    output = replace_magnitude(f, y, chunk_frames=3)
+
+    np.testing.assert_array_equal(output[zero], y[zero])
+    np.testing.assert_array_equal(output[3], y[3])
+
+
+def test_single_frame():
+    f, y = make_inputs(np.complex64)
+
+    np.testing.assert_allclose(replace_magnitude(f[0], y[0]), y[0] * np.exp(1j * np.angle(f[0])), rtol=1e-6, atol=1e-6)
+
+
+def test_shape_mismatch():
+    f, y = make_inputs(np.complex64)
+
+    with pytest.raises(ValueError):
+        replace_magnitude(f, y[:-1])
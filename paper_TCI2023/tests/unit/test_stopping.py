@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.pie import epie_recon
+from paper_TCI2023.ptycho.sharp import sharp_recon, sharp_plus_recon
+from paper_TCI2023.ptycho.stopping import StoppingCriterion
+from paper_TCI2023.ptycho.wf import wf_recon
+
+
+'''
+This file checks the stopping criterion: its plateau test of err_meas, and the iteration at which the engines
+stop together with the iterations of their recorded metrics.
+'''
+
+
+ENGINES = [epie_recon, sharp_recon, sharp_plus_recon, wf_recon]
+
+
+def test_check_meas():
+    stop = StoppingCriterion(meas_tol=0.1, patience=2)
+    stop.start()
+
+    assert stop.check_meas(2, [1.0, 0.5]) is None
+    assert stop.check_meas(3, [1.0, 0.5, 0.2]) is None
+    assert stop.check_meas(4, [1.0, 0.5, 0.2, 0.46]) == 'meas_tol'
+    assert stop.check(4, np.ones((4, 4))) is None
+
+
+@pytest.mark.parametrize('recon_func', ENGINES)
+def test_meas_tol_stops_on_metric_schedule(dataset, recon_func):
+    # every relative decrease is below meas_tol, so the first plateau test with patience + 1 values stops
+    output = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], ref_probe=dataset['ref_probe'],
+                        num_iter=30, metrics=5, stop=dict(meas_tol=1.0, patience=3), fft_backend='numpy')
+
+    assert output['stop_reason'] == 'meas_tol'
+    assert output['num_iter'] == 20
+    assert output['metric_iters'] == [5, 10, 15, 20]
+    assert len(output['err_meas']) == 4
+
+
+@pytest.mark.parametrize('recon_func', ENGINES)
+def test_obj_tol_records_final_metrics(dataset, recon_func):
+    output = recon_func(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], ref_probe=dataset['ref_probe'],
+                        num_iter=30, metrics=5, stop=dict(obj_tol=10.0), fft_backend='numpy')
+
+    assert output['stop_reason'] == 'obj_tol'
+    assert output['num_iter'] == 2
+    assert output['metric_iters'] == [2]
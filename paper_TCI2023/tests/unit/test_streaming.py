@@ -0,0 +1,47 @@
+import queue
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.streaming import simulate_detector, stream_epie_recon, watch_directory
+
+
+'''
+This file checks the streaming ePIE reconstruction: the frames collected from a source, and the error raised for
+a stream that ends before its first frame.
+'''
+
+
+def centers(patch_bounds):
+    patch_bounds = np.asarray(patch_bounds)
+    return np.stack([patch_bounds[:, 0] + patch_bounds[:, 1], patch_bounds[:, 2] + patch_bounds[:, 3]], axis=1) / 2
+
+
+def test_stream_collects_frames(dataset):
+    source = simulate_detector(dataset['y_meas'], centers(dataset['patch_bounds']))
+    output = stream_epie_recon(source, dataset['ref_probe'], updates_per_frame=1, fft_backend='numpy')
+
+    np.testing.assert_array_equal(output['y_meas'], dataset['y_meas'])
+    assert len(output['patch_bounds']) == len(dataset['y_meas'])
+    assert np.all(np.isfinite(output['object']))
+
+
+def test_empty_iterator(dataset):
+    with pytest.raises(ValueError, match='No frames'):
+        stream_epie_recon(iter([]), dataset['ref_probe'], fft_backend='numpy')
+
+
+def test_empty_queue(dataset):
+    snapshots = []
+    frame_queue = queue.Queue()
+    frame_queue.put(None)
+
+    with pytest.raises(ValueError, match='No frames'):
+        stream_epie_recon(frame_queue, dataset['ref_probe'], snapshot_interval=0, fft_backend='numpy',
+                          on_snapshot=lambda *args: snapshots.append(args))
+    assert snapshots == []
+
+
+def test_watcher_timeout(dataset, tmp_path):
+    source = watch_directory(str(tmp_path), poll_interval=0.01, timeout=0.05)
+
+    with pytest.raises(ValueError, match='No frames'):
+        stream_epie_recon(source, dataset['ref_probe'], fft_backend='numpy')
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from paper_TCI2023.ptycho.runner import share_array, attach_array
+from paper_TCI2023.ptycho.sharp import sharp_recon
+from paper_TCI2023.ptycho.tiling import partition_scan, tiled_recon
+
+
+'''
+This file checks the tiled reconstruction: the partition of the scan into tiles, the shared measurements of its
+worker processes, and its results with and without worker processes.
+'''
+
+
+def test_partition_covers_scan(dataset):
+    tiles = partition_scan(dataset['patch_bounds'], tile_size=24, overlap=6)
+    frames = np.concatenate([tile['frames'] for tile in tiles])
+
+    assert len(tiles) > 1
+    np.testing.assert_array_equal(np.unique(frames), np.arange(len(dataset['patch_bounds'])))
+    for tile in tiles:
+        assert np.all(tile['bounds'] >= 0)
+        assert np.all(tile['bounds'][:, [1, 3]] <= tile['shape'])
+
+
+def test_share_array_casts(dataset):
+    shm, desc = share_array(dataset['y_meas'], dtype=np.float64)
+    try:
+        attached_shm, y_meas = attach_array(desc)
+        assert y_meas.dtype == np.float64
+        np.testing.assert_array_equal(y_meas, dataset['y_meas'])
+        del y_meas
+        attached_shm.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_workers_match_serial(dataset):
+    args = dict(tile_size=32, overlap=6, outer_iter=2, inner_iter=2, ref_probe=dataset['ref_probe'], fft_backend='numpy')
+    serial = tiled_recon(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], sharp_recon, num_workers=1, **args)
+    parallel = tiled_recon(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], sharp_recon, num_workers=2, **args)
+
+    np.testing.assert_array_equal(parallel['object'], serial['object'])
+    assert parallel['err_meas'] == serial['err_meas']
+    assert serial['metric_iters'] == [2, 4]
+
+
+def test_outer_iter_at_least_one(dataset):
+    with pytest.raises(ValueError):
+        tiled_recon(dataset['y_meas'], dataset['patch_bounds'], dataset['init_obj'], sharp_recon, outer_iter=0,
+                    ref_probe=dataset['ref_probe'], num_workers=1)
@@ -15,6 +15,7 @@ setup(
    install_requires=['numpy==1.22.*', 'matplotlib>=3.5', 'scipy==1.8.0', 'pandas==1.4.2',
                      'tifffile==2022.5.4', 'pyfftw==0.13.0', 'PyYAML==6.0',
                      'imagecodecs==2022.2.22', 'scico', 'imageio==2.19.2', 'h5py==3.7.0'],  #external packages as dependencies
+   extras_require={'sweep': ['ray[tune]~=2.3.1', 'hyperopt~=0.2.7']},  #optional dependencies of the hyperparameter sweep
 )
 
 